@@ -76,6 +76,28 @@ CONFIGURATION_INDEX_SETTINGS = {
 
 DEFAULT_CONFIG_DIR = '/etc/elasticarmor'
 DEFAULT_LOGFILE = '/var/log/elasticarmor/elasticarmor.log'
+DEFAULT_LOG_QUEUE_SIZE = 10000  # Records
 DEFAULT_NODE = 'localhost:9200'
 DEFAULT_ADDRESS = 'localhost'
 DEFAULT_PORT = 59200
+DEFAULT_CONTENT_BUFFER_SIZE = 2**16  # Bytes, 64KiB
+DEFAULT_COMPRESSION_LEVEL = 6
+DEFAULT_UPSTREAM_POOL_SIZE = 10  # Connections per node
+DEFAULT_UPSTREAM_IDLE_TIMEOUT = 30  # Seconds
+DEFAULT_UPSTREAM_REQUEST_LIMIT = 1000
+DEFAULT_RETRY_RATIO = 0.1  # Retries per request
+DEFAULT_RETRY_MINIMUM = 10  # Retries per second
+DEFAULT_MAX_TIMEOUT_EXTENSION = 300  # Seconds
+DEFAULT_HEALTH_CHECK_INTERVAL = 10  # Seconds
+DEFAULT_HEALTH_CHECK_TIMEOUT = 2  # Seconds
+DEFAULT_INDEX_CATALOG_INTERVAL = 30  # Seconds
+DEFAULT_METRICS_PORT = 0  # Disabled
+DEFAULT_WORKER_THREADS = 32
+DEFAULT_WORKER_QUEUE_SIZE = 128
+DEFAULT_AUTHENTICATION_CACHE_SIZE = 1000  # Entries
+DEFAULT_AUTHENTICATION_CACHE_TTL = 300  # Seconds
+DEFAULT_ROLE_CACHE_SIZE = 1000  # Entries
+DEFAULT_ROLE_CACHE_TTL = 60  # Seconds
+DEFAULT_PERMISSION_CACHE_SIZE = 10000  # Entries
+DEFAULT_INSPECTION_CACHE_SIZE = 2**24  # Bytes, 16MiB
+DEFAULT_INSPECTION_CACHE_TTL = 300  # Seconds
@@ -1,5 +1,9 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
+import hashlib
+import hmac
+import json
+import os
 import socket
 
 import requests
@@ -7,10 +11,16 @@ from ldap import LDAPError
 
 from elasticarmor import *
 from elasticarmor.util import format_ldap_error, format_elasticsearch_error
+from elasticarmor.util.cache import Cache
 from elasticarmor.util.elastic import SourceFilter, FilterString, FieldsFilter
+from elasticarmor.util.metrics import Histogram
 from elasticarmor.util.mixins import LoggingAware
 
-__all__ = ['AuthorizationError', 'Auth', 'MultipleIncludesError', 'Client']
+__all__ = ['AuthorizationError', 'Auth', 'MultipleIncludesError', 'Client', 'BACKEND_REQUEST_SECONDS']
+
+BACKEND_REQUEST_SECONDS = Histogram('elasticarmor_backend_request_seconds',
+                                    'Time spent waiting for authentication, group and role backends.',
+                                    ['backend', 'operation'])
 
 
 class AuthorizationError(Exception):
@@ -28,6 +38,22 @@ class Auth(LoggingAware, object):
         self.group_backends = settings.group_backends
         self.trusted_proxies = settings.trusted_proxies
 
+        self.negative_authentication_ttl = settings.negative_authentication_ttl
+        self.authentication_cache = Cache(settings.authentication_cache_size)
+        self.permission_cache = Cache(settings.permission_cache_size) if settings.permission_cache_size else None
+        self._credential_salt = os.urandom(16)  # Passwords are never cached in plain text
+
+    def clear_caches(self):
+        """Clear all internal caches."""
+        self.authentication_cache.clear()
+        self.role_backend.clear_cache()
+        if self.permission_cache is not None:
+            self.permission_cache.clear()
+
+    def _create_credential_key(self, client):
+        """Create and return the cache key for the credentials presented by the given client."""
+        return client.username, hmac.new(self._credential_salt, client.password, hashlib.sha256).digest()
+
     def authenticate(self, client, populate=True):
         """Authenticate the given client and return whether it succeeded or not."""
         if client.username is None or client.password is None:
@@ -51,18 +77,18 @@ class Auth(LoggingAware, object):
         else:
             client.name = client.username
             if self.auth_backends:
-                for backend in self.auth_backends:
-                    try:
-                        if backend.authenticate(client):
-                            client.authenticated = True
-                            client.default_role = backend.default_role
-                            break
-                    except LDAPError as error:
-                        self.log.error('Failed to authenticate client "%s" using backend "%s". %s.',
-                                       client, backend.name, format_ldap_error(error))
-                    except requests.RequestException as error:
-                        self.log.error('Failed to authenticate client "%s" using backend "%s". Error: %s.',
-                                       client, backend.name, format_elasticsearch_error(error))
+                cache_key = self._create_credential_key(client)
+                backend = self.authentication_cache.get(cache_key)
+                if backend is not None:
+                    if backend:
+                        self.log.debug('Client "%s" has been authenticated by backend "%s" recently.',
+                                       client, backend.name)
+                        client.authenticated = True
+                        client.default_role = backend.default_role
+                    else:
+                        self.log.debug('Authentication of client "%s" has failed recently.', client)
+                else:
+                    self._authenticate(client, cache_key)
             else:
                 trusted_ports = self.trusted_proxies.get(client.peer_address, [])
                 client.authenticated = trusted_ports is None or client.peer_port in trusted_ports
@@ -72,6 +98,33 @@ class Auth(LoggingAware, object):
 
         return client.authenticated
 
+    def _authenticate(self, client, cache_key):
+        """Authenticate the given client using the configured backends and cache the result."""
+        failed = False
+        for backend in self.auth_backends:
+            try:
+                with BACKEND_REQUEST_SECONDS.time(backend.name, 'authenticate'):
+                    authenticated = backend.authenticate(client)
+
+                if authenticated:
+                    client.authenticated = True
+                    client.default_role = backend.default_role
+                    if backend.cache_ttl:
+                        self.authentication_cache.set(cache_key, backend, backend.cache_ttl)
+                    break
+            except LDAPError as error:
+                failed = True
+                self.log.error('Failed to authenticate client "%s" using backend "%s". %s.',
+                               client, backend.name, format_ldap_error(error))
+            except requests.RequestException as error:
+                failed = True
+                self.log.error('Failed to authenticate client "%s" using backend "%s". Error: %s.',
+                               client, backend.name, format_elasticsearch_error(error))
+        else:
+            if not failed and self.negative_authentication_ttl:
+                # Only cache the failure if all backends could be asked
+                self.authentication_cache.set(cache_key, False, self.negative_authentication_ttl)
+
     def populate(self, client):
         """Populate the group and role memberships of the given client."""
         if self.group_backends and client.username is not None:
@@ -103,6 +156,17 @@ class Auth(LoggingAware, object):
             else:
                 self.log.debug('Client "%s" is a member of the following roles: %s',
                                client, ', '.join(r.id for r in client.roles) or 'None')
+                if client.roles:
+                    self._apply_system_defaults(client)
+
+                # Anything depending solely on the roles of a client may be shared by clients with the same roles
+                client.role_fingerprint = self._create_role_fingerprint(client.roles)
+                client.permission_cache = self.permission_cache
+
+    def _create_role_fingerprint(self, roles):
+        """Create and return a fingerprint identifying the given set of roles."""
+        role_set = sorted((role.id, role.privileges) for role in roles)
+        return hashlib.sha1(json.dumps(role_set, sort_keys=True)).digest()
 
     # TODO: Provide a more sophisticated solution, this can't be the only one..
     def _apply_system_defaults(self, client):
@@ -187,6 +251,11 @@ class Client(LoggingAware, object):
         self.groups = None
         self.roles = None
 
+        self.role_fingerprint = None
+        self.permission_cache = None
+        self.index_catalog = None
+        self.granted_permissions = set()  # Reset by the proxy for each request, reported in the access log
+
     def __str__(self):
         """Return a human readable string representation for this client.
         That's either the name, username or the address and port concatenated with a colon.
@@ -254,7 +323,21 @@ class Client(LoggingAware, object):
         except AttributeError:
             pass
 
-        return any(role.permits(permission, index, document_type, field) for role in self.roles)
+        if self.permission_cache is None:
+            decision = any(role.permits(permission, index, document_type, field) for role in self.roles)
+        else:
+            # Clients with the same roles share their decisions, hence the fingerprint
+            cache_key = (self.role_fingerprint, permission,
+                         _to_cache_key(index), _to_cache_key(document_type), _to_cache_key(field))
+            decision = self.permission_cache.get(cache_key)
+            if decision is None:
+                decision = any(role.permits(permission, index, document_type, field) for role in self.roles)
+                self.permission_cache.set(cache_key, decision)
+
+        if decision:
+            self.granted_permissions.add(permission)
+
+        return decision
 
     def has_restriction(self, index, document_type=None, without_permission=None):
         """Return whether this client is restricted within the given context.
@@ -299,6 +382,13 @@ class Client(LoggingAware, object):
             return  # None of the client's roles permit access to any index or any document type
         elif not filters:
             return filter_string or FilterString()  # Not a single restriction, congratulations!
+        elif single and index is None and len(filters) > 1 and self.index_catalog is not None:
+            # Includes which match neither an index nor an alias do not contribute anything, so
+            # there's no need to refuse the request because of them. Unless there are only such
+            existing = dict((include, excludes) for include, excludes in filters.iteritems()
+                            if self.index_catalog.contains(include, excludes, filter_string))
+            if existing:
+                filters = existing
 
         prepared_filter_string = FilterString()
         for include, excludes in filters.iteritems():
@@ -423,6 +513,7 @@ class Client(LoggingAware, object):
                     else:
                         # But if a role grants the permission at a higher level, guess what,
                         # the client is obviously not restricted at all in the given context
+                        self.granted_permissions.add(permission)
                         return {}
                 else:
                     for restriction in restrictions:
@@ -435,6 +526,7 @@ class Client(LoggingAware, object):
             # for the given context, so the client is not permitted, not at all
             return
 
+        self.granted_permissions.add(permission)
         # Remove the most restrictive filters. This is the part that ensures
         # that we're granting the client the broadest access possible
         scope = 'indices' if index is None else 'types' if document_type is None else 'fields'
@@ -465,3 +557,8 @@ class Client(LoggingAware, object):
                     del filters[include]
 
         return filters
+
+
+def _to_cache_key(value):
+    """Return the given context value in a form suitable for a cache key."""
+    return None if value is None else str(value)
@@ -2,7 +2,11 @@
 
 import crypt
 
+import requests
+
+from elasticarmor.auth import BACKEND_REQUEST_SECONDS
 from elasticarmor.auth.role import Role
+from elasticarmor.util.cache import Cache
 from elasticarmor.util.elastic import ElasticSearchError, ElasticUser
 from elasticarmor.util.mixins import LoggingAware
 
@@ -14,15 +18,34 @@ class ElasticsearchRoleBackend(LoggingAware, object):
 
     def __init__(self, settings):
         self.connection = settings.elasticsearch
+        self.role_cache = Cache(settings.role_cache_size, settings.role_cache_ttl)
+
+    def clear_cache(self):
+        """Clear the internal role membership cache."""
+        self.role_cache.clear()
 
     def get_role_memberships(self, client):
         """Fetch and return all roles the given client is a member of."""
+        cache_key = (client.name, frozenset(client.groups or []), client.default_role)
+        roles = self.role_cache.get(cache_key)
+        if roles is None:
+            with BACKEND_REQUEST_SECONDS.time('elasticsearch', 'roles'):
+                roles = self._fetch_role_memberships(client)
+
+            self.role_cache.set(cache_key, roles)
+        else:
+            self.log.debug('Using cached role memberships for client "%s".', client)
+
+        return list(roles)  # The caller is free to extend the list, but not the cached one
+
+    def _fetch_role_memberships(self, client):
+        # Failures are raised instead of returning what's known so far, as results are cached
         request = Role.search(client.name, client.groups)
         request.params['size'] = 1000  # If you know how to express "unlimited", feel free to change this!
 
         response = self.connection.process(request)
         if response is None:
-            return []
+            raise requests.ConnectionError('No response received from any of the configured Elasticsearch nodes.')
 
         response.raise_for_status()
         result = response.json()
@@ -36,13 +59,18 @@ class ElasticsearchRoleBackend(LoggingAware, object):
 
         if client.default_role is not None and not any(role.id == client.default_role for role in roles):
             response = self.connection.process(Role.get_source(client.default_role))
-            if response is not None and response.ok:
+            if response is None:
+                raise requests.ConnectionError(
+                    'No response received from any of the configured Elasticsearch nodes.')
+            elif response.ok:
                 try:
                     roles.append(Role.from_source(client.default_role, response.json()))
                 except ElasticSearchError as error:
                     self.log.warning('Failed to create role from source. An error occurred: %s', error)
+            elif response.status_code == 404:
+                self.log.warning('Default role "%s" of client "%s" does not exist.', client.default_role, client)
             else:
-                self.log.warning('Unable to retrieve default role "%s" for client "%s".', client.default_role, client)
+                response.raise_for_status()
 
         return roles
 
@@ -5,6 +5,7 @@ import threading
 
 import ldap
 
+from elasticarmor.auth import BACKEND_REQUEST_SECONDS
 from elasticarmor.util.rwlock import ReadWriteLock, Protector
 
 __all__ = ['LdapBackend', 'LdapUserBackend', 'LdapUsergroupBackend']
@@ -189,6 +190,7 @@ class LdapUsergroupBackend(LdapBackend):
             memberships = membership_cache['memberships']
         else:
             with self._cache_lock.writeContext:
+                started = time.time()
                 self.bind()
                 user_filter = self.render_search_filter({'objectClass': self.user_object_class,
                                                          self.user_name_attribute: client.name})
@@ -210,5 +212,6 @@ class LdapUsergroupBackend(LdapBackend):
                     'expires': now + CACHE_INVALIDATION_INTERVAL
                 }
                 self.unbind()
+                BACKEND_REQUEST_SECONDS.observe(time.time() - started, self.name, 'groups')
 
         return memberships
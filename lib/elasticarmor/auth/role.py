@@ -6,7 +6,7 @@ from elasticarmor.auth import AuthorizationError
 from elasticarmor.util import pattern_compare
 from elasticarmor.util.elastic import ElasticRole
 
-__all__ = ['RoleError', 'RestrictionsFound', 'Role', 'RestrictionError', 'Restriction', 'Pattern']
+__all__ = ['RoleError', 'RestrictionsFound', 'Role', 'RestrictionError', 'Restriction', 'RestrictionIndex', 'Pattern']
 
 
 class RoleError(AuthorizationError):
@@ -73,6 +73,27 @@ class Role(ElasticRole):
             self.__privileges = {'cluster': cluster, 'indices': indices, 'types': types, 'fields': fields}
             return self.__privileges
 
+    def _find_restrictions(self, scope, pattern=None):
+        """Return all restrictions of the given scope which may match the given pattern, in their original order."""
+        if pattern is None:
+            return self._privileges[scope]
+
+        try:
+            indices = self.__restriction_indices
+        except AttributeError:
+            indices = self.__restriction_indices = {}
+
+        depth = pattern.depth
+        if depth > ('indices', 'types', 'fields').index(scope):
+            return self._privileges[scope]  # Not a case RestrictionIndex is able to handle
+
+        try:
+            index = indices[(scope, depth)]
+        except KeyError:
+            index = indices[(scope, depth)] = RestrictionIndex(self._privileges[scope], depth)
+
+        return index.find(pattern)
+
     def get_restricted_scope(self):
         """Return the smallest scope this role has restrictions for.
         That's either None, 'indices', 'types' or 'fields'.
@@ -96,7 +117,7 @@ class Role(ElasticRole):
         restrictions, candidates, restrictions_found = [], [], False
         if document_type is not None:
             pattern = Pattern.from_context(index, document_type)
-            for restriction in self._privileges['fields']:
+            for restriction in self._find_restrictions('fields', pattern):
                 if restriction.matches(pattern):
                     if permission is None:
                         # If there is no permission it's the restriction itself we're interested in
@@ -133,7 +154,7 @@ class Role(ElasticRole):
                 register_candidates = True
                 pattern = Pattern.from_context(index)
 
-            for restriction in self._privileges['types']:
+            for restriction in self._find_restrictions('types', pattern):
                 if restriction.matches(pattern):
                     if permission is None:
                         restrictions.append(restriction)
@@ -183,7 +204,7 @@ class Role(ElasticRole):
                 register_candidates = True
                 pattern = None
 
-            for restriction in self._privileges['indices']:
+            for restriction in self._find_restrictions('indices', pattern):
                 if pattern is None or restriction.matches(pattern):
                     if permission is None:
                         restrictions.append(restriction)
@@ -240,9 +261,11 @@ class Role(ElasticRole):
             if type_match is not None:
                 return type_match
 
-        if index is not None:
-            index_match = self._grants_permission(permission, self.get_restrictions(),
-                                                  Pattern.from_context(index))
+        if index is not None and self._privileges['indices']:
+            pattern = Pattern.from_context(index)
+            candidates = self._find_restrictions('indices', pattern)
+            # If none of the candidates match, there are still restrictions and these do not grant the permission
+            index_match = self._grants_permission(permission, candidates, pattern) if candidates else False
             if index_match is not None:
                 return index_match
 
@@ -374,6 +397,81 @@ class Restriction(object):
             not any(exclude >= pattern for exclude in self.excludes)
 
 
+class RestrictionIndex(object):
+    """Index of restrictions which allows to quickly look up candidates for a particular pattern.
+
+    Restrictions are indexed by their own includes and by the includes of their parents, up to the given
+    depth. That's the depth of the patterns to look up. (0 = index, 1 = type, 2 = field) The candidates
+    returned may still not match, so they need to be checked with Restriction.matches() anyway.
+    """
+
+    def __init__(self, restrictions, depth):
+        self.restrictions = restrictions
+        self.depth = depth
+
+        self._levels = [_IncludeIndex() for _ in range(depth + 1)]
+        for position, restriction in enumerate(restrictions):
+            lineage = []
+            while restriction is not None:
+                lineage.insert(0, restriction)
+                restriction = restriction.parent
+
+            for level, ancestor in zip(self._levels, lineage):
+                for include in ancestor.includes:
+                    level.add(include.pattern, position)
+
+    def find(self, pattern):
+        """Return all restrictions which may match the given pattern, in their original order."""
+        subjects, parent = [pattern.pattern], pattern.parent
+        while parent is not None:
+            subjects.insert(0, parent.includes[0].pattern if len(parent.includes) == 1 else None)
+            parent = parent.parent
+
+        positions = None
+        for depth, subject in enumerate(subjects):
+            if depth < self.depth and (subject is None or '*' in subject):
+                # A parent's includes only need to match the very same pattern if it's a literal one
+                continue
+
+            candidates = self._levels[depth].find(subject)
+            positions = candidates if positions is None else positions & candidates
+
+        return [self.restrictions[position] for position in sorted(positions)]
+
+
+class _IncludeIndex(object):
+    """Helper for class RestrictionIndex which maps include patterns to the positions of their restrictions."""
+
+    def __init__(self):
+        self._literals = {}  # Includes without wildcards can only match the very same pattern
+        self._prefixes = {}  # Includes with wildcards can only match patterns starting with the same literal prefix
+        self._prefix_lengths = []
+        self._wildcards = set()  # Includes starting with a wildcard may match anything
+
+    def add(self, pattern, position):
+        if '*' not in pattern:
+            self._literals.setdefault(pattern, set()).add(position)
+        elif pattern.startswith('*'):
+            self._wildcards.add(position)
+        else:
+            prefix = pattern[:pattern.index('*')]
+            self._prefixes.setdefault(prefix, set()).add(position)
+            if len(prefix) not in self._prefix_lengths:
+                self._prefix_lengths.append(len(prefix))
+                self._prefix_lengths.sort()
+
+    def find(self, subject):
+        positions = set(self._wildcards)
+        positions.update(self._literals.get(subject, ()))
+        for length in self._prefix_lengths:
+            if length > len(subject):
+                break
+
+            positions.update(self._prefixes.get(subject[:length], ()))
+
+        return positions
+
+
 # TODO: Comments. This is way too much magic to remain uncommented...
 class Pattern(object):
     """Pattern container which provides methods to perform rich comparisons with other patterns."""
@@ -391,6 +489,16 @@ class Pattern(object):
     def __repr__(self):
         return 'Pattern({0!r}, {1!r})'.format(self.pattern, self.parent)
 
+    @property
+    def depth(self):
+        """The depth of this pattern in the hierarchy. (0 = index, 1 = type, 2 = field)"""
+        if self.parent is None:
+            return 0
+        elif self.parent.parent is None:
+            return 1
+
+        return 2
+
     @classmethod
     def from_context(cls, index, document_type=None, field=None):
         """Create and return a new instance of Pattern using the given context."""
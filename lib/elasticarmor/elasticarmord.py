@@ -7,7 +7,9 @@ from elasticarmor import *
 from elasticarmor.proxy import ElasticReverseProxy
 from elasticarmor.request import ElasticRequest
 from elasticarmor.settings import ElasticSettings
+from elasticarmor.util.asynclog import AsyncLogHandler
 from elasticarmor.util.daemon import UnixDaemon, StreamLogger
+from elasticarmor.util.metrics import Callback
 from elasticarmor.util.mixins import LoggingAware
 
 __all__ = ['ElasticArmor']
@@ -23,14 +25,33 @@ class ElasticArmor(UnixDaemon, LoggingAware):
 
         self._proxy = ElasticReverseProxy(self.settings)
         self.persistent_files.append(self._proxy.socket)
+        self._log_handler = None
 
     def cleanup(self):
         self.log.info('Shutting down reverse proxy...')
         self._proxy.shutdown()
+        if self._log_handler is not None:
+            self._log_handler.stop()
 
     def handle_reload(self):
+        auth_cache = self._proxy.auth.authentication_cache
+        self.log.info('Clearing authentication cache... (Hits: %u, Misses: %u)', auth_cache.hits, auth_cache.misses)
+        self._proxy.auth.clear_caches()
         self.log.info('Reloading request handler caches...')
         ElasticRequest.clear_caches()
+        if self._proxy.inspection_cache is not None:
+            inspection_cache = self._proxy.inspection_cache
+            self.log.info('Clearing inspection cache... (Hits: %u, Misses: %u)',
+                          inspection_cache.hits, inspection_cache.misses)
+            inspection_cache.clear()
+        if self._proxy.response_cache is not None:
+            response_cache = self._proxy.response_cache
+            self.log.info('Clearing response cache... (Hits: %u, Misses: %u)',
+                          response_cache.hits, response_cache.misses)
+            response_cache.clear()
+        if self._proxy.access_log is not None:
+            self.log.info('Reopening access log...')
+            self._proxy.access_log.reopen()
         if self._proxy.auth.group_backends:
             self.log.info('Reloading group membership cache...')
             for backend in self._proxy.auth.group_backends:
@@ -40,6 +61,9 @@ class ElasticArmor(UnixDaemon, LoggingAware):
                     pass
 
     def run(self):
+        if self._log_handler is not None:
+            self._log_handler.start()
+
         self.log.info('Launching reverse proxy...')
         self._proxy.launch()
 
@@ -63,6 +87,13 @@ class ElasticArmor(UnixDaemon, LoggingAware):
             # The default StreamHandler is the only one at this time
             root_log.handlers[0].setFormatter(logging.Formatter(FILE_LOG_FORMAT_DEBUG))
 
+        if self.settings.log_queue_size:
+            # Started not until the daemon has been detached, as threads do not survive this
+            self._log_handler = AsyncLogHandler(root_log.handlers[0], self.settings.log_queue_size)
+            root_log.handlers = [self._log_handler]
+            Callback('elasticarmor_log_records_dropped_total', 'Log records dropped because the queue was full.',
+                     lambda: self._log_handler.dropped, metric_type='counter')
+
 
 def main():
     logging.basicConfig(level=logging.INFO, format=FILE_LOG_FORMAT)
@@ -1,13 +1,16 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
 import base64
+import hashlib
+import itertools
 import os
 import socket
 import ssl
 import sys
 import threading
+import time
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
-from SocketServer import ThreadingMixIn
+from contextlib import contextmanager
 from urllib import unquote
 from urlparse import urlparse
 
@@ -15,17 +18,25 @@ import requests
 
 from elasticarmor import *
 from elasticarmor.auth import AuthorizationError, Auth, Client
-from elasticarmor.request import ElasticRequest, RequestError
-from elasticarmor.util import format_elasticsearch_error
+from elasticarmor.request import ElasticRequest, ElasticResponse, RequestError
+from elasticarmor.util import format_elasticsearch_error, pattern_match
+from elasticarmor.util.accesslog import AccessLog
+from elasticarmor.util.cache import Cache
+from elasticarmor.util.catalog import IndexCatalog
 from elasticarmor.util.elastic import ElasticSearchError
+from elasticarmor.util.health import CircuitBreaker, HealthChecker
 from elasticarmor.util.http import *
+from elasticarmor.util.metrics import Callback, Counter, Histogram, MetricsServer
 from elasticarmor.util.mixins import LoggingAware
+from elasticarmor.util.poller import ConnectionPoller
+from elasticarmor.util.workers import WorkerPool
 
 # TODO: Make all constants but the format strings configurable
 CONNECTION_TIMEOUT = 5  # Seconds
 CONNECTION_REQUEST_LIMIT = 100
-CONTENT_BUFFER_SIZE = 2**16  # Bytes, 64KiB
-MAX_CHUNK_SIZE = 4096  # Bytes, used when transferring response payloads
+MIN_CHUNK_SIZE = 16384  # Bytes, used when starting to transfer response payloads
+MAX_CHUNK_SIZE = 262144  # Bytes, used when transferring large response payloads
+MAX_CACHED_RESPONSE_SHARE = 0.1  # Of the response cache's size, larger responses are not cached
 DENSE_ERROR_FORMAT = '{"error":"[%(app)s] %(explain)s","status":%(code)d}'
 PRETTY_ERROR_FORMAT = '''{
   "error" : "[%(app)s] %(explain)s",
@@ -33,14 +44,39 @@ PRETTY_ERROR_FORMAT = '''{
 }
 '''
 
+REQUESTS = Counter('elasticarmor_requests_total', 'Responses sent to clients, by request handler and status code.',
+                   ['handler', 'status'])
+REQUEST_PHASE_SECONDS = Histogram('elasticarmor_request_phase_seconds',
+                                  'Time spent in the individual phases of processing a request.', ['phase'])
 
-class ElasticReverseProxy(LoggingAware, ThreadingMixIn, HTTPServer):
+
+class ElasticReverseProxy(LoggingAware, HTTPServer):
     def __init__(self, settings):
         self._terminator = threading.Event()
+        self._workers = WorkerPool(settings.worker_threads, settings.worker_queue_size, 'RequestWorker')
+        if settings.engine == 'evented':
+            self._poller = ConnectionPoller(self._dispatch_connection, self._expire_connection, CONNECTION_TIMEOUT)
+        else:  # settings.engine == 'threaded'
+            self._poller = None
 
         self.auth = Auth(settings)
         self.elasticsearch = settings.elasticsearch
+        self._health_checker = HealthChecker(self.elasticsearch, settings.health_check_interval,
+                                             settings.health_check_timeout)
+        self.content_buffer_size = settings.content_buffer_size
+        self.json_codec = settings.json_codec
+        self.compression_threshold = settings.compression_threshold
+        self.compression_level = settings.compression_level
+        self.inspection_cache = Cache(ttl=settings.inspection_cache_ttl, max_size=settings.inspection_cache_size) \
+            if settings.inspection_cache_size else None
+        self.response_cache = Cache(max_size=settings.response_cache_size) if settings.response_cache_size else None
+        self.index_catalog = IndexCatalog(self.elasticsearch, settings.index_catalog_interval,
+                                          self._clear_inspection_cache) if settings.index_catalog_interval else None
+        self.access_log = AccessLog(settings.access_log) if settings.access_log else None
         self.skip_index_initialization = settings.options.skip_index_initialization
+        self._metrics_server = MetricsServer(settings.metrics_address, settings.metrics_port) \
+            if settings.metrics_port else None
+        self._register_metrics()
 
         listen_address = settings.listen_address
         listen_port = settings.listen_port
@@ -81,6 +117,45 @@ class ElasticReverseProxy(LoggingAware, ThreadingMixIn, HTTPServer):
                 else:
                     self.log.info('Successfully initialized configuration index "%s".', CONFIGURATION_INDEX)
 
+    def _register_metrics(self):
+        caches = {
+            'authentication': self.auth.authentication_cache,
+            'permission': self.auth.permission_cache,
+            'role': self.auth.role_backend.role_cache,
+            'inspection': self.inspection_cache,
+            'response': self.response_cache
+        }
+        caches = dict((name, cache) for name, cache in caches.iteritems() if cache is not None)
+
+        Callback('elasticarmor_workers_busy', 'Worker threads currently processing a request.',
+                 lambda: self._workers.busy)
+        Callback('elasticarmor_worker_queue_depth', 'Requests waiting for a free worker thread.',
+                 lambda: self._workers.queue_depth)
+        Callback('elasticarmor_rejected_requests_total', 'Requests rejected because the worker queue was full.',
+                 lambda: self._workers.rejected, metric_type='counter')
+        Callback('elasticarmor_idle_connections', 'Idle client connections waiting for their next request.',
+                 lambda: self._poller.watched if self._poller is not None else 0)
+        Callback('elasticarmor_cache_hits_total', 'Successful cache lookups.',
+                 lambda: dict(((name,), cache.hits) for name, cache in caches.iteritems()),
+                 ['cache'], 'counter')
+        Callback('elasticarmor_cache_misses_total', 'Cache lookups for which no entry was found.',
+                 lambda: dict(((name,), cache.misses) for name, cache in caches.iteritems()),
+                 ['cache'], 'counter')
+        Callback('elasticarmor_node_available', 'Whether requests are currently sent to an Elasticsearch node.',
+                 lambda: dict(((node,), breaker.state != CircuitBreaker.OPEN)
+                              for node, breaker in self.elasticsearch.breakers.iteritems()), ['node'])
+        Callback('elasticarmor_node_outstanding_requests', 'Requests currently awaiting a response of a node.',
+                 lambda: dict(((node,), self.elasticsearch.balancer.outstanding(node))
+                              for node in self.elasticsearch.nodes), ['node'])
+        if self.access_log is not None:
+            Callback('elasticarmor_access_log_dropped_total', 'Access log records dropped because the queue was full.',
+                     lambda: self.access_log.dropped, metric_type='counter')
+
+    def _clear_inspection_cache(self):
+        # Called by the index catalog, as inspections may depend on which indices exist
+        if self.inspection_cache is not None:
+            self.inspection_cache.clear()
+
     def launch(self):
         if not self.skip_index_initialization:
             self._initialize_configuration_index()
@@ -89,15 +164,115 @@ class ElasticReverseProxy(LoggingAware, ThreadingMixIn, HTTPServer):
         self.log.debug('Bound TCP socket to "%s"...', self.server_address[0])
         self.server_activate()
         self.log.debug('Now listening on port %d...', self.server_port)
+        if self.access_log is not None:
+            self.access_log.start()
+        self._workers.start()
+        self._health_checker.start()
+        self.log.debug('Started to check the health of Elasticsearch nodes...')
+        if self.index_catalog is not None:
+            self.index_catalog.start()
+            self.log.debug('Started to refresh the catalog of indices and aliases...')
+        if self._poller is not None:
+            self._poller.start()
+            self.log.debug('Started to watch idle client connections...')
+        if self._metrics_server is not None:
+            self._metrics_server.start()
+            self.log.debug('Serving metrics on port %d...', self._metrics_server.server_port)
+
         self.log.debug('Starting to serve incoming requests...')
         self.serve_forever()
 
     def process_request(self, request, client_address):
         self.log.debug('Accepted request from "%s:%u".', *client_address)
-        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
-        thread.request_thread = True  # Required to simplify identification when cleaning up
-        thread.start()
-        self.log.debug('Started thread %s to process request from "%s:%u".', thread.name, *client_address)
+        if self._poller is not None:
+            handler = self.RequestHandlerClass(request, client_address, self, serve=False)
+            if not self._poller.watch(request.fileno(), handler):
+                self._close_connection(handler)
+        elif self._workers.submit(self.process_request_thread, request, client_address):
+            self.log.debug('Queued request from "%s:%u". (Queue depth: %u/%u)',
+                           client_address[0], client_address[1], self._workers.queue_depth,
+                           self._workers.queue_size)
+        else:
+            self._log_rejection(client_address)
+            self.reject_request(request, client_address)
+
+    def _log_rejection(self, client_address):
+        self.log.warning('Rejected request from "%s:%u". All workers are busy and the queue is full. (%u'
+                         ' requests rejected so far)', client_address[0], client_address[1],
+                         self._workers.rejected)
+
+    def _dispatch_connection(self, handler):
+        # Called by the poller once a client connection has become readable
+        if not self._workers.submit(self._serve_connection, handler):
+            self._log_rejection(handler.client_address)
+            self.reject_request(handler.request, handler.client_address)
+            handler.finish()
+
+    def _expire_connection(self, handler):
+        # Called by the poller once a client connection has been idle for too long
+        if not self._workers.submit(self._time_out_connection, handler):
+            self._close_connection(handler)
+
+    def _time_out_connection(self, handler):
+        try:
+            handler.process(handler.expire)
+        finally:
+            self._close_connection(handler)
+
+    def _serve_connection(self, handler):
+        try:
+            while True:
+                handler.close_connection = True  # Just like BaseHTTPRequestHandler.handle() does it
+                handler.process(handler.handle_one_request)
+                if handler.close_connection:
+                    break
+                elif handler.has_buffered_input():
+                    continue  # The client has already sent its next request
+                elif self._poller.watch(handler.request.fileno(), handler):
+                    return  # Park the connection until the client sends its next request
+                else:
+                    break
+        except:
+            self.handle_error(handler.request, handler.client_address)
+
+        self._close_connection(handler)
+
+    def _close_connection(self, handler):
+        try:
+            handler.finish()
+        finally:
+            self.shutdown_request(handler.request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def reject_request(self, request, client_address):
+        content = DENSE_ERROR_FORMAT % {'app': APP_NAME, 'code': 503,
+                                        'explain': 'Proxy is overloaded. Please try again later.'}
+        response = '\r\n'.join([
+            'HTTP/1.1 503 Service Unavailable',
+            'Server: {0}/{1}'.format(APP_NAME, VERSION),
+            'Content-Type: application/json',
+            'Content-Length: {0}'.format(len(content)),
+            'Retry-After: 1',
+            'Connection: close',
+            '',
+            content
+        ])
+
+        try:
+            request.settimeout(CONNECTION_TIMEOUT)
+            request.sendall(response)
+        except socket.error as error:
+            self.log.debug('Failed to send error response to "%s:%u". An error occurred: %s',
+                           client_address[0], client_address[1], error)
+        finally:
+            self.shutdown_request(request)
 
     def is_shutting_down(self):
         return self._terminator.is_set()
@@ -107,13 +282,21 @@ class ElasticReverseProxy(LoggingAware, ThreadingMixIn, HTTPServer):
         self._terminator.set()
         HTTPServer.shutdown(self)
 
-        for thread in threading.enumerate():
-            try:
-                if thread.request_thread:
-                    self.log.debug('Waiting for request thread %s to finish...', thread.name)
-                    thread.join()
-            except AttributeError:
-                pass
+        if self._poller is not None:
+            idle_connections = self._poller.stop()
+            self.log.debug('Closing %u idle client connections...', len(idle_connections))
+            for handler in idle_connections:
+                self._close_connection(handler)
+
+        self.log.debug('Waiting for %u queued requests to be processed...', self._workers.queue_depth)
+        self._workers.shutdown()
+        if self.access_log is not None:
+            self.access_log.stop()
+        self._health_checker.stop()
+        if self.index_catalog is not None:
+            self.index_catalog.stop()
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
 
         self.server_close()
         self.log.debug('Closed socket.')
@@ -127,12 +310,19 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
     MessageClass = HttpHeaders
 
-    def __init__(self, request, client_address, server):
+    def __init__(self, request, client_address, server, serve=True):
         self._continue_expected = None
         self._received_requests = 0
         self._context = None
         self._client = None
+        self._handler_name = None
+        self._started = None
+        self._timings = {}
+        self._status = None
+        self._bytes_out = 0
+        self._transformed = False
         self._body = None
+        self._payload = None
 
         self.options = None
 
@@ -148,6 +338,10 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
         # Set the timeout to use for the connection
         request.settimeout(CONNECTION_TIMEOUT)
 
+        # Responses are sent in several pieces, each of which would otherwise be held back until the client
+        # acknowledged the previous one. Clients usually delay this for up to 40ms, hoping to receive more data
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
         # The following is borrowed from SocketServer.BaseRequestHandler.__init__ to be able to handle exceptions.
         # Instead of overwriting SocketServer.BaseServer.handle_error we're doing this here because otherwise it's
         # not possible to utilize all the "shiny" HTTP utilities of BaseHTTPServer.BaseHTTPRequestHandler.
@@ -155,9 +349,17 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
         self.request = request
         self.server = server
 
+        self.setup()
+        if serve:
+            try:
+                self.process(self.handle)
+            finally:
+                self.finish()
+
+    def process(self, handler):
+        """Call the given handler and respond with an appropriate error if it fails."""
         try:
-            self.setup()
-            self.handle()
+            handler()
         except socket.timeout:
             self.close_connection = True
             self.log.debug('Client "%s" timed out. Closing connection.', self.client)
@@ -165,14 +367,16 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
             try:
                 self.send_error(408, explain='Idle time limit exceeded. (%u Seconds)' % CONNECTION_TIMEOUT)
             except socket.error as error:
-                self.log.debug('Failed to send error response to "%s". An error occurred: %s', client_address, error)
+                self.log.debug('Failed to send error response to "%s". An error occurred: %s',
+                               self.client_address, error)
         except ChunkParserError as error:
             self.log.debug('Client "%s" sent an invalid chunked payload. Error: %s', self.client, error)
 
             try:
                 self.send_error(400, explain='Payload encoding invalid. Error: {0}'.format(error))
             except socket.error as error:
-                self.log.debug('Failed to send error response to "%s". An error occurred: %s', client_address, error)
+                self.log.debug('Failed to send error response to "%s". An error occurred: %s',
+                               self.client_address, error)
         except RequestEntityTooLarge as error:
             self.log.debug('Client "%s" exceeded the buffer size limit. Closing connection.', self.client)
             self.close_connection = True
@@ -180,8 +384,21 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
             try:
                 self.send_error(413, explain=str(error))
             except socket.error as error:
-                self.log.debug('Failed to send error response to "%s". An error occurred: %s', client_address, error)
+                self.log.debug('Failed to send error response to "%s". An error occurred: %s',
+                               self.client_address, error)
+        except RequestError as error:
+            # Only raised by request handlers which inspect the payload while it's being forwarded
+            self.close_connection = True
+            self.log.debug('Request of client "%s" got rejected while being forwarded. Error: %s',
+                           self.client, error.reason)
+
+            try:
+                self.send_error(error.status_code, explain=error.reason)
+            except socket.error as error:
+                self.log.debug('Failed to send error response to "%s". An error occurred: %s',
+                               self.client_address, error)
         except requests.RequestException as error:
+            self.close_connection = True
             self.log.error('An error occurred while communicating with Elasticsearch: %s',
                            format_elasticsearch_error(error))
 
@@ -189,10 +406,13 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
                 self.send_error(502, explain='An error occurred while communicating with Elasticsearch.'
                                              ' Please contact an administrator.')
             except socket.error as error:
-                self.log.debug('Failed to send error response to "%s". An error occurred: %s', client_address, error)
+                self.log.debug('Failed to send error response to "%s". An error occurred: %s',
+                               self.client_address, error)
         except socket.error as error:
+            self.close_connection = True
             self.log.error('Connection to client "%s" broke. An error occurred: %s', self.client, error)
         except Exception:
+            self.close_connection = True
             exc_info = sys.exc_info()  # Fetch exception information now..
 
             try:
@@ -205,53 +425,102 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
                 pass
 
             self.log.error('Unhandled exception occurred while handling request "%s" from %s:'
-                           '\nHeaders:\n%s\nBody:\n%s\n', self.requestline, client_address,
+                           '\nHeaders:\n%s\nBody:\n%s\n', self.requestline, self.client_address,
                            self.headers, body, exc_info=exc_info)
             try:
                 self.send_error(
                     500, explain='An error occurred while processing this request. Please contact an administrator.')
             except socket.error as error:
-                self.log.debug('Failed to send error response to "%s". An error occurred: %s', client_address, error)
+                self.log.debug('Failed to send error response to "%s". An error occurred: %s',
+                               self.client_address, error)
         finally:
-            try:
-                self.finish()
-            finally:
-                sys.exc_traceback = None  # Help garbage collection
+            sys.exc_traceback = None  # Help garbage collection
+            self._log_access()  # In case the request's handling got interrupted
 
-    @property
-    def body(self):
-        if self._body is not None:
-            return self._body
+    def expire(self):
+        """Respond with a timeout error as if the client failed to send its next request in time."""
+        self._context = self._body = self._payload = self._handler_name = self._started = None
+        self.options = self.headers = self.command = self.path = None
+        raise socket.timeout()
 
+    def has_buffered_input(self):
+        """Return whether data sent by the client is already waiting to be processed."""
+        try:
+            if self.rfile._rbuf.tell() > 0:
+                return True
+        except AttributeError:
+            pass
+
+        try:
+            return self.request.pending() > 0  # SSL
+        except AttributeError:
+            return False
+
+    def _answer_continue_expectation(self):
         if self._continue_expected:
             self.send_response(100)
             self._continue_expected = False
             self.log.debug('Answered to 100-continue expectation.')
 
+    def _get_content_length(self):
+        if self.headers and self.command != 'HEAD':
+            return int(self.headers.get('Content-Length', 0))
+
+        return 0
+
+    @property
+    def body(self):
+        if self._body is not None:
+            return self._body
+        elif self._payload is not None:
+            raise AssertionError('The payload is already being streamed')
+
+        self._answer_continue_expectation()
+        buffer_size = self.server.content_buffer_size
         if self._context is not None and self._context.has_chunked_payload():
             self.log.debug('Fetching streamed request payload...')
-            self._body = read_chunked_content(self.rfile, CONTENT_BUFFER_SIZE)
+            self._body = read_chunked_content(self.rfile, buffer_size)
             self.log.debug('Completed fetching payload of length %u.', len(self._body))
         else:
-            content_length = 0
-            if self.headers and self.command != 'HEAD':
-                content_length = int(self.headers.get('Content-Length', 0))
-
+            content_length = self._get_content_length()
             if content_length > 0:
                 self.log.debug('Fetching request payload of length %u...', content_length)
-                if content_length > CONTENT_BUFFER_SIZE:
-                    raise RequestEntityTooLarge(
-                        'Content length limit of {0} bytes exceeded'.format(CONTENT_BUFFER_SIZE))
+                if content_length > buffer_size:
+                    raise RequestEntityTooLarge('Content length limit of {0} bytes exceeded'.format(buffer_size))
 
                 self._body = self.rfile.read(content_length)
             else:
                 self.log.debug('Request payload is either empty or it\'s a HEAD request.')
                 self._body = ''
 
-        # TODO: Request streaming (self.body -> <receive-generator> and request.body -> <forward-generator>)
-        # Will allow EL to simultaneously process requests already handled by us while we're still busy handling more!!1
         return self._body
 
+    @property
+    def payload(self):
+        """The request payload as stream. Unlike body, this is not limited by the content buffer size.
+        Returns the body instead if it has already been fetched or if there is no payload at all.
+
+        """
+        if self._body is not None:
+            return self._body
+        elif self._payload is not None:
+            return self._payload
+
+        if self._context is not None and self._context.has_chunked_payload():
+            self.log.debug('Streaming chunked request payload...')
+            self._payload = ChunkedReader(self.rfile)
+        else:
+            content_length = self._get_content_length()
+            if content_length == 0:
+                self._body = ''
+                return self._body
+
+            self.log.debug('Streaming request payload of length %u...', content_length)
+            self._payload = LimitedReader(self.rfile, content_length)
+
+        self._answer_continue_expectation()
+        return self._payload
+
     @property
     def client(self):
         if self._client is not None:
@@ -267,6 +536,7 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
 
         self._client = Client(client_address, client_port)
         self._client.peer_address, self._client.peer_port = self.client_address
+        self._client.index_catalog = self.server.index_catalog
 
         try:
             header_value = self.headers['Authorization']
@@ -309,7 +579,10 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
             try:
                 # We need to fetch the request payload even if it's not necessary to handle
                 # the request as the remaining data will most likely cause misbehaviour
-                if not self._continue_expected:
+                if self._payload is not None:
+                    # But a streamed payload may be of any size, so it's not worth the effort
+                    self.close_connection = True
+                elif not self._continue_expected:
                     # But that's not required if the client did not sent the payload yet (True)
                     _ = self.body
             except Exception as error:  # Fetch the request payload no matter what..
@@ -340,6 +613,7 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
         if self.command != 'HEAD' and code >= 200 and code not in (204, 304):
             self.log.debug('Sending response payload of length %u...', len(content))
             self.wfile.write(content)
+            self._bytes_out += len(content)
 
         if code != 408:  # 408 = Request timeout; This is not triggered by the client, so there is no need to log it
             self.log.info('Refused request "%s %s" issued by "%s" with status %u. Reason: %s (%s).',
@@ -355,10 +629,14 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
                 message = ''
 
         self.wfile.write("%s %d %s\r\n" % (self.protocol_version, code, message))
+        if code >= 200:
+            REQUESTS.inc(self._handler_name or 'none', code)
+            self._status = code
 
     def fetch_request(self):
         # Free some memory as we're not closing the connection and thus the thread is kept alive
-        self._context = self._body = self.options = self.headers = self.command = self.path = None
+        self._context = self._body = self._payload = self._handler_name = self._started = None
+        self.options = self.headers = self.command = self.path = self._status = None
 
         self.raw_requestline = self.rfile.readline()  # Extract the first header line, required by parse_request()
         if not self.raw_requestline:
@@ -366,7 +644,12 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
                            ' likely because the client has closed the connection!)')
             self.close_connection = True
             return
-        elif not self.parse_request():
+
+        self._started = time.time()
+        self._timings = {}
+        self._bytes_out = 0
+        self._transformed = False
+        if not self.parse_request():
             self.log.debug('Invalid request received. Closing connection.')
             return
 
@@ -418,7 +701,16 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
             # TODO: Elasticsearch responds also with YAML if desired by the client (format=yaml)
             self.error_message_format = PRETTY_ERROR_FORMAT
 
-        if not self.client.authenticated and not self.server.auth.authenticate(self.client):
+        self._record_phase('parse', time.time() - self._started)
+        if not self.client.authenticated:
+            with self._measure('authentication'):
+                self.server.auth.authenticate(self.client, populate=False)
+
+            if self.client.authenticated:
+                with self._measure('population'):
+                    self.server.auth.populate(self.client)
+
+        if not self.client.authenticated:
             self.send_error(401, None, 'Authorization Required. Please authenticate yourself to access this realm.',
                             {'WWW-Authenticate': 'Basic realm="Elasticsearch - Protected by ElasticArmor"'})
             return
@@ -436,19 +728,62 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
             self.send_error(400, explain='Unable to process this request. No request handler found.')
             return
 
+        self._handler_name = request.__class__.__name__
         request.options = self.options
         return request
 
+    def _record_phase(self, phase, duration):
+        self._timings[phase] = duration
+        REQUEST_PHASE_SECONDS.observe(duration, phase)
+
+    @contextmanager
+    def _measure(self, phase):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._record_phase(phase, time.time() - started)
+
+    def _log_access(self):
+        """Write the record of the current request to the access log, if not already done."""
+        started, self._started = self._started, None
+        if started is None or self.server.access_log is None:
+            return
+
+        try:
+            bytes_in = len(self._body) if self._body is not None else self._get_content_length()
+        except ValueError:
+            bytes_in = None
+
+        self.server.access_log.write({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(started)) + '.{0:03d}Z'.format(
+                int(started % 1 * 1000)),
+            'client': _to_text(str(self._client)) if self._client is not None else self.client_address[0],
+            'address': self.client_address[0],
+            'method': _to_text(self.command),
+            'path': _to_text(self.path),
+            'handler': self._handler_name,
+            'permissions': sorted(self._client.granted_permissions) if self._handler_name is not None else None,
+            'status': self._status,
+            'bytes_in': bytes_in,
+            'bytes_out': self._bytes_out,
+            'transformed': self._transformed,
+            'durations': dict((phase, round(duration * 1000, 3)) for phase, duration in self._timings.iteritems())
+        })
+
     def handle_one_request(self):
+        self._handle_one_request()
+        self._log_access()
+
+    def _handle_one_request(self):
         request = self.fetch_request()
         if request is None:
             return
 
-        # TODO: Is this really required for *every* request??
-        self.server.auth._apply_system_defaults(self.client)
-
+        self.client.granted_permissions.clear()
         try:
-            response = request.inspect(self.client)
+            with self._measure('inspection'):
+                response = request.inspect(self.client)
         except RequestError as error:
             self.send_error(error.status_code, explain=error.reason)
             return
@@ -463,14 +798,30 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
                 403, explain='An error occurred while checking your authorization. Please contact an administrator.')
             return
 
+        cache_key = self._get_response_cache_key(request) if response is None else None
+        if cache_key is not None:
+            response = self._fetch_cached_response(cache_key)
+
         if response is None:
             self.log.debug('Forwarding request "%s %s" to Elasticsearch...', self.command, self.path)
             request.headers.extend_via_field(self.protocol_version, APP_NAME)
-            response = self.server.elasticsearch.process(request)
+            with self._measure('upstream'):
+                response = self.server.elasticsearch.process(request)
+
             if response is None:
                 self.log.debug('No response received from any of the configured Elasticsearch nodes.')
                 self.send_error(504, explain='No response received from any of the configured Elasticsearch nodes.')
                 return
+            elif self.command not in ('GET', 'HEAD'):
+                indices = request.get_indices()
+                if any(pattern_match(name, CONFIGURATION_INDEX) for name in indices):
+                    self.log.debug('Configuration index may have been altered. Clearing role membership cache...')
+                    self.server.auth.role_backend.clear_cache()
+                if self.server.response_cache is not None and not request.idempotent:
+                    self._invalidate_cached_responses(indices)
+                if self.server.index_catalog is not None and (request.alters_indices or any(
+                        '*' not in name and not self.server.index_catalog.knows(name) for name in indices)):
+                    self.server.index_catalog.request_refresh()
 
             forwarded = True
             # Convert the response's header object so that we can use our own utilities. The original
@@ -490,15 +841,29 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
 
         self._context.response = response  # Now that we got a response, we can update the context
         if not self._context.has_proper_framing():
+            if forwarded:
+                response.close()  # Closes the connection, as the payload is not consumed
+
             self.send_error(502, explain='Bad or malicious message framing detected. Please contact an administrator.')
             return
 
         transformation_reason = request.prepare_transformation(response)
         if transformation_reason:
+            self._transformed = True
             response.status_code = 203
             response.headers['Warning'] = '214 {0} "{1}"'.format(self.server_version, transformation_reason)
 
-        stream = request.transform(response.raw.stream(MAX_CHUNK_SIZE, decode_content=False), MAX_CHUNK_SIZE)
+        if forwarded:
+            stream = iter(ResponseReader(response.raw, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE))
+        else:
+            stream = response.raw.stream(MAX_CHUNK_SIZE, decode_content=False)
+
+        stream = request.transform(stream, MAX_CHUNK_SIZE)
+        if forwarded and cache_key is not None and response.status_code == 200:
+            stream = self._cache_response(cache_key, request, response, stream)
+
+        stream = self._compress_response(response, stream)
+
         data = next(stream, None)
         if data and ('Content-Length' not in response.headers or int(response.headers['Content-Length']) == 0):
             chunked_content = self.request_version >= 'HTTP/1.1'
@@ -512,6 +877,7 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
         else:
             chunked_content = False
 
+        transfer_started = time.time()
         self.send_response(response.status_code, response.reason)
         for name, value in response.headers.items():
             self.send_header(name, value)
@@ -524,25 +890,151 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
 
         self.end_headers()
 
-        if data:
-            self.log.debug('Transferring response payload...')
-
-            try:
-                self.wfile.write(prepare_chunk(data) if chunked_content else data)
-                for data in stream:
-                    self.wfile.write(prepare_chunk(data) if chunked_content else data)
+        try:
+            if data:
+                self.log.debug('Transferring response payload...')
 
-                if chunked_content:
-                    self.wfile.write(close_chunks())
-            finally:
+                # The socket is written to directly, as the unbuffered file object
+                # would split the payload into pieces of 8KiB which are sent one by one
+                sendall = self.connection.sendall
                 try:
-                    stream.close()  # Required to be compliant with PEP 333
-                except AttributeError:
-                    pass
+                    sendall(prepare_chunk(data) if chunked_content else data)
+                    self._bytes_out += len(data)
+                    for data in stream:
+                        sendall(prepare_chunk(data) if chunked_content else data)
+                        self._bytes_out += len(data)
+
+                    if chunked_content:
+                        sendall(close_chunks())
+                finally:
+                    try:
+                        stream.close()  # Required to be compliant with PEP 333
+                    except AttributeError:
+                        pass
+        finally:
+            if forwarded:
+                # Hands the connection back to the pool, or closes it if the payload hasn't been consumed entirely
+                response.close()
+
+            self._record_phase('transfer', time.time() - transfer_started)
 
         action = 'Forwarded response from Elasticsearch' if forwarded else 'Successfully provided response'
         self.log.info('%s for request "%s %s" to client "%s".', action, self.command, self.path, self.client)
 
+    def _get_response_cache_key(self, request):
+        """Return the key to cache the response for the given request with or None if it must not be cached."""
+        if self.server.response_cache is None or request.cache_ttl is None or self.command != 'GET' \
+                or self.client.role_fingerprint is None:
+            return None
+
+        query = tuple((name, tuple(values)) for name, values in request.query.iteritems())
+        return (self.client.role_fingerprint, request.path, query,
+                ', '.join(self.headers.getheaders('Accept-Encoding')))
+
+    def _fetch_cached_response(self, cache_key):
+        """Return the cached response for the given key or None if there is none or the client wants a fresh one.
+        Responds with status code 304 if the client already has the cached response.
+
+        """
+        cache_control = self.headers.getheaders('Cache-Control') + self.headers.getheaders('Pragma')
+        if 'no-cache' in (value.strip().lower() for value in cache_control):
+            return None
+
+        entry = self.server.response_cache.get(cache_key)
+        if entry is None:
+            return None
+
+        status_code, reason, headers, body, etag, stored, _ = entry
+        response = ElasticResponse()
+        if etag in (value.strip() for value in self.headers.getheaders('If-None-Match')):
+            response.status_code, response.reason, response.content = 304, 'Not Modified', ''
+        else:
+            response.status_code, response.reason, response.content = status_code, reason, [body]
+
+        for name, value in headers:
+            if name.lower() != 'content-length':
+                response.headers[name] = value
+
+        if response.status_code != 304:
+            response.headers['Content-Length'] = str(len(body))
+
+        response.headers['ETag'] = etag
+        response.headers['Age'] = str(int(time.time() - stored))
+        self.log.debug('Found cached response for request "%s %s".', self.command, self.path)
+        return response
+
+    def _cache_response(self, cache_key, request, response, stream):
+        """Pass the given response-body stream through and cache the response once its payload has
+        been transferred entirely. Responses larger than a tenth of the cache are not cached.
+
+        """
+        # Taken now, as the headers are altered once the payload is compressed. A generator would do this too late
+        return self._collect_response(cache_key, request, response.status_code, response.reason,
+                                      response.headers.items(), stream)
+
+    def _collect_response(self, cache_key, request, status_code, reason, headers, stream):
+        cache = self.server.response_cache
+        max_size = int(cache.max_size * MAX_CACHED_RESPONSE_SHARE)
+        chunks, size = [], 0
+        for data in stream:
+            if chunks is not None:
+                size += len(data)
+                if size > max_size:
+                    chunks = None
+                else:
+                    chunks.append(data)
+
+            yield data
+
+        if chunks is not None:
+            body = ''.join(chunks)
+            etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+            entry = (status_code, reason, headers, body, etag, time.time(), request.get_indices())
+            cache.set(cache_key, entry, request.cache_ttl,
+                      len(body) + len(request.path) + sum(len(n) + len(v) for n, v in headers))
+
+    def _invalidate_cached_responses(self, indices):
+        """Remove all cached responses which refer to any of the given indices. An empty list refers to all."""
+        def refers_to_indices(entry):
+            cached_indices = entry[-1]
+            return not indices or not cached_indices or any(
+                pattern_match(a, b) or pattern_match(b, a) for a in indices for b in cached_indices)
+
+        self.server.response_cache.purge(refers_to_indices)
+
+    def _compress_response(self, response, stream):
+        """Return the given response-body stream, compressed if the response qualifies for it, and prepare the
+        response's headers accordingly. If the response has no Content-Length, the payload is buffered until
+        it reaches the threshold or has been received entirely.
+
+        """
+        threshold = self.server.compression_threshold
+        if threshold is None or self.command == 'HEAD' or response.status_code in (204, 304) \
+                or response.headers.get('Content-Encoding', 'identity') != 'identity' \
+                or not accepts_content_coding(', '.join(self.headers.getheaders('Accept-Encoding')), 'gzip'):
+            return stream
+        elif 'Content-Length' in response.headers:
+            if int(response.headers['Content-Length']) < threshold:
+                return stream
+
+            del response.headers['Content-Length']
+        else:
+            chunks, size = [], 0
+            for data in stream:
+                chunks.append(data)
+                size += len(data)
+                if size >= threshold:
+                    break
+            else:
+                return iter(chunks)
+
+            stream = itertools.chain(chunks, stream)
+
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = ', '.join(response.headers.getheaders('Vary') + ['Accept-Encoding'])
+
+        return encode_content(stream, 'gzip', self.server.compression_level)
+
     def finish(self):
         # TODO: http://tools.ietf.org/html/rfc7230#section-6.6 (The last three paragraphs)
 
@@ -552,4 +1044,10 @@ class ElasticRequestHandler(LoggingAware, BaseHTTPRequestHandler):
             self.log.error('Failed to gracefully shutdown connection to client "%s". An error occurred: %s',
                            self.client, error)
 
-        self.server.elasticsearch.check_reachability()
+
+def _to_text(value):
+    """Return the given byte string as unicode, replacing invalid UTF-8 sequences. Anything else is returned as is."""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+
+    return value
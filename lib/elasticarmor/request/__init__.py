@@ -1,22 +1,23 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
+import hashlib
 import os
 import re
 import sys
 from functools import update_wrapper
 
-# We need object_pairs_hook, which is only available in the json module since Python 2.7
-if sys.version_info >= (2, 7):
-    import json
+try:
+    # Python 2.7+
     from collections import OrderedDict
-else:
-    import simplejson as json
+except ImportError:
+    # Python 2.6
     from simplejson import OrderedDict
 
-from elasticarmor.util.http import HttpHeaders
+from elasticarmor.util.http import CONTENT_CODINGS, HttpHeaders, decode_content, encode_content
 from elasticarmor.util.mixins import LoggingAware
 
-__all__ = ['RequestError', 'PermissionError', 'Permission', 'Permissions', 'ElasticResponse', 'ElasticRequest']
+__all__ = ['RequestError', 'PermissionError', 'Permission', 'Permissions', 'CachedInspection', 'ElasticResponse',
+           'ElasticRequest']
 
 
 class _RequestRegistry(type):
@@ -24,6 +25,8 @@ class _RequestRegistry(type):
 
     registry = []
     type_map = {}
+    templates = {}
+    router = None
 
     def __new__(mcs, class_name, base_classes, namespace):
         class_obj = super(_RequestRegistry, mcs).__new__(mcs, class_name, base_classes, namespace)
@@ -31,10 +34,12 @@ class _RequestRegistry(type):
             mcs.registry.append(class_obj)
             mcs.type_map[class_obj.__name__] = class_obj
 
+            templates = mcs.templates[class_obj] = {}
             for command, locations in class_obj.locations.items():
                 if not isinstance(locations, list):
                     locations = [locations]
 
+                templates[command] = locations
                 class_obj.locations[command] = [re.compile('^' + location.format(**class_obj.macros) + '/?$')
                                                 for location in locations]
 
@@ -42,9 +47,11 @@ class _RequestRegistry(type):
 
     @classmethod
     def sort(cls):
-        """Sort the handler registry."""
+        """Sort the handler registry and set up the router."""
         cls.registry.sort(key=cls._get_priority, reverse=True)
         cls.type_map.clear()  # Free some memory, the registry is only sorted once
+        cls.router = _RequestRouter(cls.registry, cls.templates)
+        cls.templates.clear()
 
     @classmethod
     def _get_priority(cls, handler):
@@ -70,6 +77,102 @@ class _RequestRegistry(type):
         return handler.priority
 
 
+class _RequestRouter(object):
+    """Finds the request handler responsible for a request by its command and path.
+
+    The locations of all handlers are arranged in a tree of path segments per command. This allows to find
+    all handlers whose locations may match a path in a single pass. Handlers which implement method
+    is_valid on their own cannot be arranged this way and are asked in the order of their priority.
+    """
+
+    def __init__(self, handlers, templates):
+        self._trees = {}
+        self._custom_handlers = []
+        for position, handler in enumerate(handlers):
+            if handler.base_url is not None or handler.is_valid.__func__ is not ElasticRequest.is_valid.__func__:
+                self._custom_handlers.append((position, handler))
+                continue
+
+            for command, locations in templates[handler].iteritems():
+                tree = self._trees.setdefault(command, _RouteNode())
+                for i, (template, regex) in enumerate(zip(locations, handler.locations[command])):
+                    tree.insert(_split_path(template), (position, i, handler, regex), handler.macros)
+
+    def route(self, command, path):
+        """Return the first handler, by priority, whose locations match the given command and path and the
+        match object of its location, or None twice if there is no such handler. The custom handlers with
+        a higher priority are returned as well, as a list which is in the order of their priority.
+
+        """
+        candidates = []
+        tree = self._trees.get(command)
+        if tree is not None:
+            tree.find(_split_path(path), 0, candidates)
+            candidates.sort()
+
+        position, handler, match = sys.maxint, None, None
+        for candidate_position, _, candidate, regex in candidates:
+            match = regex.match(path)
+            if match is not None:
+                position, handler = candidate_position, candidate
+                break
+
+        return [h for p, h in self._custom_handlers if p < position], handler, match
+
+
+class _RouteNode(object):
+    """A node in the tree of path segments of class _RequestRouter."""
+
+    __slots__ = ['literals', 'patterns', 'routes']
+
+    def __init__(self):
+        self.literals = {}
+        self.patterns = OrderedDict()
+        self.routes = []
+
+    def insert(self, segments, route, macros):
+        """Insert the given route at the end of the given segments of a location template."""
+        node = self
+        for segment in segments:
+            if _LITERAL_SEGMENT.match(segment):
+                node = node.literals.setdefault(segment, _RouteNode())
+            else:
+                try:
+                    node = node.patterns[segment][1]
+                except KeyError:
+                    regex = re.compile('^' + segment.format(**macros) + '$')
+                    node = node.patterns.setdefault(segment, (regex, _RouteNode()))[1]
+
+        node.routes.append(route)
+
+    def find(self, segments, depth, routes):
+        """Add all routes whose location template may match the given segments to the given list."""
+        if depth == len(segments):
+            routes.extend(self.routes)
+            return
+
+        segment = segments[depth]
+        node = self.literals.get(segment)
+        if node is not None:
+            node.find(segments, depth + 1, routes)
+
+        for regex, node in self.patterns.itervalues():
+            if regex.match(segment) is not None:
+                node.find(segments, depth + 1, routes)
+
+
+_LITERAL_SEGMENT = re.compile(r'^[^\\.^$*+?()[\]{}|]*$')
+
+
+def _split_path(path):
+    """Split the given path or location template into its segments. A single trailing slash is ignored."""
+    segments = path.split('/')[1:]
+    if segments and not segments[-1]:
+        segments.pop()
+
+    return segments
+
+
 class RequestError(Exception):
     """Raised by instances of ElasticRequest. This is the base
     class for all other request inspection related exceptions."""
@@ -155,6 +258,77 @@ class Permission(object):
 Permissions = Permission
 
 
+class CachedInspection(object):
+    """Decorator for method inspect of class ElasticRequest to cache its outcome.
+
+    The outcome of an inspection is cached per set of roles, command, path, query and payload. It consists of
+    the request's path, query and payload after the inspection or the RequestError which has been raised.
+    Inspections which provide a response on their own are not cached.
+
+        @CachedInspection()
+        @Permission('<permission-name>')
+        def inspect(self, client):
+            pass
+
+    If your handler stores additional results of an inspection in instance attributes, pass their names:
+
+        @CachedInspection('<attribute-name>')
+        def inspect(self, client):
+            pass
+
+    The cache is shared by all handlers and limited by size. Make sure that your inspection does not depend
+    on anything else than what is part of the cache key, such as the client's name or its group memberships.
+    """
+
+    def __init__(self, *attributes):
+        self.attributes = attributes
+
+    def __call__(self, inspector):
+        def cacher(request, client):
+            cache = getattr(request.server, 'inspection_cache', None)
+            if cache is None or client.role_fingerprint is None:
+                return inspector(request, client)
+
+            body = request.body
+            query = tuple((name, tuple(values)) for name, values in request.query.iteritems())
+            cache_key = (client.role_fingerprint, request.command, request.path, query,
+                         hashlib.sha1(body).digest() if body else None)
+            key_size = len(request.path) + sum(len(n) + sum(len(v) for v in values) for n, values in query)
+
+            outcome = cache.get(cache_key)
+            if outcome is None:
+                try:
+                    response = inspector(request, client)
+                except RequestError as error:
+                    cache.set(cache_key, error, size=key_size + len(error.reason))
+                    raise
+
+                if response is None:
+                    updated_body = request.body if request.body is not body else None
+                    outcome = (request.path, [(name, list(values)) for name, values in request.query.iteritems()],
+                               updated_body, dict((name, getattr(request, name)) for name in self.attributes),
+                               frozenset(client.granted_permissions))
+                    cache.set(cache_key, outcome, size=key_size * 2 + len(request.path) + len(updated_body or ''))
+
+                return response
+            elif isinstance(outcome, RequestError):
+                raise outcome
+
+            request.path, query, updated_body, attributes, permissions = outcome
+            client.granted_permissions.update(permissions)
+            request.query.clear()
+            for name, values in query:
+                request.query[name] = list(values)
+
+            if updated_body is not None:
+                request.body = updated_body
+
+            for name, value in attributes.iteritems():
+                setattr(request, name, value)
+
+        return update_wrapper(cacher, inspector)
+
+
 class ElasticResponse(object):
     """Response object which may be provided by instances of ElasticRequest.
 
@@ -253,6 +427,29 @@ class ElasticRequest(LoggingAware, object):
     before = None
     after = None
 
+    # Set this to True if your handler does not need to inspect the request's payload. It's then streamed to
+    # Elasticsearch while being received, instead of being buffered entirely in advance. Note that accessing
+    # the body or json attribute is still possible, but will render this obsolete
+    stream_payload = False
+
+    # Set this to False if your handler does not forward the JSON payload it decoded. The payload's objects are
+    # then decoded into plain dicts, which is a lot faster. Keep the default if the order of keys is important
+    preserve_json_order = True
+
+    # Set this to True if your handler uses a method other than GET or HEAD, but does not alter any data. The request
+    # may then be sent to multiple nodes at once, in case the first one is too slow to respond
+    idempotent = False
+
+    # Set this to True if your handler creates or deletes indices or aliases. The catalog of indices and aliases is
+    # then refreshed once Elasticsearch responded. Indices created implicitly by indexing documents are detected anyway
+    alters_indices = False
+
+    # Set this to the number of seconds the responses of your handler may be cached, if it handles GET requests which do
+    # not alter any data. Responses are cached per set of roles, path and query after the inspection. To prevent that
+    # a particular response is cached, e.g. because it depends on the time it took to process it, set this to None
+    # on the instance in method inspect
+    cache_ttl = None
+
     # The base url a request handler is responsible for. If this is not None, the base
     # implementation of is_valid() checks whether a request's path starts with this url
     base_url = None
@@ -296,11 +493,18 @@ class ElasticRequest(LoggingAware, object):
         for the given request. Returns None if no handler matches.
 
         """
-        for class_obj in _RequestRegistry.registry:
-            handler = class_obj(context, **kwargs)
+        path = kwargs['path'] if 'path' in kwargs else context.request.path
+        custom_handlers, class_obj, match = _RequestRegistry.router.route(context.request.command, path)
+        for custom_handler in custom_handlers:
+            handler = custom_handler(context, **kwargs)
             if handler.is_valid():
                 return handler
 
+        if class_obj is not None:
+            handler = class_obj(context, **kwargs)
+            handler._match = match
+            return handler
+
     @classmethod
     def clear_caches(cls):
         """Clear the cache of all registered request handlers."""
@@ -324,6 +528,14 @@ class ElasticRequest(LoggingAware, object):
         environ['PATH_INFO'] = self.path[len(self.base_url):]
         return environ
 
+    @property
+    def payload(self):
+        """The payload to send to Elasticsearch. That's either the body or a stream of the client's payload."""
+        if self.stream_payload and 'body' not in self.__dict__:
+            return self.context.request.payload
+
+        return self.body
+
     @property
     def json(self):
         if self._json is False:
@@ -340,16 +552,32 @@ class ElasticRequest(LoggingAware, object):
 
         return self._json
 
-    def json_decode(self, data):
-        """Decode the given JSON data and return the result."""
-        return json.loads(data, object_pairs_hook=OrderedDict)
+    def json_decode(self, data, ordered=None):
+        """Decode the given JSON data and return the result. Unless ordered is given,
+        the class attribute preserve_json_order decides whether the order of keys is preserved.
+
+        """
+        return self.server.json_codec.decode(data, self.preserve_json_order if ordered is None else ordered)
 
     def json_encode(self, data, pretty=False):
         """Return the given data encoded to JSON."""
-        if not pretty:
-            return json.dumps(data, separators=(',', ':'))
+        return self.server.json_codec.encode(data, pretty)
 
-        return json.dumps(data, indent=2, separators=(',', ' : '))
+    def get_indices(self):
+        """Return the names or patterns of the indices which are referenced in the request's path.
+        Returns an empty list if all indices are referenced or if the path does not reference any.
+
+        """
+        if self._match is None:
+            return []
+
+        groups = self._match.groupdict()
+        indices = groups.get('indices') or groups.get('index')
+        if not indices:
+            return []
+
+        names = [name.lstrip('+') for name in indices.split(',') if name and not name.startswith('-')]
+        return [] if '_all' in names else names
 
     def get_match(self, name, default=None):
         """Return the given group of the matched location or the default if no such group exists."""
@@ -398,6 +626,25 @@ class ElasticRequest(LoggingAware, object):
         """Apply required transformations on the given response-body stream and return a new iterable."""
         return stream
 
+    def transform_content(self, stream, transformation):
+        """Pass the given response-body stream to the given callable and return the iterable it returns.
+        Compressed payloads are decompressed beforehand and compressed again afterwards, piece by piece.
+        If the payload's content-coding is not supported, the stream is returned untouched instead.
+
+        """
+        response = self.context.response
+        coding = response.headers.get('Content-Encoding', 'identity').strip().lower()
+        if coding != 'identity' and coding not in CONTENT_CODINGS:
+            return stream
+
+        if 'Content-Length' in response.headers:
+            del response.headers['Content-Length']
+
+        if coding == 'identity':
+            return transformation(stream)
+
+        return encode_content(transformation(decode_content(stream, coding)), coding, self.server.compression_level)
+
 
 # Dynamically import all sub-modules to avoid manually adjusting
 # this file every time we'll support an additional request
@@ -13,6 +13,7 @@ class ClusterInfoApiRequest(ElasticRequest):
 
 
 class ClusterHealthApiRequest(ElasticRequest):
+    cache_ttl = 1
     locations = {
         'GET': [
             '/_cluster/health',
@@ -28,6 +29,9 @@ class ClusterHealthApiRequest(ElasticRequest):
         elif index_filter:
             self.path = '/_cluster/health/{0}'.format(index_filter)
 
+        if any(param.startswith('wait_for_') for param in self.query):
+            self.cache_ttl = None  # The response depends on how long it took to reach the desired state
+
 
 class ClusterStateApiRequest(ElasticRequest):
     locations = {
@@ -74,6 +78,7 @@ class ClusterRerouteApiRequest(ElasticRequest):
 
 
 class GetClusterSettingsApiRequest(ElasticRequest):
+    cache_ttl = 5
     locations = {
         'GET': '/_cluster/settings'
     }
@@ -94,6 +99,7 @@ class UpdateClusterSettingsApiRequest(ElasticRequest):
 
 
 class NodesStatsApiRequest(ElasticRequest):
+    cache_ttl = 1
     locations = {
         'GET': [
             '/_nodes/stats',
@@ -110,6 +116,7 @@ class NodesStatsApiRequest(ElasticRequest):
 
 
 class NodesInfoApiRequest(ElasticRequest):
+    cache_ttl = 10
     locations = {
         'GET': [
             '/_nodes',
@@ -3,10 +3,13 @@
 from elasticarmor import APP_NAME
 from elasticarmor.auth import MultipleIncludesError
 from elasticarmor.request import *
-from elasticarmor.util.elastic import SourceFilter, FieldsFilter
+from elasticarmor.util.elastic import ElasticSearchError, SourceFilter, FieldsFilter
+from elasticarmor.util.http import LineReader, StreamedPayload
+from elasticarmor.util.splicer import splice_json_array
 
 
 class IndexApiRequest(ElasticRequest):
+    stream_payload = True
     locations = {
         'POST': [
             '/{index}/{document}',
@@ -87,6 +90,7 @@ class DeleteApiRequest(ElasticRequest):
 
 
 class UpdateApiRequest(ElasticRequest):
+    preserve_json_order = False
     locations = {
         'POST': '/{index}/{document}/{identifier}/_update'
     }
@@ -98,9 +102,9 @@ class UpdateApiRequest(ElasticRequest):
         elif 'script' in self.json and not client.can('api/feature/script', self.index, self.document):
             raise PermissionError('You are not permitted to perform scripted updates of this document.')
         elif self.json.get('doc'):
-            self._inspect_document(client, self.index, self.document, self.json['doc'])
+            _inspect_document(client, self.index, self.document, self.json['doc'])
             if self.json.get('upsert'):
-                self._inspect_document(client, self.index, self.document, self.json['upsert'])
+                _inspect_document(client, self.index, self.document, self.json['upsert'])
 
         fields_filter = client.create_fields_filter('api/documents/get', self.index, self.document,
                                                     FieldsFilter.from_query(self.query))
@@ -112,36 +116,11 @@ class UpdateApiRequest(ElasticRequest):
 
             self.query.update(fields_filter.as_query())
 
-    def _inspect_document(self, client, index, document_type, document):
-        forbidden = []
-        for key, value in document.iteritems():
-            if isinstance(value, dict):
-                fields = self._aggregate_fields(value, key)
-            else:
-                fields = [key]
-
-            for field in fields:
-                if not client.can('api/documents/update', index, document_type, field):
-                    forbidden.append(field)
-
-        if forbidden:
-            raise PermissionError('You are not permitted to update the following fields: {0}'
-                                  ''.format(', '.join(forbidden)))
-
-    def _aggregate_fields(self, obj, path):
-        for key, value in obj.iteritems():
-            key_path = '.'.join((path, key))
-
-            try:
-                for key_path_extension in self._aggregate_fields(value, key_path):
-                    yield key_path_extension
-            except AttributeError:
-                yield key_path
-
 
 class MultiGetApiRequest(ElasticRequest):
     _errors = None
 
+    idempotent = True
     before = [
         'GetIndexApiRequest',
         'IndexApiRequest',
@@ -255,31 +234,23 @@ class MultiGetApiRequest(ElasticRequest):
         self.query.discard('_source', '_source_include', '_source_exclude')
 
     def transform(self, stream, chunk_size):
-        if not self._errors:
-            for chunk in stream:
-                yield chunk
-            return
+        if not self._errors or self.context.response.status_code != 200:
+            return stream
 
-        payload = ''.join(stream)
-
-        try:
-            data = self.json_decode(payload)
-        except ValueError:
-            pass
-        else:
-            for position, document in self._errors:
-                data['docs'].insert(position, document)
-
-            payload = self.json_encode(data, not self.query.is_false('pretty'))
-            if 'Content-Length' in self.context.response.headers:
-                self.context.response.headers['Content-Length'] = str(len(payload))
-
-        while payload:
-            yield payload[:chunk_size]
-            payload = payload[chunk_size:]
+        return self.transform_content(stream, lambda content: splice_json_array(
+            content, 'docs', ((p, self.json_encode(d)) for p, d in self._errors)))
 
 
 class BulkApiRequest(ElasticRequest):
+    _errors = None
+    _indices = None
+    _source = None
+    _reader = None
+    _actions = None
+    _next_action = None
+
+    stream_payload = True
+    preserve_json_order = False
     before = 'IndexApiRequest'
     locations = {
         'POST': [
@@ -289,10 +260,199 @@ class BulkApiRequest(ElasticRequest):
         ]
     }
 
-    @Permission('api/feature/notImplemented')
+    @property
+    def payload(self):
+        return StreamedPayload(self._iter_payload(), self._source)
+
     @Permission('api/bulk', scope='cluster')
     def inspect(self, client):
-        pass
+        self._source = self.context.request.payload
+        self._reader = LineReader([self._source] if isinstance(self._source, basestring) else self._source)
+
+        # Actions are inspected while the payload is being forwarded. Only those which are
+        # denied before the first permitted one is found are known when responding early
+        self._errors = []
+        self._indices = set()
+        self._actions = self._inspect_actions(client)
+        self._next_action = next(self._actions, None)
+        if self._next_action is None and self._errors:
+            response = ElasticResponse()
+            response.content = self.json_encode({'took': 0, 'errors': True, 'items': [e for p, e in self._errors]},
+                                                not self.query.is_false('pretty'))
+            response.headers['Content-Length'] = str(len(response.content))
+            response.headers['Content-Type'] = 'application/json'
+            response.status_code = 200
+            del self._errors
+            return response
+
+        if 'Content-Length' in self.headers:
+            del self.headers['Content-Length']  # The payload's length is not known in advance anymore
+
+    def get_indices(self):
+        """Return the names of the indices referenced by the actions which have been forwarded so far."""
+        if self._indices is None:
+            return ElasticRequest.get_indices(self)
+
+        return sorted(self._indices)
+
+    def transform(self, stream, chunk_size):
+        if not self._errors or self.context.response.status_code != 200:
+            return stream
+
+        return self.transform_content(stream, lambda content: splice_json_array(
+            content, 'items', ((p, self.json_encode(e)) for p, e in self._errors), {'errors': 'true'}))
+
+    def _iter_payload(self):
+        while self._next_action is not None:
+            lines, has_source = self._next_action
+            for line in lines:
+                yield line
+
+            if has_source:
+                for piece in self._reader.iter_line():
+                    yield piece
+
+            self._next_action = next(self._actions, None)
+
+    def _inspect_actions(self, client):
+        """Read and inspect the actions of the payload one by one and yield those which are permitted. Each action
+        is a tuple of the lines to forward and whether the action's source follows. Denied actions are recorded
+        as errors, including their position, and their source is skipped.
+
+        """
+        default_index = self.get_match('index')
+        default_document_type = self.get_match('document')
+        default_fields_filter = FieldsFilter.from_query(self.query)
+        line_limit = self.server.content_buffer_size
+
+        decisions, position = {}, 0
+        line = self._reader.readline(line_limit)
+        while line:
+            if not line.strip():
+                line = self._reader.readline(line_limit)
+                continue
+
+            line_no = self._reader.line_no
+            try:
+                action = self.json_decode(line)
+            except ValueError as error:
+                raise RequestError(400, 'Failed to decode JSON action at line #{0}: {1}'.format(line_no, error))
+
+            if not isinstance(action, dict) or len(action) != 1:
+                raise RequestError(400, 'Failed to parse action at line #{0}. Exactly one action expected.'
+                                        ''.format(line_no))
+
+            operation, metadata = next(action.iteritems())
+            if operation not in ('index', 'create', 'update', 'delete'):
+                raise RequestError(400, 'Failed to parse action at line #{0}. Unknown action "{1}".'
+                                        ''.format(line_no, operation))
+            elif not isinstance(metadata, dict):
+                raise RequestError(400, 'Failed to parse action at line #{0}. Invalid JSON object.'.format(line_no))
+
+            index = metadata.get('_index', default_index)
+            if not index:
+                raise RequestError(400, 'Action at line #{0} is missing an index.'.format(line_no))
+            elif not isinstance(index, basestring):
+                raise RequestError(400, 'Failed to parse action at line #{0}. Invalid index.'.format(line_no))
+
+            document_type = metadata.get('_type', default_document_type)
+            lines = [line]
+            if operation == 'update':
+                body = self._reader.readline(line_limit)
+                if not body.strip():
+                    raise RequestError(400, 'Expected body at line #{0}. Got an empty line instead.'
+                                            ''.format(self._reader.line_no))
+
+                try:
+                    document = self.json_decode(body)
+                except ValueError as error:
+                    raise RequestError(400, 'Failed to decode JSON body at line #{0}: {1}'
+                                            ''.format(self._reader.line_no, error))
+
+                lines.append(body)
+                error = self._inspect_update(client, index, document_type, metadata, document, default_fields_filter)
+                if error is None and 'fields' in metadata:
+                    lines[0] = self.json_encode(action) + '\n'  # The stored fields may have been restricted
+            else:
+                # Identical actions are quite common, so their decision is remembered for the rest of the request
+                decision_key = (operation, index, document_type, bool(metadata.get('_id')))
+                try:
+                    error = decisions[decision_key]
+                except KeyError:
+                    error = decisions[decision_key] = self._inspect_action(client, operation, index,
+                                                                           document_type, metadata)
+
+            if error is None:
+                self._indices.add(index)
+                yield lines, operation in ('index', 'create')
+            else:
+                if operation in ('index', 'create'):
+                    for _ in self._reader.iter_line():
+                        pass
+
+                self._errors.append((position, {operation: {
+                    '_index': index,
+                    '_type': document_type,
+                    '_id': metadata.get('_id'),
+                    'status': error.status_code,
+                    'error': '[{0}] {1}'.format(APP_NAME, error.reason)
+                }}))
+
+            position += 1
+            line = self._reader.readline(line_limit)
+
+    def _inspect_action(self, client, operation, index, document_type, metadata):
+        """Inspect the given index, create or delete action and return a PermissionError if it's not permitted."""
+        if operation == 'delete':
+            if not client.can('api/documents/delete', index, document_type):
+                return PermissionError('You are not permitted to delete documents of this type.')
+            elif client.has_restriction(index, document_type):
+                return PermissionError('You are restricted to specific fields of the given type.')
+        elif not client.can('api/documents/index', index, document_type):
+            return PermissionError('You are not permitted to index documents of this type.')
+        elif not metadata.get('_id') and operation != 'create' and client.has_restriction(index, document_type):
+            return PermissionError('You are restricted to specific fields of the given type. Please use'
+                                   ' either the update action instead or the "create" action.')
+
+        if not self.query.is_false('refresh') and not client.can('api/indices/refresh', index):
+            return PermissionError('You are not permitted to refresh this index.')
+
+    def _inspect_update(self, client, index, document_type, metadata, document, default_fields_filter):
+        """Inspect the given update action and return a RequestError if it's not permitted. The stored fields to
+        return are restricted to the ones the client is permitted to access by adjusting the action's metadata.
+
+        """
+        if not client.can('api/documents/update', index, document_type):
+            return PermissionError('You are not permitted to update documents of this type.')
+        elif not self.query.is_false('refresh') and not client.can('api/indices/refresh', index):
+            return PermissionError('You are not permitted to refresh this index.')
+        elif not isinstance(document, dict):
+            return RequestError(400, 'Invalid JSON object.')
+        elif 'script' in document and not client.can('api/feature/script', index, document_type):
+            return PermissionError('You are not permitted to perform scripted updates of this document.')
+
+        try:
+            if isinstance(document.get('doc'), dict):
+                _inspect_document(client, index, document_type, document['doc'])
+                if isinstance(document.get('upsert'), dict):
+                    _inspect_document(client, index, document_type, document['upsert'])
+        except PermissionError as error:
+            return error
+
+        try:
+            requested_fields = FieldsFilter.from_json(metadata['fields']) if 'fields' in metadata \
+                else default_fields_filter
+        except ElasticSearchError as error:
+            return RequestError(400, str(error))
+
+        fields_filter = client.create_fields_filter('api/documents/get', index, document_type, requested_fields)
+        if fields_filter is None:
+            return PermissionError('You are not permitted to access any of the requested stored fields.')
+        elif fields_filter:
+            if fields_filter.requires_source and client.has_restriction(index, document_type):
+                return PermissionError('"_source" is not available. You are restricted to specific fields.')
+
+            metadata['fields'] = fields_filter.as_json()
 
 
 class DeleteByQueryApiRequest(ElasticRequest):
@@ -342,3 +502,33 @@ class MultiTermVectorApiRequest(ElasticRequest):
     @Permission('api/documents/termVector')
     def inspect(self, client):
         pass
+
+
+def _inspect_document(client, index, document_type, document):
+    """Raise PermissionError if the given client is not permitted to update all fields of the given document."""
+    forbidden = []
+    for key, value in document.iteritems():
+        if isinstance(value, dict):
+            fields = _aggregate_fields(value, key)
+        else:
+            fields = [key]
+
+        for field in fields:
+            if not client.can('api/documents/update', index, document_type, field):
+                forbidden.append(field)
+
+    if forbidden:
+        raise PermissionError('You are not permitted to update the following fields: {0}'
+                              ''.format(', '.join(forbidden)))
+
+
+def _aggregate_fields(obj, path):
+    """Yield the dotted path of each leaf of the given object, prefixed with the given path."""
+    for key, value in obj.iteritems():
+        key_path = '.'.join((path, key))
+
+        try:
+            for key_path_extension in _aggregate_fields(value, key_path):
+                yield key_path_extension
+        except AttributeError:
+            yield key_path
@@ -6,6 +6,8 @@ from elasticarmor.util.elastic import FilterString
 
 
 class CreateIndexApiRequest(ElasticRequest):
+    alters_indices = True
+    preserve_json_order = False
     locations = {
         'PUT': '/{index}',
         'POST': '/{index}'
@@ -39,6 +41,7 @@ class CreateIndexApiRequest(ElasticRequest):
 
 
 class DeleteIndexApiRequest(ElasticRequest):
+    alters_indices = True
     locations = {
         'DELETE': '/{indices}'
     }
@@ -49,6 +52,7 @@ class DeleteIndexApiRequest(ElasticRequest):
 
 
 class GetIndexApiRequest(ElasticRequest):
+    cache_ttl = 5
     locations = {
         'HEAD': '/{indices}',
         'GET': [
@@ -115,6 +119,7 @@ class CloseIndexApiRequest(ElasticRequest):
 
 
 class CreateMappingApiRequest(ElasticRequest):
+    stream_payload = True
     locations = {
         'PUT': [
             '/_mapping{s}/{document}',
@@ -149,6 +154,7 @@ class CreateMappingApiRequest(ElasticRequest):
 class GetMappingApiRequest(ElasticRequest):
     before = 'GetIndexApiRequest'
 
+    cache_ttl = 5
     locations = {
         'GET': [
             '/_mapping{s}',
@@ -193,6 +199,7 @@ class GetMappingApiRequest(ElasticRequest):
 
 
 class GetFieldMappingApiRequest(ElasticRequest):
+    cache_ttl = 5
     locations = {
         'GET': [
             '/{indices}/_mapping/field/{fields}',
@@ -246,6 +253,7 @@ class DeleteMappingApiRequest(ElasticRequest):
 
 
 class CreateAliasApiRequest(ElasticRequest):
+    alters_indices = True
     locations = {
         'POST': '/_aliases',
         'PUT': '/{indices}/_alias{es}/{name}'
@@ -257,6 +265,7 @@ class CreateAliasApiRequest(ElasticRequest):
 
 
 class DeleteAliasApiRequest(ElasticRequest):
+    alters_indices = True
     locations = {
         'DELETE': '/{indices}/_alias{es}/{names}'
     }
@@ -268,6 +277,7 @@ class DeleteAliasApiRequest(ElasticRequest):
 
 class GetAliasApiRequest(ElasticRequest):
     before = 'GetIndexApiRequest'
+    cache_ttl = 5
     locations = {
         'GET': [
             '/_alias',
@@ -291,6 +301,7 @@ class GetAliasApiRequest(ElasticRequest):
 
 
 class UpdateIndexSettingsApiRequest(ElasticRequest):
+    stream_payload = True
     locations = {
         'PUT': [
             '/_settings',
@@ -305,6 +316,7 @@ class UpdateIndexSettingsApiRequest(ElasticRequest):
 
 class GetIndexSettingsApiRequest(ElasticRequest):
     before = 'GetIndexApiRequest'
+    cache_ttl = 5
     locations = {
         'GET': [
             '/_settings',
@@ -341,6 +353,7 @@ class AnalyzeApiRequest(ElasticRequest):
 
 
 class CreateIndexTemplateApiRequest(ElasticRequest):
+    stream_payload = True
     locations = {
         'PUT': '/_template/{name}'
     }
@@ -361,6 +374,7 @@ class DeleteIndexTemplateApiRequest(ElasticRequest):
 
 
 class GetIndexTemplateApiRequest(ElasticRequest):
+    cache_ttl = 5
     locations = {
         'GET': [
             '/_template',
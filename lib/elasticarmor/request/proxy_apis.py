@@ -0,0 +1,19 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+from elasticarmor.request import *
+
+
+class ProxyStatusApiRequest(ElasticRequest):
+    locations = {
+        'GET': '/_elasticarmor/status'
+    }
+
+    @Permission('api/proxy/status')
+    def inspect(self, client):
+        response = ElasticResponse()
+        response.content = self.json_encode({'nodes': self.server.elasticsearch.status()},
+                                            not self.query.is_false('pretty'))
+        response.headers['Content-Length'] = str(len(response.content))
+        response.headers['Content-Type'] = 'application/json'
+        response.status_code = 200
+        return response
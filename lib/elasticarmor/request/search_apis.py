@@ -8,9 +8,11 @@ from elasticarmor.auth import MultipleIncludesError
 from elasticarmor.request import *
 from elasticarmor.util.elastic import (SourceFilter, FilterString, QueryDslParser, AggregationParser,
                                        HighlightParser, FieldsFilter)
+from elasticarmor.util.splicer import splice_json_array
 
 
 class SearchApiRequest(ElasticRequest):
+    idempotent = True
     before = [
         'GetIndexApiRequest',
         'IndexApiRequest',
@@ -79,11 +81,36 @@ class SearchApiRequest(ElasticRequest):
         }
     }
 
+    # Strings which indicate that a payload may require the respective permission. Payloads are searched for
+    # them in lower case and without underscores, as Elasticsearch accepts names in camel case and prefixes
+    # are matched, to include aliases such as more_like_this_field or fuzzy_like_this_field
+    _permission_markers = {
+        'api/indices/stats': ['"stats'],
+        'api/feature/facets': ['"facets'],
+        'api/feature/script': ['"script'],
+        'api/feature/innerHits': ['"innerhits'],
+        'api/feature/moreLikeThis': ['"morelikethis', '"mlt'],
+        'api/feature/fuzzyLikeThis': ['"fuzzylikethis', '"flt'],
+        'api/search/explain': ['"explain'],
+        'api/search/suggest': ['"suggest'],
+        'api/search/template': ['"template']
+    }
+
+    # Strings which indicate that a payload refers to specific indices or document types
+    _scope_markers = ['"index', '"type', '"parenttype', '"childtype']
+
+    # Strings which indicate that a payload conceals some of its content, e.g. by escaping or encoding it
+    _opaque_markers = ['\\', '"wrapper']
+
+    # Strings which indicate that a payload utilizes the query string search
+    _query_string_markers = ['"querystring', '"simplequerystring']
+
+    @CachedInspection()
     def inspect(self, client):
         index_filter, type_filter, source_filter, json = self.inspect_request(
             client, FilterString.from_string(self.get_match('indices', '')),
             FilterString.from_string(self.get_match('documents', '')),
-            SourceFilter.from_query(self.query), self.json)
+            SourceFilter.from_query(self.query), self.body or self.query.last('source'))
 
         if self.query.last('q', '').strip() and self.query.last('q').strip() != '*':
             if client.has_restriction(index_filter, type_filter):
@@ -115,6 +142,11 @@ class SearchApiRequest(ElasticRequest):
             self.body = self.json_encode(json)
 
     def inspect_request(self, client, requested_indices, requested_types, requested_source=None, json=None):
+        """Inspect the given request details and return the index, type and source filter to apply. The
+        fourth item is the given payload, if it got updated. The payload may be passed in its raw form.
+        It's then only decoded if it may affect whether the client is permitted to perform the request.
+
+        """
         # TODO: Error handling for unexpected types
         try:
             index_filter = client.create_filter_string('api/search/documents', requested_indices,
@@ -140,16 +172,25 @@ class SearchApiRequest(ElasticRequest):
                 raise PermissionError('You are not permitted to search for documents using'
                                       ' the type filter "{0}".'.format(requested_types))
 
+        if isinstance(json, basestring):
+            if not json or not self._requires_inspection(client, json, index_filter, type_filter):
+                json = None
+            else:
+                try:
+                    json = self.json_decode(json)
+                except ValueError as error:
+                    raise RequestError(400, 'Failed to parse payload. An error occurred: {0}'.format(error))
+
         if json is not None:
             if json.get('stats'):
                 self._check_permission('api/indices/stats', client, index_filter)
             if json.get('facets'):
                 self._check_permission('api/feature/facets', client, index_filter, type_filter)
-            if json.get('script_fields'):
+            if json.get('script_fields') or json.get('scriptFields'):
                 self._check_permission('api/feature/script', client, index_filter, type_filter)
             if json.get('explain', False):
                 self._check_permission('api/search/explain', client, index_filter, type_filter)
-            if json.get('inner_hits'):
+            if json.get('inner_hits') or json.get('innerHits'):
                 self._check_permission('api/feature/innerHits', client, index_filter, type_filter)
             if json.get('suggest'):
                 self._check_permission('api/search/suggest', client, index_filter, type_filter)
@@ -252,6 +293,40 @@ class SearchApiRequest(ElasticRequest):
 
         return index_filter, type_filter, source_filter, json if json_updated else None
 
+    def _requires_inspection(self, client, payload, index_filter, type_filter):
+        """Return whether the given raw payload needs to be decoded and inspected. That's not the case if it
+        contains nothing which may affect whether the client is permitted to perform the request. Clients
+        restricted to specific fields are not considered, as their payload usually needs to be rewritten.
+
+        """
+        if client.is_restricted('fields'):
+            return True
+
+        payload = payload.lower().replace('_', '')
+        if any(marker in payload for marker in self._opaque_markers):
+            return True
+        elif client.is_restricted('indices') and any(marker in payload for marker in self._scope_markers):
+            return True
+        elif any(marker in payload for marker in self._query_string_markers) \
+                and client.has_restriction(index_filter, type_filter):
+            return True
+
+        for permission, markers in self._permission_markers.iteritems():
+            if any(marker in payload for marker in markers) \
+                    and not self._is_permitted(permission, client, index_filter, type_filter):
+                return True
+
+        return False
+
+    def _is_permitted(self, permission, client, index_filter, type_filter=None):
+        """Return whether _check_permission() would succeed for the given permission."""
+        if index_filter:
+            return all(client.can(permission, index, document_type)
+                       for index in index_filter.iter_patterns()
+                       for document_type in (type_filter.iter_patterns() if type_filter else [None]))
+
+        return client.can(permission)
+
     def _check_permission(self, permission, client, index_filter, type_filter=None, fields=None):
         if index_filter:
             forbidden = []
@@ -428,6 +503,7 @@ class MultiSearchApiRequest(SearchApiRequest):
         ]
     }
 
+    @CachedInspection('_errors')
     @Permission('api/bulk', scope='cluster')
     def inspect(self, client):
         lines, self._errors = [], []
@@ -445,7 +521,7 @@ class MultiSearchApiRequest(SearchApiRequest):
                 header['index'] = [str(part) for part in index_filter]
                 header['type'] = [str(part) for part in type_filter]
                 lines.append(self.json_encode(header))
-                lines.append(self.json_encode(json or body))
+                lines.append(self.json_encode(json) if json is not None else body)
 
         if not lines:
             response = ElasticResponse()
@@ -461,10 +537,11 @@ class MultiSearchApiRequest(SearchApiRequest):
         self.body = '\n'.join(lines) + '\n'
 
     def transform(self, stream, chunk_size):
-        if not self._errors:
+        if not self._errors or self.context.response.status_code != 200:
             return stream
 
-        return self._transform_payload(''.join(stream), chunk_size)
+        return self.transform_content(stream, lambda content: splice_json_array(
+            content, 'responses', ((p, self.json_encode(e)) for p, e in self._errors)))
 
     def _parse_payload(self):
         default_indices = self.get_match('indices', '').split(',')
@@ -482,7 +559,7 @@ class MultiSearchApiRequest(SearchApiRequest):
                             400, 'Expected body at line #{0}. Got an empty line instead.'.format(line_no))
 
                     try:
-                        header = self.json_decode(header) if header else {}
+                        header = self.json_decode(header, ordered=False) if header else {}
                         if not header.get('index'):
                             header['index'] = default_indices
                         elif isinstance(header['index'], basestring):
@@ -507,33 +584,12 @@ class MultiSearchApiRequest(SearchApiRequest):
                         raise RequestError(
                             400, 'Failed to parse header at line #{0}. Invalid JSON object.'.format(line_no - 1))
 
-                    try:
-                        yield header, self.json_decode(body)
-                    except ValueError as error:
-                        raise RequestError(400, 'Failed to decode JSON body at line #{0}: {1}'.format(line_no, error))
-                    else:
-                        header = None
+                    yield header, body
+                    header = None
 
                 line_no += 1
                 line = feed.readline()
 
-    def _transform_payload(self, payload, chunk_size):
-        try:
-            data = self.json_decode(payload)
-        except ValueError:
-            pass
-        else:
-            for position, error in self._errors:
-                data['responses'].insert(position, error)
-
-            payload = self.json_encode(data, not self.query.is_false('pretty'))
-            if 'Content-Length' in self.context.response.headers:
-                self.context.response.headers['Content-Length'] = str(len(payload))
-
-        while payload:
-            yield payload[:chunk_size]
-            payload = payload[chunk_size:]
-
 
 class CountApiRequest(SearchApiRequest):
     before = [
@@ -555,10 +611,11 @@ class CountApiRequest(SearchApiRequest):
         ]
     }
 
+    @CachedInspection()
     def inspect(self, client):
         index_filter, type_filter, _, json = self.inspect_request(
             client, FilterString.from_string(self.get_match('indices', '')),
-            FilterString.from_string(self.get_match('documents', '')), json=self.json)
+            FilterString.from_string(self.get_match('documents', '')), json=self.body or self.query.last('source'))
 
         if self.query.last('q', '').strip() and self.query.last('q').strip() != '*':
             if client.has_restriction(index_filter, type_filter):
@@ -577,6 +634,7 @@ class CountApiRequest(SearchApiRequest):
 
 
 class SearchExistsApiRequest(ElasticRequest):
+    idempotent = True
     locations = {
         'GET': [
             '/_search/exists',
@@ -622,7 +680,7 @@ class ValidateApiRequest(SearchApiRequest):
 
         index_filter, type_filter, _, json = self.inspect_request(
             client, FilterString.from_string(self.get_match('indices', '')),
-            FilterString.from_string(self.get_match('documents', '')), json=self.json)
+            FilterString.from_string(self.get_match('documents', '')), json=self.body or self.query.last('source'))
 
         if self.query.last('q', '').strip() and self.query.last('q').strip() != '*':
             if client.has_restriction(index_filter, type_filter):
@@ -14,9 +14,12 @@ from elasticarmor import *
 from elasticarmor.auth.elasticsearch_backend import ElasticsearchRoleBackend, ElasticsearchUserBackend
 from elasticarmor.auth.ldap_backend import LdapUserBackend, LdapUsergroupBackend
 from elasticarmor.util import format_elasticsearch_error, compare_major_and_minor_version, cachedproperty
+from elasticarmor.util.balancer import BALANCING_STRATEGIES
+from elasticarmor.util.codec import JSON_LIBRARIES, JsonCodec
 from elasticarmor.util.config import Parser
 from elasticarmor.util.daemon import Settings
 from elasticarmor.util.elastic import ElasticConnection
+from elasticarmor.util.health import RetryBudget
 from elasticarmor.util.mixins import LoggingAware
 
 __all__ = ['ElasticSettings']
@@ -29,15 +32,46 @@ class ElasticSettings(LoggingAware, Settings):
         'facility': 'authpriv',
         'application': APP_NAME.lower(),
         'level': 'error',
+        'access_log': '',
+        'queue_size': DEFAULT_LOG_QUEUE_SIZE,
         'elasticsearch': DEFAULT_NODE,
         'address': DEFAULT_ADDRESS,
         'port': DEFAULT_PORT,
-        'secured': 'false'
+        'secured': 'false',
+        'content_buffer_size': DEFAULT_CONTENT_BUFFER_SIZE,
+        'json_library': 'auto',
+        'compression_threshold': 0,
+        'compression_level': DEFAULT_COMPRESSION_LEVEL,
+        'node_selection': 'priority',
+        'upstream_pool_size': DEFAULT_UPSTREAM_POOL_SIZE,
+        'upstream_idle_timeout': DEFAULT_UPSTREAM_IDLE_TIMEOUT,
+        'upstream_request_limit': DEFAULT_UPSTREAM_REQUEST_LIMIT,
+        'upstream_hedging': 'false',
+        'upstream_retry_ratio': DEFAULT_RETRY_RATIO,
+        'upstream_retry_minimum': DEFAULT_RETRY_MINIMUM,
+        'upstream_max_timeout_extension': DEFAULT_MAX_TIMEOUT_EXTENSION,
+        'health_check_interval': DEFAULT_HEALTH_CHECK_INTERVAL,
+        'health_check_timeout': DEFAULT_HEALTH_CHECK_TIMEOUT,
+        'index_catalog_interval': DEFAULT_INDEX_CATALOG_INTERVAL,
+        'metrics_address': DEFAULT_ADDRESS,
+        'metrics_port': DEFAULT_METRICS_PORT,
+        'engine': 'threaded',
+        'worker_threads': DEFAULT_WORKER_THREADS,
+        'worker_queue_size': DEFAULT_WORKER_QUEUE_SIZE,
+        'authentication_cache_size': DEFAULT_AUTHENTICATION_CACHE_SIZE,
+        'negative_authentication_ttl': 0,
+        'role_cache_size': DEFAULT_ROLE_CACHE_SIZE,
+        'role_cache_ttl': DEFAULT_ROLE_CACHE_TTL,
+        'permission_cache_size': DEFAULT_PERMISSION_CACHE_SIZE,
+        'inspection_cache_size': DEFAULT_INSPECTION_CACHE_SIZE,
+        'inspection_cache_ttl': DEFAULT_INSPECTION_CACHE_TTL,
+        'response_cache_size': 0
     }
 
     default_authentication_config = {
         'global': {
-            'default_role': None
+            'default_role': None,
+            'cache_ttl': DEFAULT_AUTHENTICATION_CACHE_TTL
         },
         'msldap': {
             'user_object_class': 'user',
@@ -115,6 +149,23 @@ class ElasticSettings(LoggingAware, Settings):
         self._check_file_permissions(file_path, 'a')
         return file_path
 
+    @property
+    def log_queue_size(self):
+        queue_size = self.config.getint('logging', 'queue_size')
+        if queue_size < 0:
+            self._exit('Invalid log queue size "%s" set. It must not be negative.', queue_size)
+
+        return queue_size
+
+    @property
+    def access_log(self):
+        file_path = self.config.get('logging', 'access_log')
+        if not file_path:
+            return None
+
+        self._check_file_permissions(file_path, 'a')
+        return file_path
+
     @property
     def log_application(self):
         return self.config.get('logging', 'application')
@@ -173,6 +224,44 @@ class ElasticSettings(LoggingAware, Settings):
     def secure_connection(self):
         return self.config.getboolean('proxy', 'secured')
 
+    @property
+    def content_buffer_size(self):
+        buffer_size = self.config.getint('proxy', 'content_buffer_size')
+        if buffer_size < 1:
+            self._exit('Invalid content buffer size "%s" set. It must be greater than zero.', buffer_size)
+
+        return buffer_size
+
+    @property
+    def json_codec(self):
+        library = self.config.get('proxy', 'json_library').lower()
+        if library == 'auto':
+            return JsonCodec()
+        elif library not in JSON_LIBRARIES:
+            self._exit('Invalid JSON library "%s" set. Valid libraries are: auto, %s',
+                       library, ', '.join(JSON_LIBRARIES))
+
+        try:
+            return JsonCodec(library)
+        except ImportError:
+            self._exit('JSON library "%s" is not installed.', library)
+
+    @property
+    def compression_threshold(self):
+        threshold = self.config.getint('proxy', 'compression_threshold')
+        if threshold < 0:
+            self._exit('Invalid compression threshold "%s" set. It must not be negative.', threshold)
+
+        return threshold or None
+
+    @property
+    def compression_level(self):
+        level = self.config.getint('proxy', 'compression_level')
+        if not 1 <= level <= 9:
+            self._exit('Invalid compression level "%s" set. It must be between 1 and 9.', level)
+
+        return level
+
     @property
     def private_key(self):
         try:
@@ -268,7 +357,10 @@ class ElasticSettings(LoggingAware, Settings):
                                      ' by sending us the results of a test ran against this particular node.',
                                      node, node_version)"""
 
-        return ElasticConnection(nodes)
+        return ElasticConnection(nodes, self.upstream_pool_size, self.upstream_idle_timeout,
+                                 self.upstream_request_limit, self.node_selection(nodes), self.upstream_hedging,
+                                 RetryBudget(self.upstream_retry_ratio, self.upstream_retry_minimum),
+                                 self.upstream_max_timeout_extension)
 
     @property
     def elasticsearch_nodes(self):
@@ -287,6 +379,172 @@ class ElasticSettings(LoggingAware, Settings):
 
         return nodes
 
+    @property
+    def node_selection(self):
+        strategy = self.config.get('proxy', 'node_selection').lower()
+        if strategy not in BALANCING_STRATEGIES:
+            self._exit('Invalid node selection "%s" set. Valid strategies are: %s',
+                       strategy, ', '.join(sorted(BALANCING_STRATEGIES)))
+
+        return BALANCING_STRATEGIES[strategy]
+
+    @property
+    def upstream_pool_size(self):
+        pool_size = self.config.getint('proxy', 'upstream_pool_size')
+        if pool_size < 1:
+            self._exit('Invalid upstream pool size "%s" set. It must be greater than zero.', pool_size)
+
+        return pool_size
+
+    @property
+    def upstream_idle_timeout(self):
+        return self.config.getint('proxy', 'upstream_idle_timeout') or None
+
+    @property
+    def upstream_request_limit(self):
+        return self.config.getint('proxy', 'upstream_request_limit') or None
+
+    @property
+    def upstream_hedging(self):
+        return self.config.getboolean('proxy', 'upstream_hedging')
+
+    @property
+    def upstream_retry_ratio(self):
+        ratio = self.config.getfloat('proxy', 'upstream_retry_ratio')
+        if ratio < 0:
+            self._exit('Invalid upstream retry ratio "%s" set. It must not be negative.', ratio)
+
+        return ratio
+
+    @property
+    def upstream_retry_minimum(self):
+        minimum = self.config.getint('proxy', 'upstream_retry_minimum')
+        if minimum < 0:
+            self._exit('Invalid upstream retry minimum "%s" set. It must not be negative.', minimum)
+
+        return minimum
+
+    @property
+    def upstream_max_timeout_extension(self):
+        extension = self.config.getint('proxy', 'upstream_max_timeout_extension')
+        if extension < 0:
+            self._exit('Invalid upstream max timeout extension "%s" set. It must not be negative.', extension)
+
+        return extension
+
+    @property
+    def health_check_interval(self):
+        interval = self.config.getint('proxy', 'health_check_interval')
+        if interval < 1:
+            self._exit('Invalid health check interval "%s" set. It must be greater than zero.', interval)
+
+        return interval
+
+    @property
+    def health_check_timeout(self):
+        timeout = self.config.getint('proxy', 'health_check_timeout')
+        if timeout < 1:
+            self._exit('Invalid health check timeout "%s" set. It must be greater than zero.', timeout)
+
+        return timeout
+
+    @property
+    def index_catalog_interval(self):
+        interval = self.config.getint('proxy', 'index_catalog_interval')
+        if interval < 0:
+            self._exit('Invalid index catalog interval "%s" set. It must not be negative.', interval)
+
+        return interval
+
+    @property
+    def metrics_address(self):
+        return self.config.get('proxy', 'metrics_address')
+
+    @property
+    def metrics_port(self):
+        port = self.config.getint('proxy', 'metrics_port')
+        if port < 0 or port > 65535:
+            self._exit('Invalid metrics port "%s" set. It must be between 0 and 65535.', port)
+
+        return port
+
+    @property
+    def engine(self):
+        engine = self.config.get('proxy', 'engine').lower()
+        engines = ['threaded', 'evented']
+        if engine in engines:
+            return engine
+
+        self._exit('Invalid engine "%s" set. Valid engines are: %s', engine, ', '.join(engines))
+
+    @property
+    def worker_threads(self):
+        threads = self.config.getint('proxy', 'worker_threads')
+        if threads < 1:
+            self._exit('Invalid number of worker threads "%s" set. It must be greater than zero.', threads)
+
+        return threads
+
+    @property
+    def worker_queue_size(self):
+        queue_size = self.config.getint('proxy', 'worker_queue_size')
+        if queue_size < 1:
+            self._exit('Invalid worker queue size "%s" set. It must be greater than zero.', queue_size)
+
+        return queue_size
+
+    @property
+    def authentication_cache_size(self):
+        cache_size = self.config.getint('cache', 'authentication_cache_size')
+        if cache_size < 0:
+            self._exit('Invalid authentication cache size "%s" set. It must not be negative.', cache_size)
+
+        return cache_size
+
+    @property
+    def negative_authentication_ttl(self):
+        return self.config.getint('cache', 'negative_authentication_ttl')
+
+    @property
+    def role_cache_size(self):
+        cache_size = self.config.getint('cache', 'role_cache_size')
+        if cache_size < 0:
+            self._exit('Invalid role cache size "%s" set. It must not be negative.', cache_size)
+
+        return cache_size
+
+    @property
+    def role_cache_ttl(self):
+        return self.config.getint('cache', 'role_cache_ttl')
+
+    @property
+    def permission_cache_size(self):
+        cache_size = self.config.getint('cache', 'permission_cache_size')
+        if cache_size < 0:
+            self._exit('Invalid permission cache size "%s" set. It must not be negative.', cache_size)
+
+        return cache_size
+
+    @property
+    def inspection_cache_size(self):
+        cache_size = self.config.getint('cache', 'inspection_cache_size')
+        if cache_size < 0:
+            self._exit('Invalid inspection cache size "%s" set. It must not be negative.', cache_size)
+
+        return cache_size
+
+    @property
+    def inspection_cache_ttl(self):
+        return self.config.getint('cache', 'inspection_cache_ttl')
+
+    @property
+    def response_cache_size(self):
+        cache_size = self.config.getint('cache', 'response_cache_size')
+        if cache_size < 0:
+            self._exit('Invalid response cache size "%s" set. It must not be negative.', cache_size)
+
+        return cache_size
+
     @property
     def role_backend(self):
         return ElasticsearchRoleBackend(self)
@@ -323,6 +581,10 @@ class ElasticSettings(LoggingAware, Settings):
             # TODO: Can't help myself, but passing self AND get_option seems a bit overkill to me..
             backend = backend_type(section_name, get_option, self)
             backend.default_role = self.authentication.get(section_name, 'default_role')
+            try:
+                backend.cache_ttl = self.authentication.getint(section_name, 'cache_ttl')
+            except ValueError:
+                self._exit('Invalid "cache_ttl" option in authentication backend "%s".', section_name)
             backends.append(backend)
 
         return backends
@@ -4,9 +4,12 @@ import re
 from distutils.version import StrictVersion
 
 __all__ = ['format_ldap_error', 'format_elasticsearch_error', 'compare_major_and_minor_version',
-           'pattern_match', 'pattern_compare', 'classproperty', 'cachedproperty', 'strip_quotes']
+           'pattern_match', 'pattern_compare', 'classproperty', 'cachedproperty', 'strip_quotes',
+           'parse_time_value']
 
 CACHE_MAX_SIZE = 1000
+TIME_UNITS = [('micros', 1e-6), ('nanos', 1e-9), ('ms', 1e-3), ('s', 1), ('m', 60), ('h', 3600), ('d', 86400),
+              ('w', 604800)]  # The order matters, as some units are suffixes of others
 _pattern_cache = {}
 
 
@@ -207,3 +210,16 @@ def strip_quotes(buf):
         raise TypeError('Expected type string, got %s instead' % type(buf))
 
     return buf
+
+
+def parse_time_value(value):
+    """Parse the given time value as understood by Elasticsearch and return it in seconds.
+    Values without unit are milliseconds. Raises ValueError if the value is invalid.
+
+    """
+    value = value.strip().lower()
+    for unit, factor in TIME_UNITS:
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * factor
+
+    return float(value) / 1000
@@ -0,0 +1,92 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import json
+import threading
+from Queue import Queue, Full
+
+from elasticarmor.util.mixins import LoggingAware
+from elasticarmor.util.workers import iter_batches
+
+__all__ = ['AccessLog']
+
+QUEUE_SIZE = 10000  # Records, further ones are dropped until the writer caught up
+MAX_BATCH_SIZE = 500  # Records written at once
+
+
+class AccessLog(LoggingAware, object):
+    """Writes records of processed requests as JSON lines to the given file.
+
+    Records are queued and written in a separate thread, so that a slow disk does not delay any request.
+    If the queue is full, records are dropped and counted instead of waiting for the writer to catch up.
+    """
+
+    def __init__(self, path, queue_size=QUEUE_SIZE):
+        self.path = path
+
+        self._queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self._dropped = 0
+        self._reopen = False
+        self._thread = None
+
+    @property
+    def dropped(self):
+        """The number of records which have been dropped because the queue was full."""
+        return self._dropped
+
+    def start(self):
+        """Start writing records."""
+        self._thread = threading.Thread(target=self._run, name='AccessLog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Write all remaining records and stop."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def reopen(self):
+        """Reopen the file before writing the next records. Required once the file has been rotated."""
+        self._reopen = True
+
+    def write(self, record):
+        """Queue the given record, a dictionary, to be written. Returns False if it has been dropped."""
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            with self._lock:
+                self._dropped += 1
+
+            return False
+
+        return True
+
+    def _run(self):
+        log_file = None
+        for batch in iter_batches(self._queue, MAX_BATCH_SIZE):
+            lines = []
+            for record in batch:
+                # Serialized one by one, so that a single faulty record cannot prevent others from being written
+                try:
+                    lines.append(json.dumps(record, separators=(',', ':'), sort_keys=True) + '\n')
+                except (TypeError, ValueError) as error:
+                    self.log.error('Failed to serialize access log record %r. An error occurred: %s', record, error)
+
+            try:
+                if log_file is not None and self._reopen:
+                    log_file.close()
+                    log_file = None
+                if log_file is None:
+                    self._reopen = False
+                    log_file = open(self.path, 'a')
+
+                log_file.write(''.join(lines))
+                log_file.flush()
+            except IOError as error:
+                self.log.error('Failed to write %u records to access log "%s". An error occurred: %s',
+                               len(lines), self.path, error)
+
+        if log_file is not None:
+            log_file.close()
@@ -0,0 +1,128 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import logging
+import threading
+import traceback
+from Queue import Queue, Full
+
+from elasticarmor.util.mixins import LoggingAware
+from elasticarmor.util.workers import iter_batches
+
+__all__ = ['AsyncLogHandler']
+
+MAX_BATCH_SIZE = 500  # Records written at once
+
+
+class AsyncLogHandler(LoggingAware, logging.Handler):
+    """Passes log records to the given handler in a separate thread, so that logging threads
+    never wait for a slow disk or syslog socket. Records of stream and file handlers are
+    written in batches, with a single flush.
+
+    Records are queued until the given number of records is waiting. Further records are dropped
+    and counted instead, until the writer caught up. Until start() has been called, records are
+    passed to the given handler immediately, as threads do not survive daemonization.
+    """
+
+    def __init__(self, target, queue_size):
+        logging.Handler.__init__(self)
+        self.target = target
+
+        self._queue = Queue(queue_size)
+        self._dropped = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def dropped(self):
+        """The number of records which have been dropped because the queue was full."""
+        return self._dropped
+
+    def start(self):
+        """Start passing records to the target handler in a separate thread."""
+        self._thread = threading.Thread(target=self._run, name='AsyncLogHandler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Write all remaining records and pass further ones to the target handler immediately."""
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def close(self):
+        self.stop()
+        self.target.close()
+        logging.Handler.close(self)
+
+    def emit(self, record):
+        if self._thread is None:
+            self.target.handle(record)
+            return
+
+        try:
+            # The arguments are merged now, as they may change or are not safe to access from another thread
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = _exception_formatter.formatException(record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            with self._lock:
+                self._dropped += 1
+
+    def _run(self):
+        for batch in iter_batches(self._queue, MAX_BATCH_SIZE):
+            try:
+                self._write([record for record in batch if record.levelno >= self.target.level])
+            except Exception:
+                traceback.print_exc()  # Logging it would only end up here again
+
+            if self._dropped != self._reported:
+                dropped, self._reported = self._dropped - self._reported, self._dropped
+                self.log.warning('Dropped %u log records, as they were logged faster than they could be written.',
+                                 dropped)
+
+    def _write(self, records):
+        target = self.target
+        if not records:
+            return
+        elif not isinstance(target, logging.StreamHandler):
+            for record in records:
+                target.handle(record)
+            return
+
+        lines = []
+        for record in records:
+            if target.filter(record):
+                try:
+                    lines.append(target.format(record))
+                except Exception:
+                    target.handleError(record)
+
+        if lines:
+            target.acquire()
+            try:
+                if target.stream is None:  # Files are not opened until the first record is written (delay=True)
+                    target.stream = target._open()
+
+                target.stream.write('\n'.join(lines) + '\n')
+                target.flush()
+            except UnicodeError:
+                # Mixing byte and unicode strings is something the target knows how to deal with, though
+                for record in records:
+                    target.handle(record)
+            except Exception:
+                target.handleError(records[-1])
+            finally:
+                target.release()
+
+
+_exception_formatter = logging.Formatter()
@@ -0,0 +1,125 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ['BALANCING_STRATEGIES', 'NodeBalancer', 'PriorityBalancer', 'RoundRobinBalancer', 'RandomBalancer',
+           'LeastOutstandingBalancer', 'LatencyBalancer']
+
+LATENCY_DECAY = 0.3  # The weight of the latest response time in the moving average
+
+
+class NodeBalancer(object):
+    """Base class for all strategies which decide in which order nodes are tried.
+
+    The number of outstanding requests and the average response time of each node are tracked regardless of
+    the strategy. A request is outstanding until the response's headers have been received. The response time
+    is measured up to this point as well, so it reflects how long a node takes to process a request.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = list(nodes)  # In order of their priority
+
+        self._lock = threading.Lock()
+        self._outstanding = dict((node, 0) for node in self.nodes)
+        self._latencies = dict((node, None) for node in self.nodes)
+
+    def order(self, nodes):
+        """Return the given nodes in the order they are supposed to be tried."""
+        raise NotImplementedError()
+
+    @contextmanager
+    def track(self, node):
+        """Context manager to register a request sent to the given node. Its response time is only recorded
+        if no exception is raised in the context, as the node is then considered unavailable anyway.
+
+        """
+        with self._lock:
+            self._outstanding[node] += 1
+
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._outstanding[node] -= 1
+
+        latency = time.time() - started
+        with self._lock:
+            average = self._latencies[node]
+            self._latencies[node] = latency if average is None \
+                else LATENCY_DECAY * latency + (1 - LATENCY_DECAY) * average
+
+    def outstanding(self, node):
+        """Return the number of requests currently being processed by the given node."""
+        return self._outstanding[node]
+
+    def latency(self, node):
+        """Return the average response time of the given node in seconds or None if it's not known yet."""
+        return self._latencies[node]
+
+    def reset(self, node):
+        """Forget the average response time of the given node."""
+        with self._lock:
+            self._latencies[node] = None
+
+
+class PriorityBalancer(NodeBalancer):
+    """Tries nodes strictly in the order they are configured. Secondary nodes are used in case of a failure only."""
+
+    def order(self, nodes):
+        return nodes
+
+
+class RoundRobinBalancer(NodeBalancer):
+    """Starts with the next node for each request, so that all nodes receive the same number of requests."""
+
+    def __init__(self, nodes):
+        super(RoundRobinBalancer, self).__init__(nodes)
+        self._counter = itertools.count()
+
+    def order(self, nodes):
+        if not nodes:
+            return nodes
+
+        offset = next(self._counter) % len(nodes)
+        return nodes[offset:] + nodes[:offset]
+
+
+class RandomBalancer(NodeBalancer):
+    """Tries nodes in random order."""
+
+    def order(self, nodes):
+        return random.sample(nodes, len(nodes))
+
+
+class LeastOutstandingBalancer(RoundRobinBalancer):
+    """Prefers nodes with the fewest outstanding requests. Nodes which are equally busy take turns."""
+
+    def order(self, nodes):
+        return sorted(super(LeastOutstandingBalancer, self).order(nodes), key=self._outstanding.__getitem__)
+
+
+class LatencyBalancer(RoundRobinBalancer):
+    """Prefers nodes with the lowest average response time, multiplied by the number of requests they're
+    processing, so that the fastest node does not get overwhelmed. Nodes not tried yet are preferred.
+
+    """
+
+    def order(self, nodes):
+        return sorted(super(LatencyBalancer, self).order(nodes), key=self._score)
+
+    def _score(self, node):
+        return (self._latencies[node] or 0) * (self._outstanding[node] + 1)
+
+
+BALANCING_STRATEGIES = {
+    'priority': PriorityBalancer,
+    'round-robin': RoundRobinBalancer,
+    'random': RandomBalancer,
+    'least-outstanding': LeastOutstandingBalancer,
+    'latency': LatencyBalancer
+}
@@ -0,0 +1,106 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import threading
+import time
+
+try:
+    # Python 2.7+
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from simplejson import OrderedDict
+
+__all__ = ['Cache']
+
+
+class Cache(object):
+    """Thread-safe cache which discards the least recently used entries once one of
+    its size limits is reached and entries once their time to live expired.
+
+    The size of an entry is what the caller claims it is when storing it. This
+    allows to limit the cache's memory usage without having to measure objects.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires, size), ordered by last use
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """The accumulated size of all entries."""
+        return self._size
+
+    @property
+    def hits(self):
+        """The number of successful lookups."""
+        return self._hits
+
+    @property
+    def misses(self):
+        """The number of lookups for which no entry was found."""
+        return self._misses
+
+    def get(self, key, default=None):
+        """Return the value for the given key or the given default if there is no such entry or it expired."""
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+
+            value, expires, size = entry
+            if expires is not None and expires <= time.time():
+                self._size -= size
+                self._misses += 1
+                return default
+
+            self._entries[key] = entry
+            self._hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, size=0):
+        """Store the given value for the given key. The given time to live overrides the default one."""
+        if ttl is None:
+            ttl = self.ttl
+
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, time.time() + ttl if ttl else None, size)
+            self._size += size
+            while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                                     (self.max_size is not None and self._size > self.max_size)):
+                self._size -= self._entries.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        """Remove the entry for the given key."""
+        with self._lock:
+            self._discard(key)
+
+    def purge(self, predicate):
+        """Remove all entries whose value satisfies the given predicate."""
+        with self._lock:
+            for key in [k for k, (value, _, _) in self._entries.iteritems() if predicate(value)]:
+                self._discard(key)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _discard(self, key):
+        try:
+            self._size -= self._entries.pop(key)[2]
+        except KeyError:
+            pass
@@ -0,0 +1,111 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import threading
+
+import requests
+
+from elasticarmor.util import format_elasticsearch_error, pattern_match
+from elasticarmor.util.mixins import LoggingAware
+
+__all__ = ['IndexCatalog']
+
+MIN_REFRESH_INTERVAL = 1  # Seconds, refresh requests arriving in quick succession are handled at once
+
+
+class IndexCatalog(LoggingAware, object):
+    """Keeps track of the names of all indices and aliases which exist in the cluster of the given connection.
+
+    The names are fetched in a separate thread, every time the given interval has passed or once a refresh has
+    been requested. The given callback is called without arguments each time the names have changed.
+    """
+
+    def __init__(self, connection, interval, on_change=None):
+        self.connection = connection
+        self.interval = interval
+        self.on_change = on_change
+
+        self._names = None  # Not known until the first refresh succeeded
+        self._stopped = threading.Event()
+        self._refresh_requested = threading.Event()
+        self._thread = None
+
+    @property
+    def names(self):
+        """The names of all indices and aliases or None if they're not known yet."""
+        return self._names
+
+    def start(self):
+        """Start refreshing the catalog."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='IndexCatalog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop refreshing the catalog."""
+        self._stopped.set()
+        self._refresh_requested.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def request_refresh(self):
+        """Refresh the catalog as soon as possible."""
+        self._refresh_requested.set()
+
+    def knows(self, name):
+        """Return whether the given index or alias exists. Returns True as well if that's not known yet."""
+        names = self._names
+        return names is None or name in names
+
+    def contains(self, pattern, excludes=None, filter_string=None):
+        """Return whether any index or alias matches the given pattern, but none of the given exclude patterns
+        and any pattern of the given filter string. Returns True as well if the names are not known yet.
+
+        """
+        names = self._names
+        if names is None:
+            return True
+
+        pattern, excludes = str(pattern), [str(exclude) for exclude in excludes or []]
+        requested = [str(p) for p in filter_string.iter_patterns()] if filter_string else None
+        for name in names:
+            if pattern_match(pattern, name) and not any(pattern_match(e, name) for e in excludes) \
+                    and (requested is None or any(pattern_match(p, name) for p in requested)):
+                return True
+
+        return False
+
+    def refresh(self):
+        """Fetch the names of all indices and aliases."""
+        try:
+            response = self.connection.process(requests.Request('GET', '/_aliases'))
+            if response is None:
+                return
+
+            response.raise_for_status()
+            indices = response.json()
+        except (requests.RequestException, ValueError) as error:
+            self.log.error('Failed to fetch the names of all indices and aliases. An error occurred: %s',
+                           format_elasticsearch_error(error))
+            return
+
+        names = set(indices)
+        for index in indices.itervalues():
+            names.update(index.get('aliases', ()))
+
+        if names != self._names:
+            self.log.debug('Catalog of indices and aliases changed. It now contains %u names.', len(names))
+            self._names = frozenset(names)
+            if self.on_change is not None:
+                self.on_change()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                self.log.exception('An unexpected error occurred while refreshing the catalog of indices.')
+
+            self._stopped.wait(MIN_REFRESH_INTERVAL)
+            self._refresh_requested.wait(self.interval - MIN_REFRESH_INTERVAL)
+            self._refresh_requested.clear()
@@ -0,0 +1,65 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import sys
+
+try:
+    # Python 2.7+
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from simplejson import OrderedDict
+
+__all__ = ['JSON_LIBRARIES', 'JsonCodec']
+
+JSON_LIBRARIES = ['ujson', 'simplejson', 'json']  # Ordered by preference
+
+
+def _import(name):
+    """Import and return the module with the given name or None if it is not installed."""
+    if name == 'json' and sys.version_info < (2, 7):
+        return None  # We need object_pairs_hook, which is only available in the json module since Python 2.7
+
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
+
+
+class JsonCodec(object):
+    """Encodes and decodes JSON by utilizing the given library or the fastest one installed.
+
+    Decoded objects are of type OrderedDict unless the caller states that the order of keys is irrelevant.
+    Plain dicts are decoded several times faster. ujson preserves neither the order of keys nor the precision
+    of floating point numbers, so simplejson or json is used to decode ordered objects in this case. Encoding
+    is left to json if possible, as its C-accelerated encoder outperforms the ones of the other libraries.
+    """
+
+    def __init__(self, library=None):
+        if library is None:
+            library = next(name for name in JSON_LIBRARIES if _import(name) is not None)
+
+        module = _import(library)
+        if module is None:
+            raise ImportError('Library "{0}" is not available'.format(library))
+        elif library == 'ujson':
+            self._ordered = _import('simplejson') or _import('json')
+        else:
+            self._ordered = module
+
+        self._unordered = module
+        self._encoder = _import('json') or self._ordered
+        self.library = library
+
+    def decode(self, data, ordered=True):
+        """Decode the given JSON data and return the result."""
+        if ordered:
+            return self._ordered.loads(data, object_pairs_hook=OrderedDict)
+
+        return self._unordered.loads(data)
+
+    def encode(self, data, pretty=False):
+        """Return the given data encoded to JSON."""
+        if not pretty:
+            return self._encoder.dumps(data, separators=(',', ':'))
+
+        return self._encoder.dumps(data, indent=2, separators=(',', ' : '))
@@ -1,23 +1,38 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
 import base64
+import socket
+import threading
 import time
 import urllib
-import threading
+from Queue import Queue
+from collections import deque
 
 import requests
 
 from elasticarmor import *
-from elasticarmor.util import format_elasticsearch_error, pattern_compare
+from elasticarmor.util import format_elasticsearch_error, pattern_compare, parse_time_value
+from elasticarmor.util.balancer import PriorityBalancer
+from elasticarmor.util.health import CircuitBreaker, RetryBudget
 from elasticarmor.util.http import Query
-from elasticarmor.util.rwlock import ReadWriteLock
+from elasticarmor.util.metrics import Counter, Histogram
+from elasticarmor.util.pool import PooledHttpAdapter, watch_connections
 from elasticarmor.util.mixins import LoggingAware
+from elasticarmor.util.workers import Scheduler, WorkerPool
 
 __all__ = ['ElasticSearchError', 'ElasticConnection', 'ElasticObject', 'ElasticRole', 'QueryDslParser',
            'AggregationParser', 'HighlightParser', 'SourceFilter', 'FilterString', 'FieldsFilter']
 
 DEFAULT_TIMEOUT = 10  # Seconds
-CHECK_REACHABILITY_INTERVAL = 900  # Seconds
+HEDGE_PERCENTILE = 0.95  # Of the response times, after which a request is sent to another node as well
+HEDGE_DELAY_UPDATE_INTERVAL = 100  # Responses
+HEDGE_WORKERS = 8  # Threads sending hedged requests, further ones are not sent until one of them is free
+
+UPSTREAM_RESPONSE_SECONDS = Histogram('elasticarmor_upstream_response_seconds',
+                                      'Time until a node responded, up to the end of the headers.', ['node'])
+UPSTREAM_FAILURES = Counter('elasticarmor_upstream_failures_total',
+                            'Requests which failed because a node timed out or could not be connected.',
+                            ['node', 'reason'])
 
 
 class ElasticSearchError(Exception):
@@ -25,77 +40,49 @@ class ElasticSearchError(Exception):
 
 
 class ElasticConnection(LoggingAware, object):
-    """Class for failover handling of multiple Elasticsearch nodes."""
-    def __init__(self, nodes):
-        self.nodes = set(nodes)
+    """Class for failover handling and balancing of multiple Elasticsearch nodes.
 
-        self._last_check = None
-        self._unreachable_nodes = set()
-        self._node_priorities = dict((node, index) for index, node in enumerate(self.nodes))
-
-        self._check_flag = threading.Event()
-        self._reachable_nodes_lock = ReadWriteLock()
-        self._unreachable_nodes_lock = ReadWriteLock()
+    Connections to the nodes are kept alive and shared among all threads utilizing the same instance of this class.
+    The order in which nodes are tried is decided by the given balancer, which defaults to a PriorityBalancer.
+    Whether a node is available is decided by its circuit breaker. Requests which do not alter any data may
+    be hedged: If the node does not respond within the time in which 95% of the responses are usually received,
+    the request is sent to the next node as well. Retries and hedged requests are limited by the retry budget.
+    """
+    def __init__(self, nodes, pool_size=DEFAULT_UPSTREAM_POOL_SIZE, idle_timeout=None, request_limit=None,
+                 balancer=None, hedging=False, retry_budget=None, max_timeout_extension=DEFAULT_MAX_TIMEOUT_EXTENSION):
+        self.nodes = list(nodes)
+        self.hedging = hedging
+        self.max_timeout_extension = max_timeout_extension
+        self.balancer = balancer or PriorityBalancer(nodes)
+        self.breakers = dict((node, CircuitBreaker(node)) for node in self.nodes)
+        self.retry_budget = retry_budget or RetryBudget(DEFAULT_RETRY_RATIO, DEFAULT_RETRY_MINIMUM)
+        self._adapter = PooledHttpAdapter(nodes, pool_size, idle_timeout, request_limit)
+
+        self._scheduler = Scheduler('HedgeScheduler')
+        self._hedge_workers = WorkerPool(HEDGE_WORKERS, HEDGE_WORKERS, 'HedgeWorker', daemon=True)
+        self._recorded = 0
+        self._hedge_delay = None  # Not known until enough response times have been recorded
+        self._latencies = deque(maxlen=HEDGE_DELAY_UPDATE_INTERVAL * 10)
 
     @property
-    def _reachable_nodes(self):
-        """Return a list of all currently available nodes."""
-        with self._reachable_nodes_lock.readContext:
-            return self.nodes.copy()
-
-    def _mark_as_unreachable(self, node):
-        """Register the given node as unreachable."""
-        with self._reachable_nodes_lock.writeContext:
-            self.nodes.discard(node)
-
-        with self._unreachable_nodes_lock.writeContext:
-            self._unreachable_nodes.add(node)
-
-    def _is_reachability_check_necessary(self):
-        """Return whether it is necessary to check node reachability."""
-        return self._unreachable_nodes and (self._last_check is None or
-                                            time.time() - self._last_check > CHECK_REACHABILITY_INTERVAL)
-
-    def check_reachability(self):
-        """Check all currently unavailable nodes whether they are still unreachable."""
-        if not self._is_reachability_check_necessary() or self._check_flag.is_set():
-            return  # Checking reachability is either not necessary or another thread is currently doing it
-
-        # Notify any other request thread that we're now checking reachability
-        self._check_flag.set()
-
-        # Check if any unreachable nodes are reachable again
-        reachable_nodes, still_unreachable = [], []
-        with self._unreachable_nodes_lock.writeContext:
-            for node in self._unreachable_nodes.copy():
-                try:
-                    requests.head(node).raise_for_status()
-                except requests.RequestException as error:
-                    still_unreachable.append(node)
-                    self.log.debug('Node "%s" is still unreachable. Error: %s',
-                                   node, format_elasticsearch_error(error))
-                else:
-                    reachable_nodes.append(node)
-                    self._unreachable_nodes.remove(node)
-                    self.log.debug('Node "%s" is reachable and being made available again.', node)
-
-        if reachable_nodes:
-            # Make the now reachable nodes available again and ensure that the priority order is restored
-            with self._reachable_nodes_lock.writeContext:
-                self.nodes.update(reachable_nodes)
-                self.nodes = set(sorted(self.nodes, key=self._node_priorities.__getitem__))
-                reachable_nodes = self.nodes.copy()
-
-        self.log.debug('Currently available nodes: %s', ', '.join(reachable_nodes) if reachable_nodes else 'None')
-        self.log.debug('Currently unavailable nodes: %s', ', '.join(still_unreachable) if still_unreachable else 'None')
-
-        # Remember when we've checked reachability the last time and clear the flag
-        self._last_check = time.time()
-        self._check_flag.clear()
+    def available_nodes(self):
+        """Return a list of all nodes which are currently not considered to be unavailable."""
+        return [node for node in self.nodes if self.breakers[node].state != CircuitBreaker.OPEN]
+
+    def status(self):
+        """Return the current state of all nodes."""
+        return dict((node, {
+            'state': self.breakers[node].state,
+            'reason': self.breakers[node].reason,
+            'since': int(self.breakers[node].since),
+            'outstanding_requests': self.balancer.outstanding(node),
+            'average_response_time': self.balancer.latency(node)
+        }) for node in self.nodes)
 
     def process(self, request):
         """Send the given request to Elasticsearch and return its response.
         Returns None if it was not possible to receive a response."""
+        timeout = DEFAULT_TIMEOUT
         try:  # It's either a ElasticRequestHandler, a ElasticRequest ..
             request_path = urllib.quote_plus(request.path, '/')
         except AttributeError:  # .. or a requests.Request
@@ -105,46 +92,206 @@ class ElasticConnection(LoggingAware, object):
             prepared_request.prepare_method(request.method)
             prepared_request.prepare_headers(request.headers)
             prepared_request.prepare_body(request.data, request.files, request.json)
+            idempotent = request.method in ('GET', 'HEAD')
         else:
             encoded_query = urllib.urlencode(request.query, True)
             prepared_request = requests.PreparedRequest()
             prepared_request.prepare_method(request.command)
             prepared_request.prepare_headers(request.headers)
-            prepared_request.prepare_body(request.body, None)
+            prepared_request.prepare_body(request.payload, None)
 
-        if prepared_request.body:
+            # Opening a scroll twice would leave one of them open until it expires
+            idempotent = (request.command in ('GET', 'HEAD') or getattr(request, 'idempotent', False)) \
+                and 'scroll' not in request.query
+
+            if request.query.last('timeout'):
+                # Elasticsearch is given the requested time, plus the time we'd usually wait for it
+                timeout = _extend_timeout(timeout, request.query.last('timeout'), self.max_timeout_extension)
+
+        # A streamed payload is consumed while it's being sent and cannot be sent once more to another node
+        stream = prepared_request.body if hasattr(prepared_request.body, 'consumed') else None
+        if stream is not None:
+            self.log.debug('Processing Elasticsearch request "%s %s" with streamed body...', prepared_request.method,
+                           request_path + ('?' + encoded_query if encoded_query else ''))
+        elif prepared_request.body:
             self.log.debug('Processing Elasticsearch request "%s %s" with body %r...', prepared_request.method,
                            request_path + ('?' + encoded_query if encoded_query else ''), prepared_request.body)
         else:
             self.log.debug('Processing Elasticsearch request "%s %s"...', prepared_request.method,
                            request_path + ('?' + encoded_query if encoded_query else ''))
 
-        first_error = None
-        with requests.Session() as session:
-            for node in self._reachable_nodes:
-                prepared_request.prepare_url(node + request_path, encoded_query)
-
-                try:
-                    # TODO: Interpret the timeout= query parameter for Elasticsearch
-                    response = session.send(prepared_request, stream=True, timeout=DEFAULT_TIMEOUT)
-                except requests.Timeout:
-                    self.log.warning('Node "%s" timed out.', node)
-                    self._mark_as_unreachable(node)
-                except requests.RequestException as error:
-                    self.log.warning('Failed to connect to node "%s". An error occurred: %s',
-                                     node, format_elasticsearch_error(error))
-                    self._mark_as_unreachable(node)
-                    if first_error is None:
-                        first_error = error
+        hedge_delay = self._hedge_delay if self.hedging and idempotent and stream is None else None
+        self.retry_budget.deposit()
+
+        first_error, retry = None, False
+        nodes = self.balancer.order(self.available_nodes)
+        while nodes:
+            node = nodes.pop(0)
+            if not self.breakers[node].acquire():
+                continue  # The circuit is half-open and a trial request is already being sent
+            elif retry and not self.retry_budget.withdraw():
+                self.breakers[node].cancel()
+                self.log.warning('Not retrying request on node "%s". The retry budget is exhausted.', node)
+                break
+
+            retry = True
+            try:
+                if hedge_delay is not None and nodes:
+                    response = self._send_hedged(node, nodes, prepared_request, request_path, encoded_query,
+                                                 timeout, hedge_delay)
                 else:
-                    self.log.debug('Got response with status %u from node "%s".', response.status_code, node)
-                    return response
+                    prepared_request.prepare_url(node + request_path, encoded_query)
+                    response = self._send(node, prepared_request, timeout, stream)
+            except requests.Timeout:
+                if stream is not None and stream.consumed:
+                    break
+            except requests.RequestException as error:
+                if first_error is None:
+                    first_error = error
+                if stream is not None and stream.consumed:
+                    break
+            else:
+                return response
 
         if first_error is not None:
             # Re-raise the exception which occurred first to indicate
             # to the user that we were not able to fetch a response
             raise first_error
 
+    def _send(self, node, prepared_request, timeout, stream=None, hedge=None):
+        """Send the given request to the given node and return its response. The node's circuit
+        breaker must have been acquired already and is updated with the outcome of the request.
+
+        """
+        breaker = self.breakers[node]
+        started = time.time()
+        try:
+            with self.balancer.track(node):
+                response = self._adapter.send(prepared_request, stream=True, timeout=timeout)
+        except requests.RequestException as error:
+            if stream is not None and stream.error is not None:
+                breaker.cancel()
+                raise stream.error  # It's not the node's fault if the client fails to send the payload
+            elif hedge is not None and hedge.interrupted:
+                breaker.cancel()
+                raise  # Nor is it if another node has been faster
+            elif isinstance(error, requests.Timeout):
+                self.log.warning('Node "%s" timed out.', node)
+                UPSTREAM_FAILURES.inc(node, 'timeout')
+            else:
+                self.log.warning('Failed to connect to node "%s". An error occurred: %s',
+                                 node, format_elasticsearch_error(error))
+                UPSTREAM_FAILURES.inc(node, 'error')
+
+            breaker.record(False)
+            raise
+        except:
+            breaker.cancel()
+            raise
+
+        self.log.debug('Got response with status %u from node "%s".', response.status_code, node)
+        breaker.record(True)
+        latency = time.time() - started
+        UPSTREAM_RESPONSE_SECONDS.observe(latency, node)
+        self._record_latency(latency)
+        return response
+
+    def _send_hedged(self, node, nodes, prepared_request, request_path, encoded_query, timeout, delay):
+        """Send the given request to the given node. If it does not respond within the given delay, send it
+        to the next of the given nodes as well and return the response received first. The latter node
+        is removed from the given list. Raises the first error that occurred if none of them responds.
+
+        """
+        hedge = _HedgedRequest()
+        self._scheduler.call_later(delay, self._dispatch_hedge, hedge, node, nodes, prepared_request,
+                                   request_path, encoded_query, timeout, delay)
+
+        prepared_request.prepare_url(node + request_path, encoded_query)
+        try:
+            with watch_connections(hedge.watch):
+                response = self._send(node, prepared_request, timeout, hedge=hedge)
+        except requests.RequestException as error:
+            with hedge.lock:
+                hedge.finished = True
+                if not hedge.dispatched:
+                    raise error
+
+            response = hedge.results.get()
+            if response is None:
+                raise error
+
+            return response
+
+        with hedge.lock:
+            hedge.finished = True
+            if not hedge.responded:
+                hedge.responded = True
+                return response
+
+        response.close()  # The other node has been faster, its response is already waiting
+        return hedge.results.get()
+
+    def _dispatch_hedge(self, hedge, node, nodes, prepared_request, request_path, encoded_query, timeout, delay):
+        """Send the given request to the next of the given nodes as well, unless the first one responded already.
+        Called by the scheduler once the given delay has passed.
+
+        """
+        with hedge.lock:
+            if hedge.finished:
+                return
+
+            while nodes:
+                other = nodes.pop(0)
+                if self.breakers[other].acquire():
+                    break
+            else:
+                return
+
+            if not self._hedge_workers.running:
+                self._hedge_workers.start()  # Not earlier, as threads do not survive daemonization
+
+            request = prepared_request.copy()
+            request.prepare_url(other + request_path, encoded_query)
+            if not self.retry_budget.withdraw() or not self._hedge_workers.submit(self._send_hedge, hedge,
+                                                                                  other, request, timeout):
+                self.breakers[other].cancel()
+                nodes.insert(0, other)
+                return
+
+            hedge.dispatched = True
+
+        self.log.debug('Node "%s" did not respond within %.3fs. Sending request to node "%s" as well.',
+                       node, delay, other)
+
+    def _send_hedge(self, hedge, node, request, timeout):
+        """Send the given hedged request to the given node and interrupt the first one if this one is faster."""
+        try:
+            response = self._send(node, request, timeout)
+        except requests.RequestException:
+            hedge.results.put(None)
+            return
+        except Exception:
+            hedge.results.put(None)
+            raise  # Logged by the worker pool
+
+        with hedge.lock:
+            if hedge.responded:
+                response.close()  # The other node has been faster
+                return
+
+            hedge.responded = True
+            hedge.results.put(response)
+            if not hedge.finished:
+                hedge.interrupt()
+
+    def _record_latency(self, latency):
+        """Remember the given response time and update the hedge delay from time to time."""
+        self._latencies.append(latency)
+        self._recorded += 1
+        if self._recorded % HEDGE_DELAY_UPDATE_INTERVAL == 0:
+            latencies = sorted(self._latencies)
+            self._hedge_delay = latencies[int(len(latencies) * HEDGE_PERCENTILE)]
+
 
 class ElasticObject(LoggingAware, object):
     """Base class for all objects stored in our internal Elasticsearch index."""
@@ -309,104 +456,41 @@ class QueryDslParser(object):
         '_id'
     ]
 
+    __slots__ = ('permissions', 'indices', 'documents', 'fields', '_pending')
+
     def __init__(self):
         self.permissions = set()
         self.indices = set()
         self.documents = set()
         self.fields = set()
+        self._pending = None  # Objects nested in the object being parsed, in the order they appear
 
-        self._query_parsers = {
-            'query': self.query,
-            'match': self.match_query,
-            'match_phrase': self.match_query,
-            'match_phrase_prefix': self.match_query,
-            'multi_match': self.multi_match_query,
-            'bool': self.bool_query,
-            'boosting': self.boosting_query,
-            'common': self.common_query,
-            'constant_score': self.constant_score_query,
-            'dis_max': self.dis_max_query,
-            'filtered': self.filtered_query,
-            'fuzzy_like_this': self.fuzzy_like_this_query,
-            'flt': self.fuzzy_like_this_query,
-            'fuzzy_like_this_field': self.fuzzy_like_this_field_query,
-            'flt_field': self.fuzzy_like_this_field_query,
-            'function_score': self.function_score_query,
-            'fuzzy': self.fuzzy_query,
-            'geo_shape': self.geo_shape_query,
-            'has_child': self.has_child_query,
-            'has_parent': self.has_parent_query,
-            'ids': self.ids_query,
-            'indices': self.indices_query,
-            'match_all': self.match_all_query,
-            'more_like_this': self.more_like_this_query,
-            'mlt': self.more_like_this_query,
-            'nested': self.nested_query,
-            'prefix': self.prefix_query,
-            'query_string': self.query_string_query,
-            'simple_query_string': self.query_string_query,
-            'range': self.range_query,
-            'regexp': self.regexp_query,
-            'span_first': self.span_first_query,
-            'span_multi': self.span_multi_query,
-            'span_near': self.span_near_query,
-            'span_not': self.span_not_query,
-            'span_or': self.span_or_query,
-            'span_term': self.span_term_query,
-            'term': self.term_query,
-            'terms': self.terms_query,
-            'in': self.terms_query,
-            'top_children': self.top_children_query,
-            'wildcard': self.wildcard_query,
-            'template': self.template_query
-        }
+    def _parse(self, parsers, kind, obj, index, document):
+        """Parse the given query or filter and all objects nested therein. Raises ElasticSearchError if one
+        of them is unknown. Instead of recursing, nested objects are put on a stack and parsed one after another.
 
-        self._filter_parsers = {
-            'filter': self.filter,
-            'and': self.and_filter,
-            'bool': self.bool_filter,
-            'exists': self.exists_filter,
-            'geo_bounding_box': self.geo_bounding_box_filter,
-            'geo_distance': self.geo_distance_filter,
-            'geo_distance_range': self.geo_distance_range_filter,
-            'geo_polygon': self.geo_polygon_filter,
-            'geo_shape': self.geo_shape_filter,
-            'geohash_cell': self.geohash_cell_filter,
-            'has_child': self.has_child_filter,
-            'has_parent': self.has_parent_filter,
-            'ids': self.ids_filter,
-            'indices': self.indices_filter,
-            'limit': self.limit_filter,
-            'match_all': self.match_all_filter,
-            'missing': self.missing_filter,
-            'nested': self.nested_filter,
-            'not': self.not_filter,
-            'or': self.or_filter,
-            'prefix': self.prefix_filter,
-            'query': self.query_filter,
-            'fquery': self.query_filter,
-            'range': self.range_filter,
-            'regexp': self.regexp_filter,
-            'script': self.script_filter,
-            'term': self.term_filter,
-            'terms': self.terms_filter,
-            'in': self.terms_filter,
-            'type': self.type_filter
-        }
+        """
+        if self._pending is not None:
+            # Called by a parser of an outer object, which is still being processed
+            self._pending.append((parsers, kind, obj, index, document))
+            return
 
-    def _parse_query(self, name, obj, index=None, document=None):
-        """Parse the given query. Raises ElasticSearchError if it is unknown."""
+        stack = [(parsers, kind, obj, index, document)]
+        pending = self._pending = []
         try:
-            self._query_parsers[name](obj, index, document)
-        except KeyError:
-            raise ElasticSearchError('Unknown query "{0}"'.format(name))
+            while stack:
+                parsers, kind, obj, index, document = stack.pop()
+                name, obj = self._read_object(obj)
+                try:
+                    parsers[name](self, obj, index, document)
+                except KeyError:
+                    raise ElasticSearchError('Unknown {0} "{1}"'.format(kind, name))
 
-    def _parse_filter(self, name, obj, index=None, document=None):
-        """Parse the given filter. Raises ElasticSearchError if it is unknown."""
-        try:
-            self._filter_parsers[name](obj, index, document)
-        except KeyError:
-            raise ElasticSearchError('Unknown filter "{0}"'.format(name))
+                if pending:
+                    stack.extend(reversed(pending))
+                    del pending[:]
+        finally:
+            self._pending = None
 
     def _read_object(self, data):
         """Validate and return an object from the given data. Raises ElasticSearchError if the validation fails."""
@@ -431,8 +515,8 @@ class QueryDslParser(object):
                      if (k[0] != '_' or k in self.meta_fields) and (not blacklist or k not in blacklist)), None)
 
     def query(self, obj, index=None, document=None):
-        """Recurse into the given query and parse its contents."""
-        self._parse_query(*self._read_object(obj), index=index, document=document)
+        """Parse the given query and all queries and filters nested therein."""
+        self._parse(self._query_parsers, 'query', obj, index, document)
 
     def match_query(self, obj, index=None, document=None):
         """Parse the given match query. Raises ElasticSearchError in case the query is malformed."""
@@ -745,6 +829,15 @@ class QueryDslParser(object):
                     self.fields.add((index, document, field))
                     self.permissions.add(('api/feature/moreLikeThis', index, document, field))
 
+    def more_like_this_field_query(self, obj, index=None, document=None):
+        """Parse the given more_like_this_field query. Raises ElasticSearchError in case the query is malformed."""
+        field_name = self._read_field(obj)
+        if field_name:
+            self.fields.add((index, document, field_name))
+            self.permissions.add(('api/feature/moreLikeThis', index, document, field_name))
+        else:
+            raise ElasticSearchError('Missing field name in more_like_this_field query "{0!r}"'.format(obj))
+
     def nested_query(self, obj, index=None, document=None):
         """Parse the given nested query. Raises ElasticSearchError in case the query is malformed."""
         if 'path' not in obj:
@@ -879,8 +972,8 @@ class QueryDslParser(object):
         self.permissions.add(('api/search/template', index, document, None))
 
     def filter(self, obj, index=None, document=None):
-        """Recurse into the given filter and parse its contents."""
-        self._parse_filter(*self._read_object(obj), index=index, document=document)
+        """Parse the given filter and all queries and filters nested therein."""
+        self._parse(self._filter_parsers, 'filter', obj, index, document)
 
     def and_filter(self, obj, index=None, document=None):
         """Parse the given and filter. Raises ElasticSearchError in case the filter is malformed."""
@@ -1172,6 +1265,94 @@ class QueryDslParser(object):
         except KeyError:
             raise ElasticSearchError('Missing type name in type filter "{0!r}"'.format(obj))
 
+    # Built once, the parsers are called with the instance as first argument
+    _query_parsers = {
+            'query': query,
+            'match': match_query,
+            'match_phrase': match_query,
+            'match_phrase_prefix': match_query,
+            'multi_match': multi_match_query,
+            'bool': bool_query,
+            'boosting': boosting_query,
+            'common': common_query,
+            'constant_score': constant_score_query,
+            'dis_max': dis_max_query,
+            'filtered': filtered_query,
+            'fuzzy_like_this': fuzzy_like_this_query,
+            'flt': fuzzy_like_this_query,
+            'fuzzyLikeThis': fuzzy_like_this_query,
+            'fuzzy_like_this_field': fuzzy_like_this_field_query,
+            'flt_field': fuzzy_like_this_field_query,
+            'fuzzyLikeThisField': fuzzy_like_this_field_query,
+            'function_score': function_score_query,
+            'fuzzy': fuzzy_query,
+            'geo_shape': geo_shape_query,
+            'has_child': has_child_query,
+            'has_parent': has_parent_query,
+            'ids': ids_query,
+            'indices': indices_query,
+            'match_all': match_all_query,
+            'more_like_this': more_like_this_query,
+            'mlt': more_like_this_query,
+            'moreLikeThis': more_like_this_query,
+            'more_like_this_field': more_like_this_field_query,
+            'mlt_field': more_like_this_field_query,
+            'moreLikeThisField': more_like_this_field_query,
+            'nested': nested_query,
+            'prefix': prefix_query,
+            'query_string': query_string_query,
+            'queryString': query_string_query,
+            'simple_query_string': query_string_query,
+            'simpleQueryString': query_string_query,
+            'range': range_query,
+            'regexp': regexp_query,
+            'span_first': span_first_query,
+            'span_multi': span_multi_query,
+            'span_near': span_near_query,
+            'span_not': span_not_query,
+            'span_or': span_or_query,
+            'span_term': span_term_query,
+            'term': term_query,
+            'terms': terms_query,
+            'in': terms_query,
+            'top_children': top_children_query,
+            'wildcard': wildcard_query,
+            'template': template_query
+        }
+
+    _filter_parsers = {
+            'filter': filter,
+            'and': and_filter,
+            'bool': bool_filter,
+            'exists': exists_filter,
+            'geo_bounding_box': geo_bounding_box_filter,
+            'geo_distance': geo_distance_filter,
+            'geo_distance_range': geo_distance_range_filter,
+            'geo_polygon': geo_polygon_filter,
+            'geo_shape': geo_shape_filter,
+            'geohash_cell': geohash_cell_filter,
+            'has_child': has_child_filter,
+            'has_parent': has_parent_filter,
+            'ids': ids_filter,
+            'indices': indices_filter,
+            'limit': limit_filter,
+            'match_all': match_all_filter,
+            'missing': missing_filter,
+            'nested': nested_filter,
+            'not': not_filter,
+            'or': or_filter,
+            'prefix': prefix_filter,
+            'query': query_filter,
+            'fquery': query_filter,
+            'range': range_filter,
+            'regexp': regexp_filter,
+            'script': script_filter,
+            'term': term_filter,
+            'terms': terms_filter,
+            'in': terms_filter,
+            'type': type_filter
+        }
+
 
 class AggregationParser(object):
     """AggregationParser object to parse Elasticsearch aggregations.
@@ -1204,6 +1385,8 @@ class AggregationParser(object):
     Occurrences of 'None' have the same meaning as previously noted.
     """
 
+    __slots__ = ('permissions', 'indices', 'documents', 'fields', 'document_requests')
+
     def __init__(self):
         self.permissions = set()
         self.indices = set()
@@ -1211,44 +1394,10 @@ class AggregationParser(object):
         self.fields = set()
         self.document_requests = []
 
-        self._parsers = {
-            'aggregations': self.aggregations,
-            'aggs': self.aggregations,
-            'min': self.min_agg,
-            'max': self.max_agg,
-            'sum': self.sum_agg,
-            'avg': self.avg_agg,
-            'stats': self.stats_agg,
-            'extended_stats': self.extended_stats_agg,
-            'value_count': self.value_count_agg,
-            'percentiles': self.percentiles_agg,
-            'percentile_ranks': self.percentile_ranks_agg,
-            'cardinality': self.cardinality_agg,
-            'geo_bounds': self.geo_bounds_agg,
-            'top_hits': self.top_hits_agg,
-            'scripted_metric': self.scripted_metric_agg,
-            'global': self.global_agg,
-            'filter': self.filter_agg,
-            'filters': self.filters_agg,
-            'missing': self.missing_agg,
-            'nested': self.nested_agg,
-            'reverse_nested': self.reverse_nested_agg,
-            'children': self.children_agg,
-            'terms': self.terms_agg,
-            'significant_terms': self.significant_terms_agg,
-            'range': self.range_agg,
-            'date_range': self.date_range_agg,
-            'ip_range': self.ip_range_agg,
-            'histogram': self.histogram_agg,
-            'date_histogram': self.date_histogram_agg,
-            'geo_distance': self.geo_distance_agg,
-            'geohash_grid': self.geohash_grid_agg
-        }
-
     def _parse_aggregation(self, name, obj, index=None, document=None, field=None):
         """Parse the given aggregation. Raises ElasticSearchError if it is unknown."""
         try:
-            return self._parsers[name](obj, index, document, field)
+            return self._parsers[name](self, obj, index, document, field)
         except KeyError:
             raise ElasticSearchError('Unknown aggregation "{0}"'.format(name))
 
@@ -1304,16 +1453,21 @@ class AggregationParser(object):
         Raises ElasticSearchError in case they are malformed.
 
         """
-        if not isinstance(obj, dict):
-            raise ElasticSearchError('Invalid JSON object "{0!r}"'.format(obj))
+        stack = [(obj, (index, document, field))]
+        while stack:
+            obj, context = stack.pop()
+            if not isinstance(obj, dict):
+                raise ElasticSearchError('Invalid JSON object "{0!r}"'.format(obj))
 
-        current_context = (index, document, field)
-        for agg_body in obj.itervalues():
-            new_context = self._parse_aggregation(*self._read_aggregation(agg_body),
-                                                  index=index, document=document, field=field)
+            nested = []
+            for agg_body in obj.itervalues():
+                new_context = self._parse_aggregation(*self._read_aggregation(agg_body),
+                                                      index=context[0], document=context[1], field=context[2])
 
-            if 'aggs' in agg_body or 'aggregations' in agg_body:
-                self.aggregations(agg_body.get('aggs', agg_body.get('aggregations')), *(new_context or current_context))
+                if 'aggs' in agg_body or 'aggregations' in agg_body:
+                    nested.append((agg_body.get('aggs', agg_body.get('aggregations')), new_context or context))
+
+            stack.extend(reversed(nested))
 
     def min_agg(self, obj, index=None, document=None, field=None):
         """Parse the given min aggregation. Raises ElasticSearchError in case it is malformed."""
@@ -1667,6 +1821,41 @@ class AggregationParser(object):
             self.fields.add((index, document, field))
             return index, document, field
 
+    # Built once, the parsers are called with the instance as first argument
+    _parsers = {
+            'aggregations': aggregations,
+            'aggs': aggregations,
+            'min': min_agg,
+            'max': max_agg,
+            'sum': sum_agg,
+            'avg': avg_agg,
+            'stats': stats_agg,
+            'extended_stats': extended_stats_agg,
+            'value_count': value_count_agg,
+            'percentiles': percentiles_agg,
+            'percentile_ranks': percentile_ranks_agg,
+            'cardinality': cardinality_agg,
+            'geo_bounds': geo_bounds_agg,
+            'top_hits': top_hits_agg,
+            'scripted_metric': scripted_metric_agg,
+            'global': global_agg,
+            'filter': filter_agg,
+            'filters': filters_agg,
+            'missing': missing_agg,
+            'nested': nested_agg,
+            'reverse_nested': reverse_nested_agg,
+            'children': children_agg,
+            'terms': terms_agg,
+            'significant_terms': significant_terms_agg,
+            'range': range_agg,
+            'date_range': date_range_agg,
+            'ip_range': ip_range_agg,
+            'histogram': histogram_agg,
+            'date_histogram': date_histogram_agg,
+            'geo_distance': geo_distance_agg,
+            'geohash_grid': geohash_grid_agg
+        }
+
 
 class HighlightParser(object):
     """HighlightParser object to parse Elasticsearch highlight definitions.
@@ -2255,3 +2444,46 @@ class FieldsFilter(object):
             fields.append('_source')
 
         return fields[0] if len(fields) == 1 else fields
+
+
+def _extend_timeout(timeout, value, maximum):
+    """Return the given timeout extended by the given time value, but by not more than the given maximum.
+    Values which are invalid or not positive are ignored. It's up to Elasticsearch to complain about them.
+
+    """
+    try:
+        extension = parse_time_value(value)
+    except ValueError:
+        return timeout
+
+    if not extension > 0:  # Also true if it's not a number
+        return timeout
+
+    return timeout + min(extension, maximum)
+
+
+class _HedgedRequest(object):
+    """The state of a request which may be sent to another node as well. Attributes must only be altered
+    while holding the lock, except for the connection, which is set by the thread sending the first request.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = Queue()  # Of the hedge, None if it failed
+        self.connection = None  # Of the first request
+        self.finished = False  # Whether the first request is finished
+        self.dispatched = False  # Whether the hedge has been sent
+        self.responded = False  # Whether either request's response has been taken
+        self.interrupted = False  # Whether the first request has been interrupted by the hedge
+
+    def watch(self, connection):
+        self.connection = connection
+
+    def interrupt(self):
+        """Interrupt the first request by shutting down its connection."""
+        self.interrupted = True
+        try:
+            self.connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error):
+            pass  # Not connected yet or closed already, its response is closed once received
@@ -0,0 +1,205 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import threading
+import time
+from collections import deque
+
+import requests
+
+from elasticarmor.util import format_elasticsearch_error
+from elasticarmor.util.mixins import LoggingAware
+
+__all__ = ['CircuitBreaker', 'HealthChecker', 'RetryBudget']
+
+FAILURE_WINDOW = 10  # The number of most recent requests of which the failure rate is calculated
+FAILURE_RATE = 0.5  # The rate of failed requests at which a circuit opens..
+MIN_FAILURES = 2  # ..if at least this many requests failed
+LATENCY_OUTLIER_FACTOR = 5  # How many times slower than the median a node needs to be to be considered an outlier
+MIN_OUTLIER_LATENCY = 1  # Seconds, nodes responding faster than this are never considered to be an outlier
+
+
+class CircuitBreaker(LoggingAware, object):
+    """Decides whether requests may be sent to a node, based on the outcome of previous requests and health checks.
+
+    A circuit is closed as long as the node is healthy. It opens once too many of the recent requests failed or
+    if a health check fails, and no requests are sent to the node anymore. Once a health check succeeds again,
+    the circuit is half-open and a single trial request is sent to the node. It closes if that one succeeds.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, node):
+        self.node = node
+        self.state = self.CLOSED
+        self.reason = None
+        self.since = time.time()
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=FAILURE_WINDOW)
+        self._trial = False
+
+    def acquire(self):
+        """Return whether a request may be sent to the node. The caller is
+        required to report the outcome by calling record() or cancel().
+
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            elif self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+
+            return False
+
+    def record(self, success):
+        """Record the outcome of a request sent to the node."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial = False
+                if success:
+                    self._change_state(self.CLOSED, 'Trial request succeeded')
+                else:
+                    self._change_state(self.OPEN, 'Trial request failed')
+            elif self.state == self.CLOSED:
+                self._outcomes.append(success)
+                failures = sum(1 for outcome in self._outcomes if not outcome)
+                if not success and failures >= MIN_FAILURES and failures >= FAILURE_RATE * len(self._outcomes):
+                    self._change_state(self.OPEN, '{0} of the last {1} requests failed'.format(
+                        failures, len(self._outcomes)))
+
+    def cancel(self):
+        """Withdraw a request for which acquire() has been called, without recording its outcome."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial = False
+
+    def trip(self, reason):
+        """Open the circuit for the given reason."""
+        with self._lock:
+            if self.state != self.OPEN:
+                self._change_state(self.OPEN, reason)
+
+    def probe(self):
+        """Report a successful health check. Half-opens the circuit if it's open."""
+        with self._lock:
+            if self.state == self.OPEN:
+                self._change_state(self.HALF_OPEN, 'Health check succeeded')
+
+    def _change_state(self, state, reason):
+        if state == self.OPEN:
+            self.log.warning('Node "%s" is unavailable. Reason: %s', self.node, reason)
+        elif state == self.CLOSED:
+            self.log.info('Node "%s" is available again.', self.node)
+        else:
+            self.log.debug('Node "%s" is about to be tried again.', self.node)
+
+        self.state = state
+        self.reason = reason if state != self.CLOSED else None
+        self.since = time.time()
+        self._outcomes.clear()
+
+
+class RetryBudget(object):
+    """Limits how many requests may be retried on another node or hedged, to avoid retry storms.
+
+    Every request deposits the given ratio of a retry and every retry withdraws an entire one. In addition,
+    the given minimum of retries per second is always permitted, so that retries are possible at low rates.
+    Not more retries than the minimum are saved up, so that a burst of retries is never larger than that.
+    """
+
+    def __init__(self, ratio, minimum):
+        self.ratio = ratio
+        self.minimum = minimum
+
+        self._lock = threading.Lock()
+        self._balance = float(max(minimum, 1))
+        self._updated = time.time()
+
+    def deposit(self):
+        """Register a request."""
+        with self._lock:
+            self._refill()
+            self._balance = min(self._balance + self.ratio, max(self.minimum, 1))
+
+    def withdraw(self):
+        """Return whether a retry is permitted and register it if so."""
+        with self._lock:
+            self._refill()
+            if self._balance < 1:
+                return False
+
+            self._balance -= 1
+            return True
+
+    def _refill(self):
+        now = time.time()
+        self._balance = min(self._balance + (now - self._updated) * self.minimum, max(self.minimum, 1))
+        self._updated = now
+
+
+class HealthChecker(LoggingAware, object):
+    """Checks the health of the nodes of the given connection in a separate thread, every time the given
+    interval has passed. A node is considered unhealthy if it does not respond within the given timeout
+    or if its average response time is an outlier compared to the other nodes.
+
+    """
+
+    def __init__(self, connection, interval, timeout):
+        self.connection = connection
+        self.interval = interval
+        self.timeout = timeout
+
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start checking the health of the nodes."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='HealthChecker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop checking the health of the nodes."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def check(self):
+        """Check the health of all nodes."""
+        for node in self.connection.nodes:
+            try:
+                requests.head(node, timeout=self.timeout).raise_for_status()
+            except requests.RequestException as error:
+                self.connection.breakers[node].trip(
+                    'Health check failed. Error: {0}'.format(format_elasticsearch_error(error)))
+            else:
+                self.connection.breakers[node].probe()
+
+        latencies = {}
+        for node in self.connection.nodes:
+            latency = self.connection.balancer.latency(node)
+            if latency is not None and self.connection.breakers[node].state == CircuitBreaker.CLOSED:
+                latencies[node] = latency
+
+        if len(latencies) > 2:
+            median = sorted(latencies.values())[len(latencies) // 2]
+            for node, latency in latencies.iteritems():
+                if latency > MIN_OUTLIER_LATENCY and latency > LATENCY_OUTLIER_FACTOR * median:
+                    self.connection.balancer.reset(node)  # Otherwise the node is an outlier again once it's closed
+                    self.connection.breakers[node].trip('Average response time of {0:.2f}s exceeds {1} times'
+                                                        ' the median'.format(latency, LATENCY_OUTLIER_FACTOR))
+
+    def _run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.is_set():
+                break
+
+            try:
+                self.check()
+            except Exception:
+                self.log.exception('An unexpected error occurred while checking the health of the nodes.')
@@ -1,8 +1,10 @@
 # ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
 
 import httplib
+import socket
 import urllib
 import urlparse
+import zlib
 import cStringIO
 
 try:
@@ -14,10 +16,13 @@ except ImportError:
 
 from requests.structures import CaseInsensitiveDict
 
-__all__ = ['prepare_chunk', 'close_chunks', 'trailer_chunks', 'read_chunked_content', 'ChunkParserError',
-           'RequestEntityTooLarge', 'HttpHeaders', 'HttpContext', 'WsgiErrorLog', 'Query']
+__all__ = ['CONTENT_CODINGS', 'prepare_chunk', 'close_chunks', 'trailer_chunks', 'read_chunked_content',
+           'iter_chunked_content', 'accepts_content_coding', 'decode_content', 'encode_content',
+           'ChunkParserError', 'RequestEntityTooLarge', 'LimitedReader', 'ChunkedReader', 'ResponseReader',
+           'LineReader', 'StreamedPayload', 'HttpHeaders', 'HttpContext', 'WsgiErrorLog', 'Query']
 
 CRLF = '\r\n'
+CONTENT_CODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}  # Mapped to zlib's window size argument
 
 
 def prepare_chunk(data):
@@ -37,7 +42,15 @@ def trailer_chunks(trailers):
 
 def read_chunked_content(in_file, limit=None):
     """Read from the given file-like object until no chunked content is left and return it."""
-    content = ''
+    return ''.join(iter_chunked_content(in_file, limit))
+
+
+def iter_chunked_content(in_file, limit=None, max_size=None):
+    """Read from the given file-like object until no chunked content is left and yield it chunk by chunk.
+    Chunks larger than the given maximum size are split up and yielded piece by piece.
+
+    """
+    received = 0
     while True:
         chunk_size = in_file.readline()
         if chunk_size:
@@ -46,20 +59,24 @@ def read_chunked_content(in_file, limit=None):
             except ValueError:
                 raise ChunkParserError('Got invalid chunk-size "{0!r}"'.format(chunk_size))
 
-            if limit and len(content) + size > limit:
+            if limit and received + size > limit:
                 raise RequestEntityTooLarge('Content length limit of {0} bytes exceeded'.format(limit))
-
-            data = in_file.read(size)
-            if len(data) == size:
-                if size == 0:
-                    break
-
-                content += data
-                crlf = in_file.readline()
-                if crlf not in CRLF:
-                    raise ChunkParserError('Expected CRLF. Got {0!r} instead.'.format(crlf))
-            else:
-                raise ChunkParserError('Got incomplete chunk. ({0:d} != {1:d})'.format(len(data), size))
+            elif size == 0:
+                break
+
+            remaining = size
+            while remaining > 0:
+                data = in_file.read(min(remaining, max_size) if max_size else remaining)
+                if not data:
+                    raise ChunkParserError('Got incomplete chunk. ({0:d} != {1:d})'.format(size - remaining, size))
+
+                remaining -= len(data)
+                yield data
+
+            received += size
+            crlf = in_file.readline()
+            if crlf not in CRLF:
+                raise ChunkParserError('Expected CRLF. Got {0!r} instead.'.format(crlf))
         else:
             raise ChunkParserError('Expected chunk-size. Got nothing.')
 
@@ -68,19 +85,244 @@ def read_chunked_content(in_file, limit=None):
         trailer_line = in_file.readline()
         # Discard any trailers, we cannot handle them anyway..
 
-    return content
+
+def accepts_content_coding(accept_encoding, coding):
+    """Return whether the given value of an Accept-Encoding header permits the given content-coding."""
+    qualities = {}
+    for part in accept_encoding.split(','):
+        name, _, parameters = part.partition(';')
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            key, _, value = parameter.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        qualities[name.strip().lower()] = quality
+
+    return qualities.get(coding, qualities.get('*', 0.0)) > 0
+
+
+def decode_content(stream, coding):
+    """Decompress the data of the given iterable, which is encoded with the given content-coding, and yield
+    the result piece by piece. Only the compressor's window is buffered, not the entire content.
+
+    """
+    decompressor = zlib.decompressobj(CONTENT_CODINGS[coding])
+    for data in stream:
+        data = decompressor.decompress(data)
+        if data:
+            yield data
+
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def encode_content(stream, coding, level=6):
+    """Compress the data of the given iterable with the given content-coding and yield the result piece by piece.
+    The compression level ranges from 1 to 9, with 1 being the fastest and 9 yielding the best compression.
+
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, CONTENT_CODINGS[coding])
+    for data in stream:
+        data = compressor.compress(data)
+        if data:
+            yield data
+
+    yield compressor.flush()
 
 
 class ChunkParserError(Exception):
-    """Raised by function read_chunked_content() in case of a parsing error."""
+    """Raised by function iter_chunked_content() in case of a parsing error."""
     pass
 
 
 class RequestEntityTooLarge(Exception):
-    """Raised by function read_chunked_content() in case the buffer size limit has been exceeded."""
+    """Raised by function iter_chunked_content() in case the buffer size limit has been exceeded."""
     pass
 
 
+class LimitedReader(object):
+    """File-like object which reads not more than the given number of bytes from the given file-like object.
+
+    Any error raised while reading is remembered, so that it can be told apart from other errors later on.
+    """
+
+    def __init__(self, in_file, length, chunk_size=2**16):
+        self.length = length
+        self.chunk_size = chunk_size
+
+        self.consumed = 0
+        self.error = None
+        self._in_file = in_file
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        data = self.read(self.chunk_size)
+        while data:
+            yield data
+            data = self.read(self.chunk_size)
+
+    def read(self, size=-1):
+        remaining = self.length - self.consumed
+        if size < 0 or size > remaining:
+            size = remaining
+
+        if not size:
+            return ''
+
+        try:
+            data = self._in_file.read(size)
+            if not data:
+                raise socket.error('Connection closed with {0:d} bytes of the payload remaining'.format(remaining))
+        except socket.error as error:
+            self.error = error
+            raise
+
+        self.consumed += len(data)
+        return data
+
+
+class ChunkedReader(object):
+    """Iterable which reads chunked content from the given file-like object and yields it chunk by chunk.
+
+    Any error raised while reading is remembered, so that it can be told apart from other errors later on.
+    """
+
+    def __init__(self, in_file, chunk_size=2**16):
+        self.chunk_size = chunk_size
+
+        self.consumed = 0
+        self.error = None
+        self._in_file = in_file
+
+    def __iter__(self):
+        try:
+            for data in iter_chunked_content(self._in_file, max_size=self.chunk_size):
+                self.consumed += len(data)
+                yield data
+        except (socket.error, ChunkParserError) as error:
+            self.error = error
+            raise
+
+
+class ResponseReader(object):
+    """Iterable which reads the raw payload of the given urllib3 response and yields it chunk by chunk.
+
+    Chunked payloads are yielded as received, unless a chunk exceeds the given maximum size. Otherwise
+    the size of the chunks read starts at the given minimum and is doubled each time a chunk is read
+    entirely, until it reaches the maximum. Small payloads are therefore not read into large buffers,
+    while large ones are transferred with as few reads and writes as possible.
+    """
+
+    def __init__(self, response, min_chunk_size=2**14, max_chunk_size=2**18):
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+
+        self._response = response
+
+    def __iter__(self):
+        if getattr(self._response, 'chunked', False):
+            for data in self._response.stream(self.max_chunk_size, decode_content=False):
+                yield data
+        else:
+            chunk_size = self.min_chunk_size
+            data = self._response.read(chunk_size, decode_content=False)
+            while data:
+                yield data
+                if len(data) == chunk_size:
+                    chunk_size = min(chunk_size * 2, self.max_chunk_size)
+
+                data = self._response.read(chunk_size, decode_content=False)
+
+
+class LineReader(object):
+    """Reads lines from the given iterable of strings. A line is either returned entirely
+    or yielded piece by piece, so that not more than a single line needs to be buffered.
+
+    """
+
+    def __init__(self, iterable):
+        self.line_no = 0
+        self._iterator = iter(iterable)
+        self._buffer = ''
+        self._offset = 0
+
+    def readline(self, limit=None):
+        """Return the next line including its terminator or an empty string if there are no lines left.
+        Raises RequestEntityTooLarge if the line is longer than the given limit.
+
+        """
+        parts, size = [], 0
+        for part in self.iter_line():
+            size += len(part)
+            if limit and size > limit:
+                raise RequestEntityTooLarge('Line length limit of {0} bytes exceeded at line #{1}'
+                                            ''.format(limit, self.line_no + 1))
+
+            parts.append(part)
+
+        return ''.join(parts)
+
+    def iter_line(self):
+        """Yield the next line piece by piece. The last piece includes the line terminator."""
+        while True:
+            end = self._buffer.find('\n', self._offset)
+            if end >= 0:
+                piece, self._offset = self._buffer[self._offset:end + 1], end + 1
+                self.line_no += 1
+                yield piece
+                break
+
+            piece = self._buffer[self._offset:]
+            self._buffer, self._offset = next(self._iterator, ''), 0
+            if piece:
+                if not self._buffer:
+                    self.line_no += 1  # It's the last line and it's not terminated
+
+                yield piece
+            elif not self._buffer:
+                break
+
+
+class StreamedPayload(object):
+    """Iterable which yields the data of the given iterable in chunks of roughly the given size.
+
+    The given source is the stream the data originates from. Like LimitedReader and ChunkedReader
+    this provides the number of bytes yielded so far and any error which occurred on the source.
+    """
+
+    def __init__(self, iterable, source, chunk_size=2**16):
+        self.chunk_size = chunk_size
+
+        self.consumed = 0
+        self._iterable = iterable
+        self._source = source
+
+    @property
+    def error(self):
+        return getattr(self._source, 'error', None)
+
+    def __iter__(self):
+        parts, size = [], 0
+        for data in self._iterable:
+            parts.append(data)
+            size += len(data)
+            if size >= self.chunk_size:
+                self.consumed += size
+                yield ''.join(parts)
+                parts, size = [], 0
+
+        if parts:
+            self.consumed += size
+            yield ''.join(parts)
+
+
 class HttpHeaders(httplib.HTTPMessage):
     """HttpHeaders parser and container.
 
@@ -0,0 +1,282 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import bisect
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from contextlib import contextmanager
+
+from elasticarmor.util.mixins import LoggingAware
+
+__all__ = ['MetricsRegistry', 'Counter', 'Histogram', 'Callback', 'MetricsServer', 'registry']
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)  # Seconds
+MAX_SHARDS = 64  # The number of threads with values of their own, after which those of finished threads are merged
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsRegistry(object):
+    """A collection of metrics which can be rendered in Prometheus' text exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        """Register the given metric. Replaces any other metric with the same name."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def unregister(self, name):
+        """Remove the metric with the given name."""
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        """Return the current values of all metrics in Prometheus' text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.itervalues(), key=lambda m: m.name)
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.description))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+            for suffix, labels, value in metric.collect():
+                lines.append('{0}{1}{2} {3}'.format(metric.name, suffix, _format_labels(labels), _format_value(value)))
+
+        lines.append('')
+        return '\n'.join(lines)
+
+
+registry = MetricsRegistry()
+
+
+class _Metric(object):
+    """Base class for metrics which are recorded by the application.
+
+    Values are recorded per thread, so that threads do not need to wait for each other. Only when the metric
+    is collected, the values of all threads are summed up. Values of finished threads are kept, of course.
+    """
+
+    type = None
+
+    def __init__(self, name, description, labels=(), registry=registry):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, values)
+        self._retired = {}  # The values of finished threads
+
+        if registry is not None:
+            registry.register(self)
+
+    def _get_values(self):
+        """Return the values of the current thread."""
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+                if len(self._shards) > MAX_SHARDS:
+                    self._retire_shards()
+
+            return values
+
+    def _retire_shards(self):
+        shards = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                shards.append((thread, values))
+            else:
+                for key, value in values.iteritems():
+                    self._merge(self._retired, key, value)
+
+        self._shards = shards
+
+    def _snapshot(self):
+        """Return the summed up values of all threads."""
+        with self._lock:
+            self._retire_shards()
+            result = {}
+            for key, value in self._retired.iteritems():
+                self._merge(result, key, value)
+            for _, values in self._shards:
+                for key, value in values.items():  # A copy, as the thread may add new keys meanwhile
+                    self._merge(result, key, value)
+
+        return result
+
+    def _merge(self, values, key, value):
+        raise NotImplementedError()
+
+    def collect(self):
+        """Return a list of tuples of a suffix for the name, a dictionary of labels and a value."""
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    """A value which only increases, such as the number of processed requests."""
+
+    type = 'counter'
+
+    def inc(self, *label_values):
+        """Increment the value for the given labels by one."""
+        values = self._get_values()
+        values[label_values] = values.get(label_values, 0) + 1
+
+    def add(self, amount, *label_values):
+        """Increment the value for the given labels by the given amount."""
+        values = self._get_values()
+        values[label_values] = values.get(label_values, 0) + amount
+
+    def _merge(self, values, key, value):
+        values[key] = values.get(key, 0) + value
+
+    def collect(self):
+        return [('', dict(zip(self.labels, key)), value) for key, value in sorted(self._snapshot().iteritems())]
+
+
+class Histogram(_Metric):
+    """Counts observations, such as response times, in buckets of the given upper bounds."""
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS, registry=registry):
+        super(Histogram, self).__init__(name, description, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        """Register the given value for the given labels."""
+        values = self._get_values()
+        try:
+            counts = values[label_values]
+        except KeyError:
+            counts = values[label_values] = [0] * (len(self.buckets) + 2)  # Buckets, +Inf and the sum
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """Context manager to observe the time it takes to execute the context."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, *label_values)
+
+    def _merge(self, values, key, value):
+        try:
+            counts = values[key]
+        except KeyError:
+            values[key] = list(value)
+        else:
+            for i, count in enumerate(value):
+                counts[i] += count
+
+    def collect(self):
+        samples = []
+        for key, counts in sorted(self._snapshot().iteritems()):
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append(('_bucket', dict(labels, le=bound), cumulative))
+
+            samples.append(('_sum', labels, counts[-1]))
+            samples.append(('_count', labels, cumulative))
+
+        return samples
+
+
+class Callback(object):
+    """A metric whose values are provided by the given function once it's collected. The function either returns
+    a single value or a dictionary of tuples of label values and their value. Values may be of any type.
+
+    """
+
+    def __init__(self, name, description, func, labels=(), metric_type='gauge', registry=registry):
+        self.name = name
+        self.description = description
+        self.func = func
+        self.labels = tuple(labels)
+        self.type = metric_type
+
+        if registry is not None:
+            registry.register(self)
+
+    def collect(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            return [('', {}, values)]
+
+        return [('', dict(zip(self.labels, key)), value) for key, value in sorted(values.iteritems())]
+
+
+class MetricsServer(LoggingAware, HTTPServer):
+    """Serves the metrics of the given registry at /metrics on the given address and port, in a separate thread."""
+
+    def __init__(self, address, port, registry=registry):
+        HTTPServer.__init__(self, (address, port), _MetricsRequestHandler, bind_and_activate=False)
+        self.registry = registry
+        self._thread = None
+
+    def start(self):
+        """Start serving requests."""
+        self.server_bind()
+        self.server_activate()
+        self._thread = threading.Thread(target=self.serve_forever, name='MetricsServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving requests."""
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+
+        self.server_close()
+
+
+class _MetricsRequestHandler(LoggingAware, BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        content = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        self.log.debug('Metrics request from "%s": ' + format, self.client_address[0], *args)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value)) for name, value in sorted(labels.iteritems())) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    elif isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+def _escape(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
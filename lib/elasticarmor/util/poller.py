@@ -0,0 +1,161 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import errno
+import os
+import select
+import threading
+import time
+
+try:
+    # Python 2.7+
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from simplejson import OrderedDict
+
+from elasticarmor.util.mixins import LoggingAware
+
+__all__ = ['ConnectionPoller']
+
+
+class ConnectionPoller(LoggingAware, object):
+    """Watches idle connections in a single thread and reports once they become readable or
+    once they have been idle for too long. A connection is watched only until it's reported.
+
+    """
+
+    def __init__(self, on_readable, on_timeout, idle_timeout):
+        self.on_readable = on_readable
+        self.on_timeout = on_timeout
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        self._connections = OrderedDict()  # fd -> (connection, deadline), ordered by deadline
+        self._stopped = threading.Event()
+        self._thread = None
+        self._poll = None
+        self._wakeup = None
+
+    @property
+    def watched(self):
+        """The number of connections currently being watched."""
+        return len(self._connections)
+
+    def start(self):
+        """Start watching connections."""
+        self._stopped.clear()
+        self._poll = _create_poll()
+        self._wakeup = os.pipe()
+        self._poll.register(self._wakeup[0], select.POLLIN)
+        self._thread = threading.Thread(target=self._run, name='ConnectionPoller')
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching connections and return all which have not been reported yet."""
+        self._stopped.set()
+        os.write(self._wakeup[1], '.')
+        self._thread.join()
+
+        with self._lock:
+            connections = [connection for connection, _ in self._connections.itervalues()]
+            self._connections.clear()
+
+        self._poll.close()
+        for fd in self._wakeup:
+            os.close(fd)
+
+        return connections
+
+    def watch(self, fd, connection):
+        """Watch the given connection by its file descriptor.
+
+        Returns False if the poller is not running, in which case the connection is not watched.
+        """
+        with self._lock:
+            if self._stopped.is_set():
+                return False
+
+            self._connections[fd] = (connection, time.time() + self.idle_timeout)
+            self._poll.register(fd, select.POLLIN | select.POLLPRI)
+
+        os.write(self._wakeup[1], '.')  # Required as not all implementations recognize new registrations
+        return True
+
+    def _forget(self, fd):
+        with self._lock:
+            connection, _ = self._connections.pop(fd, (None, None))
+            if connection is not None:
+                self._poll.unregister(fd)
+
+        return connection
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                try:
+                    _, (_, deadline) = next(self._connections.iteritems())
+                except StopIteration:
+                    timeout = self.idle_timeout
+                else:
+                    timeout = max(0, deadline - time.time())
+
+            try:
+                events = self._poll.poll(timeout)
+            except (IOError, OSError, select.error) as error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, _ in events:
+                if fd == self._wakeup[0]:
+                    os.read(fd, 4096)
+                    continue
+
+                connection = self._forget(fd)
+                if connection is not None:
+                    self.on_readable(connection)
+
+            now = time.time()
+            while True:
+                with self._lock:
+                    try:
+                        fd, (_, deadline) = next(self._connections.iteritems())
+                    except StopIteration:
+                        break
+
+                if deadline > now:
+                    break
+
+                connection = self._forget(fd)
+                if connection is not None:
+                    self.on_timeout(connection)
+
+
+def _create_poll():
+    """Return the most efficient polling object available on this platform. Its poll
+    method accepts a timeout in seconds, just like the one of select.epoll.
+
+    """
+    try:
+        return select.epoll()
+    except AttributeError:
+        return _Poll()
+
+
+class _Poll(object):
+    """Wrapper for select.poll which provides the same interface as select.epoll."""
+
+    def __init__(self):
+        self._poll = select.poll()
+
+    def register(self, fd, eventmask):
+        self._poll.register(fd, eventmask)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        return self._poll.poll(timeout * 1000)
+
+    def close(self):
+        pass
@@ -0,0 +1,117 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import threading
+import time
+from contextlib import contextmanager
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.poolmanager import PoolManager, SSL_KEYWORDS
+
+__all__ = ['PooledHttpAdapter', 'watch_connections']
+
+
+class _PoolLimits(object):
+    """Mixin for urllib3's connection pools which retires connections once they have
+    been idle for too long or once they have served a particular number of requests.
+
+    """
+
+    idle_timeout = None
+    request_limit = None
+
+    def _get_conn(self, timeout=None):
+        conn = super(_PoolLimits, self)._get_conn(timeout)
+        if getattr(conn, 'sock', None) is not None:
+            served_requests = getattr(conn, '_served_requests', 0)
+            idle_since = getattr(conn, '_idle_since', None)
+            if self.request_limit and served_requests >= self.request_limit:
+                conn.close()
+                conn._served_requests = 0
+            elif self.idle_timeout and idle_since is not None and time.time() - idle_since > self.idle_timeout:
+                conn.close()
+                conn._served_requests = 0
+
+        callback = getattr(_watchers, 'callback', None)
+        if callback is not None:
+            callback(conn)
+
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn._served_requests = getattr(conn, '_served_requests', 0) + 1
+            conn._idle_since = time.time()
+
+        super(_PoolLimits, self)._put_conn(conn)
+
+
+class _HttpConnectionPool(_PoolLimits, HTTPConnectionPool):
+    pass
+
+
+class _HttpsConnectionPool(_PoolLimits, HTTPSConnectionPool):
+    pass
+
+
+class _PoolManager(PoolManager):
+    """PoolManager which creates connection pools that are aware of our connection limits."""
+
+    pool_classes = {
+        'http': _HttpConnectionPool,
+        'https': _HttpsConnectionPool
+    }
+
+    def __init__(self, idle_timeout, request_limit, *args, **kwargs):
+        PoolManager.__init__(self, *args, **kwargs)
+        self.idle_timeout = idle_timeout
+        self.request_limit = request_limit
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        if request_context is None:
+            request_context = self.connection_pool_kw.copy()
+
+        for key in ('scheme', 'host', 'port'):
+            request_context.pop(key, None)
+
+        if scheme == 'http':
+            for keyword in SSL_KEYWORDS:
+                request_context.pop(keyword, None)
+
+        pool = self.pool_classes[scheme](host, port, **request_context)
+        pool.idle_timeout = self.idle_timeout
+        pool.request_limit = self.request_limit
+        return pool
+
+
+class PooledHttpAdapter(HTTPAdapter):
+    """Transport adapter which keeps a pool of persistent connections for each Elasticsearch node.
+
+    It is safe to share a single instance of this adapter among multiple threads.
+    """
+
+    def __init__(self, nodes, pool_size, idle_timeout=None, request_limit=None):
+        self.idle_timeout = idle_timeout
+        self.request_limit = request_limit
+        super(PooledHttpAdapter, self).__init__(pool_connections=len(nodes), pool_maxsize=pool_size)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+
+        self.poolmanager = _PoolManager(self.idle_timeout, self.request_limit, num_pools=connections,
+                                        maxsize=maxsize, block=block, strict=True, **pool_kwargs)
+
+
+@contextmanager
+def watch_connections(callback):
+    """Call the given function with each connection the current thread takes from a pool in this context."""
+    _watchers.callback = callback
+    try:
+        yield
+    finally:
+        _watchers.callback = None
+
+
+_watchers = threading.local()
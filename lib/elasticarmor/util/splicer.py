@@ -0,0 +1,175 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import re
+from collections import deque
+
+__all__ = ['splice_json_array', 'JsonArraySplicer']
+
+_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*(")?|[][{}:,]')
+_NESTED = re.compile(r'(?:[^][{}"]+|"(?:[^"\\]|\\.)*")*')  # Anything but brackets and incomplete strings
+
+def splice_json_array(stream, key, elements, overrides=None):
+    """Insert the given elements into the array with the given key of the JSON object in the given
+    stream and yield the result chunk by chunk. Please see JsonArraySplicer for further details.
+
+    """
+    splicer = JsonArraySplicer(key, elements, overrides)
+    for chunk in stream:
+        data = splicer.feed(chunk)
+        if data:
+            yield data
+
+    data = splicer.close()
+    if data:
+        yield data
+
+
+class JsonArraySplicer(object):
+    """Inserts elements into an array of a JSON object while the object is being received piece by piece.
+
+    The array is identified by its key which is required to be a key of the outermost object. Elements
+    are passed as tuples of their position and JSON representation and are inserted in the order given.
+    Optionally, the scalar values of other keys of the outermost object can be replaced as well.
+
+    Only the structure of the document is tracked, hence not more than a few bytes are buffered at once.
+    Malformed documents are not detected, but passed through as is.
+    """
+
+    def __init__(self, key, elements, overrides=None):
+        self.key = '"{0}"'.format(key)
+        self.elements = deque(elements)
+        self.overrides = dict(('"{0}"'.format(k), v) for k, v in (overrides or {}).iteritems())
+
+        self._buffer = ''
+        self._offset = 0  # Where to continue scanning the buffer
+        self._depth = 0
+        self._string = None  # The last string found in the outermost object
+        self._key = None  # The key whose value is currently being received
+        self._pending = None  # The kind and position of text whose replacement is not yet decided
+        self._in_array = False
+        self._array_empty = False
+        self._position = 0  # The position of the array's current element
+
+    def feed(self, data):
+        """Feed the given data and return what is ready to be passed on."""
+        data = self._buffer + data
+        output, emitted, offset, length = [], 0, self._offset, len(data)
+        while offset < length:
+            if self._depth > 2 or (self._depth == 2 and not self._in_array):
+                # Only brackets are of interest here, so everything in between is skipped at once
+                offset = _NESTED.match(data, offset).end()
+                if offset == length or data[offset] == '"':
+                    break
+
+                emitted = self._process(data[offset], offset, offset + 1, data, emitted, output)
+                offset += 1
+                continue
+
+            match = _TOKENS.search(data, offset)
+            if match is None:
+                offset = length
+                break
+
+            token = match.group()
+            if token[0] != '"':
+                emitted = self._process(token, match.start(), match.end(), data, emitted, output)
+            elif match.group(1) is None:
+                offset = match.start()  # The string is not complete yet
+                break
+            else:
+                if self._pending is not None and self._pending[0] == 'array':
+                    emitted = self._open_array(data, emitted, output)
+
+                if self._depth == 1:
+                    self._string = token
+
+            offset = match.end()
+
+        held = self._pending[1] if self._pending is not None else offset
+        if held > emitted:
+            output.append(data[emitted:held])
+            emitted = held
+
+        self._buffer = data[emitted:]
+        self._offset = offset - emitted
+        if self._pending is not None:
+            self._pending = (self._pending[0], 0)
+
+        return ''.join(output)
+
+    def close(self):
+        """Return any remaining data."""
+        data, self._buffer = self._buffer, ''
+        return data
+
+    def _process(self, token, start, end, data, emitted, output):
+        if self._pending is not None:
+            kind, position = self._pending
+            if kind == 'array':
+                if token != ']' or data[position:start].strip():
+                    emitted = self._open_array(data, emitted, output)
+                else:
+                    self._pending = None
+                    self._array_empty = True
+            elif token in '{[':
+                self._pending = None  # Only scalar values are replaced
+            elif self._depth == 1:
+                self._pending = None
+                value = data[position:start]
+                output.append(data[emitted:position])
+                output.append(value[:len(value) - len(value.lstrip())])
+                output.append(self.overrides[self._key])
+                output.append(value[len(value.rstrip()):])
+                emitted = start
+
+        if token == ':':
+            if self._depth == 1:
+                self._key = self._string
+                if self._key in self.overrides:
+                    self._pending = ('value', end)
+        elif token == ',':
+            if self._in_array and self._depth == 2:
+                self._position += 1
+                output.append(data[emitted:end])
+                emitted = end
+                while self.elements and self.elements[0][0] <= self._position:
+                    output.append(self.elements.popleft()[1])
+                    output.append(',')
+                    self._position += 1
+        elif token in '{[':
+            if token == '[' and self._depth == 1 and self._key == self.key and self.elements:
+                self._in_array = True
+                self._pending = ('array', end)
+
+            self._depth += 1
+        else:
+            self._depth -= 1
+            if self._in_array and self._depth == 1:
+                self._in_array = False
+                if not self._array_empty:
+                    self._position += 1
+
+                preceding = data[emitted:start].rstrip()
+                output.append(preceding)
+                emitted += len(preceding)
+                while self.elements:
+                    if self._position:
+                        output.append(',')
+
+                    output.append(self.elements.popleft()[1])
+                    self._position += 1
+
+        return emitted
+
+    def _open_array(self, data, emitted, output):
+        """Insert the elements which precede the first element of the array."""
+        position = self._pending[1]
+        self._pending = None
+
+        output.append(data[emitted:position])
+        while self.elements and self.elements[0][0] <= self._position:
+            output.append(self.elements.popleft()[1])
+            output.append(',')
+            self._position += 1
+
+        return position
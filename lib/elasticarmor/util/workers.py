@@ -0,0 +1,196 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import heapq
+import sys
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+from elasticarmor.util.mixins import LoggingAware
+
+__all__ = ['WorkerPool', 'Scheduler', 'iter_batches']
+
+
+class WorkerPool(LoggingAware, object):
+    """A fixed number of threads processing tasks from a bounded queue."""
+
+    def __init__(self, size, queue_size, name='Worker', daemon=False):
+        self.size = size
+        self.name = name
+        self.daemon = daemon
+
+        self._queue = Queue(queue_size)
+        self._threads = []
+        self._busy = [False] * size  # Whether a worker is processing a task, set by the worker itself
+        self._lock = threading.Lock()
+        self._rejected = 0
+
+    @property
+    def queue_size(self):
+        """The maximum number of tasks waiting to be processed."""
+        return self._queue.maxsize
+
+    @property
+    def queue_depth(self):
+        """The current number of tasks waiting to be processed."""
+        return self._queue.qsize()
+
+    @property
+    def busy(self):
+        """The current number of workers processing a task."""
+        return sum(1 for busy in self._busy if busy)
+
+    @property
+    def running(self):
+        """Whether the worker threads have been started."""
+        return bool(self._threads)
+
+    @property
+    def rejected(self):
+        """The number of tasks which have been rejected because the queue was full."""
+        return self._rejected
+
+    def start(self):
+        """Start all worker threads."""
+        for i in range(self.size):
+            thread = threading.Thread(target=self._work, args=(i,), name='{0}-{1}'.format(self.name, i + 1))
+            thread.daemon = self.daemon
+            thread.start()
+            self._threads.append(thread)
+
+        self.log.debug('Started %u worker threads.', len(self._threads))
+
+    def submit(self, func, *args):
+        """Queue the given function to be called with the given arguments by the next free worker.
+        Returns False if the queue is full and the task has been rejected, otherwise True.
+
+        """
+        try:
+            self._queue.put_nowait((func, args))
+        except Full:
+            with self._lock:
+                self._rejected += 1
+
+            return False
+
+        return True
+
+    def shutdown(self):
+        """Process all remaining tasks and wait for the worker threads to finish."""
+        for _ in self._threads:
+            self._queue.put(None)
+
+        for thread in self._threads:
+            self.log.debug('Waiting for worker thread %s to finish...', thread.name)
+            thread.join()
+
+        del self._threads[:]
+
+    def _work(self, index):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+
+            func, args = task
+            del task  # Do not keep a reference to the last task while waiting for the next one
+
+            self._busy[index] = True
+            try:
+                func(*args)
+            except Exception:
+                self.log.error('Unhandled exception occurred in worker thread %s.',
+                               threading.current_thread().name, exc_info=True)
+            finally:
+                self._busy[index] = False
+                func = args = None
+                sys.exc_clear()
+
+
+class Scheduler(LoggingAware, object):
+    """Calls functions once a given delay has passed, in a single daemon thread.
+
+    The thread sleeps until the earliest deadline known when it went to sleep. Functions scheduled
+    meanwhile with an even earlier deadline are called late, so this is meant for delays that are
+    roughly the same for all functions. Functions are expected to be short, as they delay all others.
+    """
+
+    def __init__(self, name='Scheduler'):
+        self.name = name
+
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def call_later(self, delay, func, *args):
+        """Call the given function with the given arguments once the given number of seconds have passed."""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=self.name)
+                    self._thread.daemon = True
+                    self._thread.start()
+
+        self._queue.put((time.time() + delay, func, args))
+
+    def _run(self):
+        pending = []
+        while True:
+            if not pending:
+                heapq.heappush(pending, self._queue.get())
+
+            remaining = pending[0][0] - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+
+            try:
+                while True:
+                    heapq.heappush(pending, self._queue.get_nowait())
+            except Empty:
+                pass
+
+            now = time.time()
+            while pending and pending[0][0] <= now:
+                _, func, args = heapq.heappop(pending)
+                try:
+                    func(*args)
+                except Exception:
+                    self.log.error('Unhandled exception occurred in scheduler thread %s.', self.name, exc_info=True)
+                finally:
+                    func = args = None
+
+
+def iter_batches(queue, max_size):
+    """Take items from the given queue and yield them in lists of up to the given size, until None is taken.
+    Items queued after None are yielded as a last list, so that none of them is left behind unnoticed.
+
+    """
+    while True:
+        batch = [queue.get()]
+        try:
+            while len(batch) < max_size:
+                batch.append(queue.get_nowait())
+        except Empty:
+            pass
+
+        if None not in batch:
+            yield batch
+            continue
+
+        position = batch.index(None)
+        if position:
+            yield batch[:position]
+
+        remaining = [item for item in batch[position + 1:] if item is not None]
+        try:
+            while True:
+                item = queue.get_nowait()
+                if item is not None:
+                    remaining.append(item)
+        except Empty:
+            pass
+
+        if remaining:
+            yield remaining
+
+        return
@@ -0,0 +1,54 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from elasticarmor.util.accesslog import AccessLog
+
+
+class AccessLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'access.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_faulty_record_does_not_affect_others(self):
+        access_log = AccessLog(self.path)
+        access_log.write({'path': '/first'})
+        access_log.write({'path': '/second'})
+        access_log.write({'path': '/\xff'})  # Not valid UTF-8, cannot be serialized
+        access_log.write({'path': '/third'})
+        access_log.start()
+        access_log.stop()
+
+        with open(self.path) as f:
+            paths = [json.loads(line)['path'] for line in f]
+
+        self.assertEqual(paths, ['/first', '/second', '/third'])
+
+    def test_records_queued_after_the_sentinel_are_written(self):
+        access_log = AccessLog(self.path)
+        access_log.write({'path': '/before'})
+        access_log._queue.put(None)
+        access_log.write({'path': '/after'})
+
+        thread = threading.Thread(target=access_log._run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+        with open(self.path) as f:
+            paths = [json.loads(line)['path'] for line in f]
+
+        self.assertEqual(paths, ['/before', '/after'])
+
+
+if __name__ == '__main__':
+    unittest.main()
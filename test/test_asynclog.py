@@ -0,0 +1,51 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import logging
+import threading
+import unittest
+
+from elasticarmor.util.asynclog import AsyncLogHandler
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_record(message):
+    return logging.LogRecord('test', logging.ERROR, __file__, 1, message, None, None)
+
+
+class AsyncLogHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.target = CollectingHandler()
+        self.handler = AsyncLogHandler(self.target, 100)
+
+    def test_records_are_passed_to_the_target(self):
+        self.handler.start()
+        for message in ('one', 'two', 'three'):
+            self.handler.emit(make_record(message))
+
+        self.handler.stop()
+        self.assertEqual([r.getMessage() for r in self.target.records], ['one', 'two', 'three'])
+
+    def test_records_queued_after_the_sentinel_are_not_lost(self):
+        self.handler._queue.put(make_record('before'))
+        self.handler._queue.put(None)
+        self.handler._queue.put(make_record('after'))
+
+        thread = threading.Thread(target=self.handler._run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([r.getMessage() for r in self.target.records], ['before', 'after'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import threading
+import time
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import requests
+
+from elasticarmor.util.elastic import ElasticConnection
+
+
+class DelayedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        content = self.server.name
+        self.send_response(200)
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DelayedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, name, delay):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), DelayedHandler)
+        self.name = name
+        self.delay = delay
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_port)
+
+
+class HedgingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def start_server(self, name, delay):
+        server = DelayedServer(name, delay)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return server.url
+
+    def connect(self, *nodes):
+        connection = ElasticConnection(nodes, hedging=True)
+        connection._hedge_delay = 0.1
+        return connection
+
+    def test_no_thread_is_started_unless_a_request_is_hedged(self):
+        connection = self.connect(self.start_server('first', 0), self.start_server('second', 0))
+
+        started, start = [], threading.Thread.start
+        threading.Thread.start = lambda thread: (started.append(thread.name), start(thread))
+        try:
+            for _ in range(20):
+                self.assertEqual(connection.process(requests.Request('GET', '/')).content, 'first')
+        finally:
+            threading.Thread.start = start
+
+        self.assertEqual([name for name in started if name.startswith('Hedge')], ['HedgeScheduler'])
+        self.assertFalse(connection._hedge_workers.running)
+
+    def test_slow_request_is_interrupted_by_a_faster_hedge(self):
+        slow, fast = self.start_server('slow', 2), self.start_server('fast', 0)
+        connection = self.connect(slow, fast)
+
+        started = time.time()
+        self.assertEqual(connection.process(requests.Request('GET', '/')).content, 'fast')
+        self.assertLess(time.time() - started, 1)
+        self.assertTrue(connection._hedge_workers.running)
+        self.assertEqual(list(connection.breakers[slow]._outcomes), [])  # Being slow is not a failure
+
+
+if __name__ == '__main__':
+    unittest.main()
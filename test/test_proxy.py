@@ -0,0 +1,291 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import gzip
+import json
+import threading
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+import requests
+
+from elasticarmor import CONFIGURATION_INDEX
+from elasticarmor.auth.role import Role
+from elasticarmor.proxy import ElasticReverseProxy
+from elasticarmor.util.cache import Cache
+from elasticarmor.util.codec import JsonCodec
+from elasticarmor.util.elastic import ElasticConnection
+
+NODES_INFO = {'cluster_name': 'elasticsearch', 'nodes': {'abc': {'name': 'node-1', 'version': '2.4.0'}}}
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.received.append(self.path)
+        content = json.dumps(NODES_INFO)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if self.server.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for data in (content[:10], content[10:]):
+                self.wfile.write('{0:x}\r\n{1}\r\n'.format(len(data), data))
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])) if 'Content-Length' in self.headers \
+            else ''.join(self._read_chunks())
+        self.server.received.append(self.path)
+        self.server.payloads.append(body)
+        content = json.dumps({'took': 1, 'errors': False, 'items': [
+            {'index': {'status': 201}} for line in body.splitlines() if '"index"' in line]})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_chunks(self):
+        size = int(self.rfile.readline(), 16)
+        while size:
+            yield self.rfile.read(size)
+            self.rfile.readline()
+            size = int(self.rfile.readline(), 16)
+
+        self.rfile.readline()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeElasticsearch(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeElasticsearchHandler)
+        self.received = []
+        self.payloads = []
+        self.chunked = False
+
+
+class RoleBackend(object):
+    def __init__(self, role=None):
+        self.role_cache = Cache()
+        self.cleared = 0
+        self.role = role or Role('everything', {'cluster': ['*'], 'indices': [{'permissions': '*', 'include': '*'}]})
+
+    def get_role_memberships(self, client):
+        return [self.role]
+
+    def clear_cache(self):
+        self.cleared += 1
+
+
+class Options(object):
+    skip_index_initialization = True
+
+
+class Settings(object):
+    """The settings required by the proxy. Anonymous access is permitted for local clients."""
+
+    def __init__(self, node, **options):
+        self.elasticsearch = ElasticConnection([node])
+        self.allow_from = {'127.0.0.1': None}
+        self.trusted_proxies = {}
+        self.auth_backends = []
+        self.group_backends = []
+        self.role_backend = RoleBackend()
+        self.listen_address = '127.0.0.1'
+        self.listen_port = 0
+        self.secure_connection = False
+        self.options = Options()
+        self.engine = 'threaded'
+        self.worker_threads = 2
+        self.worker_queue_size = 8
+        self.json_codec = JsonCodec()
+        self.content_buffer_size = 2**16
+        self.compression_threshold = None
+        self.compression_level = 6
+        self.health_check_interval = 60
+        self.health_check_timeout = 1
+        self.index_catalog_interval = 0
+        self.metrics_address = '127.0.0.1'
+        self.metrics_port = 0
+        self.access_log = None
+        self.authentication_cache_size = 100
+        self.negative_authentication_ttl = 0
+        self.permission_cache_size = 0
+        self.inspection_cache_size = 0
+        self.inspection_cache_ttl = 0
+        self.response_cache_size = 0
+        for name, value in options.iteritems():
+            setattr(self, name, value)
+
+
+class ProxyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.elasticsearch = FakeElasticsearch()
+        self._serve(self.elasticsearch.serve_forever)
+        self.proxy = None
+
+    def tearDown(self):
+        if self.proxy is not None:
+            self.proxy.shutdown()
+
+        self.elasticsearch.shutdown()
+        self.elasticsearch.server_close()
+
+    def _serve(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    def start_proxy(self, **options):
+        """Start a proxy with the given settings and return its url."""
+        self.proxy = ElasticReverseProxy(Settings('http://127.0.0.1:{0}'.format(self.elasticsearch.server_port),
+                                                  **options))
+        self.proxy.server_bind()
+        self.proxy.server_activate()
+        self.proxy._workers.start()
+        self._serve(self.proxy.serve_forever)
+        return 'http://127.0.0.1:{0}'.format(self.proxy.server_port)
+
+    def post(self, url, payload, **headers):
+        """Send a POST request to the given url and return the status and JSON payload of its response."""
+        response = requests.post(url, data=payload, headers=headers)
+        return response.status_code, response.json()
+
+    def get(self, url, **headers):
+        """Send a GET request to the given url and return the status, headers and raw payload of its response."""
+        response = requests.get(url, headers=headers, stream=True)
+        return response.status_code, response.headers, response.raw.read(decode_content=False)
+
+    def test_cached_response_is_compressed_as_well(self):
+        url = self.start_proxy(compression_threshold=1, response_cache_size=2**20)
+        for _ in range(2):
+            status, headers, payload = self.get(url + '/_nodes', **{'Accept-Encoding': 'gzip'})
+            self.assertEqual(status, 200)
+            self.assertEqual(headers.get('Content-Encoding'), 'gzip')
+            self.assertEqual(json.loads(gzip.GzipFile(fileobj=StringIO(payload)).read()), NODES_INFO)
+
+        self.assertEqual(len(self.elasticsearch.received), 1)  # The second response is a cached one
+
+        status, headers, payload = self.get(url + '/_nodes', **{'Accept-Encoding': 'identity'})
+        self.assertEqual(status, 200)
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(json.loads(payload), NODES_INFO)
+
+    def test_chunked_response_is_compressed_according_to_threshold(self):
+        self.elasticsearch.chunked = True
+        url = self.start_proxy(compression_threshold=len(json.dumps(NODES_INFO)) + 1)
+        status, headers, payload = self.get(url + '/_nodes', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(json.loads(payload), NODES_INFO)
+
+        self.proxy.compression_threshold = 20
+        status, headers, payload = self.get(url + '/_nodes', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers.get('Content-Encoding'), 'gzip')
+        self.assertEqual(json.loads(gzip.GzipFile(fileobj=StringIO(payload)).read()), NODES_INFO)
+
+    def test_bulk_actions_are_inspected_at_all_locations(self):
+        url = self.start_proxy(role_backend=RoleBackend(Role('logs', {
+            'cluster': ['api/bulk'],
+            'indices': [{'permissions': 'api/documents/index', 'include': 'logs'}]
+        })))
+
+        payload = '{"index":{"_index":"secret","_type":"events","_id":"1"}}\n{"message":"x"}\n' \
+                  '{"index":{"_index":"logs","_type":"events","_id":"2"}}\n{"message":"y"}\n'
+        for path in ('/_bulk', '/logs/_bulk', '/logs/events/_bulk'):
+            status, result = self.post(url + path + '?refresh=false', payload)
+            self.assertEqual(status, 200)
+            self.assertTrue(result['errors'])
+            self.assertEqual(result['items'][0]['index']['status'], 403)
+            self.assertEqual(result['items'][1]['index']['status'], 201)
+            self.assertNotIn('secret', self.elasticsearch.payloads[-1])
+
+    def test_bulk_update_actions_return_permitted_stored_fields_only(self):
+        url = self.start_proxy(role_backend=RoleBackend(Role('logs', {
+            'cluster': ['api/bulk'],
+            'indices': [{
+                'include': 'logs',
+                'permissions': ['api/documents/update', 'api/documents/get'],
+                'types': [{'include': 'events', 'fields': [{'include': 'public*'}]}]
+            }]
+        })))
+
+        update = '{"update":{"_index":"logs","_type":"events","_id":"1"%s}}\n{"doc":{"public":1}}\n'
+        status, result = self.post(url + '/_bulk?refresh=false', update % ',"fields":["public","secret"]')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(self.elasticsearch.payloads[-1].splitlines()[0])['update']['fields'], 'public')
+
+        for query, fields in (('', ',"fields":["_source"]'), ('', ',"fields":"secret"'), ('&fields=secret', '')):
+            status, result = self.post(url + '/_bulk?refresh=false' + query, update % fields)
+            self.assertEqual(status, 200)
+            self.assertEqual(result['items'][0]['update']['status'], 403)
+
+        self.assertEqual(len(self.elasticsearch.payloads), 1)
+
+    def test_search_features_are_detected_in_all_spellings(self):
+        url = self.start_proxy(role_backend=RoleBackend(Role('logs', {
+            'indices': [{'permissions': 'api/search/documents', 'include': 'logs'}]
+        })))
+
+        bodies = [
+            {'query': {'more_like_this': {'fields': ['message'], 'like_text': 'x'}}},
+            {'query': {'moreLikeThis': {'fields': ['message'], 'like_text': 'x'}}},
+            {'query': {'mlt': {'fields': ['message'], 'like_text': 'x'}}},
+            {'query': {'mlt_field': {'message': {'like_text': 'x'}}}},
+            {'query': {'more_like_this_field': {'message': {'like_text': 'x'}}}},
+            {'query': {'fuzzyLikeThis': {'fields': ['message'], 'like_text': 'x'}}},
+            {'query': {'fuzzy_like_this_field': {'message': {'like_text': 'x'}}}},
+            {'query': {'match_all': {}}, 'innerHits': {'comments': {}}},
+            {'query': {'match_all': {}}, 'scriptFields': {'x': {'script': '1'}}},
+        ]
+        for body in bodies:
+            status, result = self.post(url + '/logs/_search', json.dumps(body))
+            self.assertEqual(status, 403, (body, result))
+
+        self.assertEqual(self.elasticsearch.payloads, [])
+
+    def test_query_string_search_is_detected_in_all_spellings(self):
+        url = self.start_proxy(role_backend=RoleBackend(Role('logs', {
+            'indices': [{
+                'include': 'logs',
+                'permissions': 'api/search/documents',
+                'types': [{'include': 'events', 'fields': [{'include': 'message'}]}]
+            }]
+        })))
+
+        for name in ('query_string', 'queryString', 'simple_query_string', 'simpleQueryString'):
+            status, result = self.post(url + '/logs/events/_search', json.dumps({'query': {name: {'query': 'x'}}}))
+            self.assertEqual(status, 403, (name, result))
+
+        self.assertEqual(self.elasticsearch.payloads, [])
+    def test_role_memberships_are_cleared_once_the_configuration_index_is_written_to(self):
+        role_backend = RoleBackend()
+        url = self.start_proxy(role_backend=role_backend)
+
+        action = '{"index":{"_index":"%s","_type":"role","_id":"1"}}\n{"users":["nobody"]}\n'
+        self.post(url + '/_bulk', action % 'logs')
+        self.assertEqual(role_backend.cleared, 0)
+
+        self.post(url + '/_bulk', action % CONFIGURATION_INDEX)
+        self.assertEqual(role_backend.cleared, 1)
+
+        self.post(url + '/logs/_bulk', action % CONFIGURATION_INDEX)
+        self.assertEqual(role_backend.cleared, 2)
+
+        self.assertIn(CONFIGURATION_INDEX, self.elasticsearch.payloads[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
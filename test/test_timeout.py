@@ -0,0 +1,41 @@
+# ElasticArmor | (c) 2016 NETWAYS GmbH | GPLv2+
+
+import unittest
+
+from elasticarmor.util import parse_time_value
+from elasticarmor.util.elastic import _extend_timeout
+
+
+class ParseTimeValueTestCase(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(parse_time_value('1500'), 1.5)
+        self.assertEqual(parse_time_value('250ms'), 0.25)
+        self.assertEqual(parse_time_value('30s'), 30)
+        self.assertEqual(parse_time_value('2m'), 120)
+        self.assertEqual(parse_time_value('1h'), 3600)
+        self.assertEqual(parse_time_value('1d'), 86400)
+        self.assertEqual(parse_time_value(' 5S '), 5)
+        self.assertEqual(parse_time_value('-20s'), -20)
+
+    def test_invalid_values(self):
+        for value in ('', 's', 'abc', '10x', '1.2.3s'):
+            self.assertRaises(ValueError, parse_time_value, value)
+
+
+class ExtendTimeoutTestCase(unittest.TestCase):
+    def test_positive_values_extend_the_timeout(self):
+        self.assertEqual(_extend_timeout(10, '30s', 300), 40)
+        self.assertEqual(_extend_timeout(10, '500', 300), 10.5)
+
+    def test_extension_is_capped(self):
+        self.assertEqual(_extend_timeout(10, '30d', 300), 310)
+        self.assertEqual(_extend_timeout(10, 'infs', 300), 310)
+        self.assertEqual(_extend_timeout(10, '30s', 0), 10)
+
+    def test_invalid_and_non_positive_values_are_ignored(self):
+        for value in ('-20s', '0', '0s', 'nans', 'abc'):
+            self.assertEqual(_extend_timeout(10, value, 300), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()